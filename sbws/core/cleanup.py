@@ -1,5 +1,6 @@
 from sbws.util.filelock import DirectoryLock
 from sbws.globals import (fail_hard, is_initted)
+from sbws.lib.resultstore import SQLiteResultStore, results_db_fname
 from argparse import ArgumentDefaultsHelpFormatter
 from datetime import datetime
 from datetime import timedelta
@@ -92,20 +93,19 @@ def _compress_stale_files(datadir, stale_days, dry_run=True):
             os.remove(fname)
 
 
-def main(args, conf):
-    '''
-    Main entry point in to the cleanup command.
-
-    :param argparse.Namespace args: command line arguments
-    :param configparser.ConfigParser conf: parsed config files
-    '''
-    if not is_initted(args.directory):
-        fail_hard('Sbws isn\'t initialized. Try sbws init')
+def _remove_rotten_results_in_db(datadir, rotten_days, dry_run=True):
+    assert os.path.isdir(datadir)
+    assert isinstance(rotten_days, int)
+    oldest_allowed = time.time() - rotten_days * 24*60*60
+    store = SQLiteResultStore(results_db_fname(datadir))
+    num = store.delete_results_older_than(oldest_allowed, dry_run=dry_run)
+    log.info('Deleting %d results older than %d days from %s', num,
+             rotten_days, results_db_fname(datadir))
 
-    datadir = conf['paths']['datadir']
-    if not os.path.isdir(datadir):
-        fail_hard('%s does not exist', datadir)
 
+def check_days(conf):
+    ''' Make sure the cleanup days in **conf** leave the fresh results alone.
+    Fails hard if they don't. '''
     fresh_days = conf.getint('general', 'data_period')
     stale_days = conf.getint('cleanup', 'stale_days')
     rotten_days = conf.getint('cleanup', 'rotten_days')
@@ -124,5 +124,34 @@ def main(args, conf):
             'if necessary, it is recommended to make stale_days at least '
             'twice the data_period.', stale_days, fresh_days)
 
-    _remove_rotten_files(datadir, rotten_days, dry_run=args.dry_run)
-    _compress_stale_files(datadir, stale_days, dry_run=args.dry_run)
+
+def clean_datadir(conf, dry_run=False):
+    ''' Delete the rotten results in the datadir and compress the stale
+    result files. check_days() must have been called first. '''
+    datadir = conf['paths']['datadir']
+    stale_days = conf.getint('cleanup', 'stale_days')
+    rotten_days = conf.getint('cleanup', 'rotten_days')
+    if conf['general']['result_store'] == 'sqlite':
+        # Results in the database don't go stale; there is nothing to
+        # compress. Old result files, if any, are still cleaned up below.
+        _remove_rotten_results_in_db(datadir, rotten_days, dry_run=dry_run)
+    _remove_rotten_files(datadir, rotten_days, dry_run=dry_run)
+    _compress_stale_files(datadir, stale_days, dry_run=dry_run)
+
+
+def main(args, conf):
+    '''
+    Main entry point in to the cleanup command.
+
+    :param argparse.Namespace args: command line arguments
+    :param configparser.ConfigParser conf: parsed config files
+    '''
+    if not is_initted(args.directory):
+        fail_hard('Sbws isn\'t initialized. Try sbws init')
+
+    datadir = conf['paths']['datadir']
+    if not os.path.isdir(datadir):
+        fail_hard('%s does not exist', datadir)
+
+    check_days(conf)
+    clean_datadir(conf, dry_run=args.dry_run)
@@ -2,12 +2,21 @@ from datetime import datetime
 
 from sbws.globals import (fail_hard, is_initted, TIMESTAMP_DT_FRMT)
 from sbws.lib.v3bwfile import V3BwHeader
-from sbws.lib.resultdump import ResultSuccess
-from sbws.lib.resultdump import load_recent_results_in_datadir
+from sbws.lib.v3bwfile import write_v3bw
+from sbws.lib.resultdump import download_speed
+from sbws.lib.resultdump import load_recent_result_fields_in_datadir
+from sbws.lib.generatecheckpoint import GenerateCheckpoint
+from sbws.lib.generatecheckpoint import (
+    load_recent_result_fields_incrementally)
 from sbws.util.filelock import FileLock
 from argparse import ArgumentDefaultsHelpFormatter
+from sbws.lib.v3bwarrays import V3BWColumns
+from sbws.lib.v3bwarrays import have_numpy
+from sbws.util.quantiles import KLLSketch
 from statistics import median
+from threading import Event
 import os
+import time
 import logging
 
 log = logging.getLogger(__name__)
@@ -20,8 +29,11 @@ class V3BWLine:
         # convert to KiB and make sure the answer is at least 1
         self.bw = max(round(bw / 1024), 1)
         # convert to ms
-        rtts = [round(r * 1000) for r in rtts]
-        self.rtt = round(median(rtts))
+        if isinstance(rtts, KLLSketch):
+            self.rtt = round(rtts.median() * 1000)
+        else:
+            rtts = [round(r * 1000) for r in rtts]
+            self.rtt = round(median(rtts))
         self.time = last_time
 
     def __str__(self):
@@ -30,24 +42,34 @@ class V3BWLine:
                            t=self.time)
 
 
+# The only parts of the results generate needs
+RESULT_FIELDS = ('nickname', 'time', 'rtts', 'downloads')
+
+
 def result_data_to_v3bw_line(data, fingerprint):
+    ''' Make the V3BWLine for the relay with **fingerprint** from the field
+    dictionary **data**, which has the RESULT_FIELDS of its successful
+    results. Its rtts and downloads can be lists or KLLSketches. '''
     assert fingerprint in data
-    results = data[fingerprint]
-    for res in results:
-        assert isinstance(res, ResultSuccess)
-    results = data[fingerprint]
-    nick = results[0].nickname
-    speeds = [dl['amount'] / dl['duration']
-              for r in results for dl in r.downloads]
-    speed = median(speeds)
-    rtts = [rtt for r in results for rtt in r.rtts]
-    last_time = round(max([r.time for r in results]))
-    return V3BWLine(fingerprint, speed, nick, rtts, last_time)
+    fields = data[fingerprint]
+    nick = fields['nickname'][0]
+    if isinstance(fields['downloads'], KLLSketch):
+        # Of the download speeds already
+        speed = fields['downloads'].median()
+    else:
+        speed = median([download_speed(dl) for dl in fields['downloads']])
+    last_time = round(max(fields['time']))
+    return V3BWLine(fingerprint, speed, nick, fields['rtts'], last_time)
 
 
 def warn_if_not_accurate_enough(lines, constant):
+    warn_if_mean_not_accurate_enough(
+        sum([l.bw for l in lines]) / len(lines), constant)
+
+
+def warn_if_mean_not_accurate_enough(mean_bw, constant):
     margin = 0.001
-    accuracy_ratio = (sum([l.bw for l in lines]) / len(lines)) / constant
+    accuracy_ratio = mean_bw / constant
     log.info('The generated lines are within {:.5}% of what they should '
              'be'.format((1-accuracy_ratio)*100))
     if accuracy_ratio < 1 - margin or accuracy_ratio > 1 + margin:
@@ -72,12 +94,36 @@ def scale_lines(args, v3bw_lines):
     return v3bw_lines
 
 
-def gen_parser(sub):
-    d = 'Generate a v3bw file based on recent results. A v3bw file is the '\
-        'file Tor directory authorities want to read and base their '\
-        'bandwidth votes on.'
-    p = sub.add_parser('generate', description=d,
-                       formatter_class=ArgumentDefaultsHelpFormatter)
+def scale_columns(args, columns):
+    ''' Like scale_lines(), but for the V3BWColumns **columns** '''
+    assert len(columns) > 0
+    if args.scale:
+        columns.scale(len(columns) * args.scale_constant)
+        warn_if_mean_not_accurate_enough(columns.mean_bw(),
+                                         args.scale_constant)
+    return columns
+
+
+def v3bw_lines_text(args, results, sketch_k=None):
+    ''' Return the sorted and scaled v3bw lines for the field dictionary
+    **results** as one string. Uses NumPy when it's installed and the results
+    aren't in quantile sketches. '''
+    if have_numpy() and not sketch_k:
+        columns = V3BWColumns.from_result_fields(results)
+        columns.sort_by_bw()
+        columns = scale_columns(args, columns)
+        log_mean_bw(columns.mean_bw())
+        return columns.lines()
+    data_lines = [result_data_to_v3bw_line(results, fp) for fp in results]
+    data_lines = sorted(data_lines, key=lambda d: d.bw, reverse=True)
+    data_lines = scale_lines(args, data_lines)
+    log_stats(data_lines)
+    return ''.join(['{}\n'.format(str(line)) for line in data_lines])
+
+
+def add_v3bw_arguments(p):
+    ''' Add the arguments about how to make the v3bw file to the parser
+    **p**. sbws service uses them too. '''
     p.add_argument('--output', default=None, type=str,
                    help='If specified, write the v3bw here instead of what is'
                    'specified in the configuration')
@@ -95,10 +141,36 @@ def gen_parser(sub):
                    'out, and we do so proportionally')
 
 
+def gen_parser(sub):
+    d = 'Generate a v3bw file based on recent results. A v3bw file is the '\
+        'file Tor directory authorities want to read and base their '\
+        'bandwidth votes on.'
+    p = sub.add_parser('generate', description=d,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    add_v3bw_arguments(p)
+    p.add_argument('--incremental', action='store_true',
+                   help='Only read the results written since the last '
+                   '--incremental run, keeping what is needed from older '
+                   'results in a checkpoint in the datadir. The output is '
+                   'the same. Only works with the files result store')
+    p.add_argument('--load-processes', default=None, type=int,
+                   help='Parse this many result files at a time in worker '
+                   'processes. Defaults to general.load_processes in the '
+                   'configuration')
+    p.add_argument('--daemon', action='store_true',
+                   help='Keep running, publishing a new v3bw file every '
+                   'generate.publish_interval seconds. The recent results '
+                   'are kept in memory and only new results are read each '
+                   'time')
+
+
 def log_stats(data_lines):
     assert len(data_lines) > 0
     total_bw = sum([l.bw for l in data_lines])
-    bw_per_line = total_bw / len(data_lines)
+    log_mean_bw(total_bw / len(data_lines))
+
+
+def log_mean_bw(bw_per_line):
     log.info('Mean bandwidth per line: %f "KiB"', bw_per_line)
 
 
@@ -120,6 +192,123 @@ def read_started_ts(conf):
     return generator_started
 
 
+def load_results(args, conf):
+    ''' Return the field dictionary of recent successful results that generate
+    makes the v3bw lines from '''
+    datadir = conf['paths']['datadir']
+    fresh_days = conf.getint('general', 'data_period')
+    result_store = conf['general']['result_store']
+    sketch_k = conf.getint('general', 'quantile_sketch_k') or None
+    if args.incremental and result_store != 'files':
+        log.warning('--incremental only works with the files result store, '
+                    'so reading all recent results from the %s one',
+                    result_store)
+    if args.incremental and result_store == 'files':
+        return load_recent_result_fields_incrementally(
+            fresh_days, datadir, RESULT_FIELDS, success_only=True,
+            sketch_k=sketch_k)
+    return load_recent_result_fields_in_datadir(
+        fresh_days, datadir, RESULT_FIELDS, success_only=True,
+        result_store=result_store,
+        processes=args.load_processes or
+        conf.getint('general', 'load_processes'),
+        sketch_k=sketch_k)
+
+
+def v3bw_text(args, conf, results):
+    ''' Return the whole v3bw document for the field dictionary **results**,
+    or None if there aren't any results '''
+    if len(results) < 1:
+        log.warning('No recent results, so not generating anything. (Have you '
+                    'ran sbws scanner recently?)')
+        return None
+    sketch_k = conf.getint('general', 'quantile_sketch_k') or None
+    # Using naive datetime object without timezone, assumed utc
+    # Not using .isoformat() since that does not include 'T'
+    earliest_bandwidth = datetime.utcfromtimestamp(
+        min([min(results[fp]['time']) for fp in results])) \
+        .strftime(TIMESTAMP_DT_FRMT)
+    lines = v3bw_lines_text(args, results, sketch_k=sketch_k)
+    generator_started = read_started_ts(conf)
+    header = V3BwHeader(earliest_bandwidth=earliest_bandwidth,
+                        generator_started=generator_started)
+    return str(header) + lines
+
+
+def publish_v3bw(args, conf, text):
+    ''' Atomically replace the v3bw file with **text**, keeping a copy of it
+    in paths.v3bw_history_dname if that is set '''
+    output = conf['paths']['v3bw_fname']
+    if args.output:
+        output = args.output
+    log.info('Writing v3bw file to %s', output)
+    history_fname = write_v3bw(
+        output, text, history_dname=conf['paths']['v3bw_history_dname'])
+    if history_fname is not None:
+        log.debug('Kept a copy of the v3bw file in %s', history_fname)
+
+
+class GenerateDaemon:
+    ''' What ``sbws generate --daemon`` keeps between the v3bw files it
+    publishes.
+
+    With the files result store, the fields of the recent results stay in
+    memory in a GenerateCheckpoint, and each run only reads the results
+    written since the last one. With the sqlite one, each run reads all recent
+    results from the database.
+    '''
+    def __init__(self, args, conf):
+        self.args = args
+        self.conf = conf
+        self.datadir = conf['paths']['datadir']
+        self.fresh_days = conf.getint('general', 'data_period')
+        self.result_store = conf['general']['result_store']
+        self.sketch_k = conf.getint('general', 'quantile_sketch_k') or None
+        self._checkpoint = None
+
+    def _new_checkpoint(self):
+        return GenerateCheckpoint(self.fresh_days, RESULT_FIELDS,
+                                  success_only=True)
+
+    def load_results(self):
+        ''' Return the field dictionary of the recent successful results '''
+        if self.result_store != 'files':
+            return load_results(self.args, self.conf)
+        if self._checkpoint is None or not self._checkpoint.is_usable(
+                self.datadir, self.fresh_days, RESULT_FIELDS,
+                success_only=True):
+            log.info('Reading all recent results')
+            self._checkpoint = self._new_checkpoint()
+        oldest_allowed = time.time() - self.fresh_days * 24*60*60
+        self._checkpoint.expire(oldest_allowed)
+        num_new = self._checkpoint.read_new_results(
+            self.datadir, oldest_allowed)
+        log.debug('Read %d new results', num_new)
+        return self._checkpoint.result_fields(sketch_k=self.sketch_k)
+
+    def run_once(self):
+        ''' Publish a v3bw file made from the recent results. Return whether
+        there were results to make it from. '''
+        text = v3bw_text(self.args, self.conf, self.load_results())
+        if text is None:
+            return False
+        publish_v3bw(self.args, self.conf, text)
+        return True
+
+    def run(self, end_event):
+        ''' Publish a v3bw file every generate.publish_interval seconds until
+        **end_event** is set '''
+        interval = self.conf.getint('generate', 'publish_interval')
+        while not end_event.is_set():
+            start = time.time()
+            try:
+                self.run_once()
+            except Exception:
+                # Maybe it works with the next results
+                log.exception('Unable to publish a v3bw file')
+            end_event.wait(max(0, interval - (time.time() - start)))
+
+
 def main(args, conf):
     if not is_initted(args.directory):
         fail_hard('Sbws isn\'t initialized.  Try sbws init')
@@ -129,36 +318,13 @@ def main(args, conf):
         fail_hard('%s does not exist', datadir)
     if args.scale_constant < 1:
         fail_hard('--scale-constant must be positive')
+    if args.load_processes is not None and args.load_processes < 1:
+        fail_hard('--load-processes must be positive')
 
-    fresh_days = conf.getint('general', 'data_period')
-    results = load_recent_results_in_datadir(
-        fresh_days, datadir, success_only=True)
-    if results:
-        # Using naive datetime object without timezone, assumed utc
-        # Not using .isoformat() since that does not include 'T'
-        earliest_bandwidth = datetime.utcfromtimestamp(
-                                min([r.time for fp in results
-                                     for r in results[fp]])) \
-                                .strftime(TIMESTAMP_DT_FRMT)
-    if len(results) < 1:
-        log.warning('No recent results, so not generating anything. (Have you '
-                    'ran sbws scanner recently?)')
+    if args.daemon:
+        GenerateDaemon(args, conf).run(Event())
         return
-    data_lines = [result_data_to_v3bw_line(results, fp) for fp in results]
-    data_lines = sorted(data_lines, key=lambda d: d.bw, reverse=True)
-    data_lines = scale_lines(args, data_lines)
-    generator_started = read_started_ts(conf)
-    if results:
-        header = V3BwHeader(earliest_bandwidth=earliest_bandwidth,
-                            generator_started=generator_started)
-    else:
-        header = V3BwHeader(generator_started=generator_started)
-    log_stats(data_lines)
-    output = conf['paths']['v3bw_fname']
-    if args.output:
-        output = args.output
-    log.info('Writing v3bw file to %s', output)
-    with open(output, 'wt') as fd:
-        fd.write(str(header))
-        for line in data_lines:
-            fd.write('{}\n'.format(str(line)))
+    text = v3bw_text(args, conf, load_results(args, conf))
+    if text is None:
+        return
+    publish_v3bw(args, conf, text)
@@ -9,42 +9,88 @@ from ..lib.resultdump import ResultErrorStream
 from ..lib.relaylist import RelayList
 from ..lib.relayprioritizer import RelayPrioritizer
 from ..lib.destination import DestinationList
+from ..lib.destination import check_content_range
+from ..lib.destination import streams_attached_to_circuit
 from ..util.filelock import FileLock
 # from ..util.simpleauth import authenticate_to_server
 # from ..util.sockio import (make_socket, close_socket)
-from sbws.globals import (fail_hard, is_initted, TIMESTAMP_DT_FRMT)
+from sbws.globals import (fail_hard, is_initted, TIMESTAMP_DT_FRMT,
+                          DOWNLOAD_CHUNK_SIZE)
 import sbws.util.stem as stem_utils
 import sbws.util.requests as requests_utils
 from argparse import ArgumentDefaultsHelpFormatter
 from multiprocessing.dummy import Pool
 from threading import Event
+from threading import Lock
+from threading import Semaphore
+from threading import local
+from collections import deque
+from statistics import mean
 import time
 import os
+import sys
 import logging
 import requests
+import urllib3
 import random
 
 rng = random.SystemRandom()
 end_event = Event()
+_thread_local = local()
 log = logging.getLogger(__name__)
 
 
-def timed_recv_from_server(session, dest, byte_range):
+def _get_download_buffer():
+    ''' Return the download buffer belonging to the calling thread, creating
+    it if this thread doesn't have one yet. Every measurement thread reads all
+    of its downloads into the same buffer, so the memory used by a measurement
+    doesn't depend on how many bytes we ask for. '''
+    buf = getattr(_thread_local, 'download_buffer', None)
+    if buf is None:
+        buf = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        _thread_local.download_buffer = buf
+    return buf
+
+
+def timed_recv_from_server(session, dest, byte_range, content_length=None):
     ''' Request the **byte_range** from the URL at **dest**. If successful,
     return True and the time it took to download. Otherwise return False and an
-    exception. '''
+    exception or a string stating what the issue is.
+
+    With **content_length**, also check that the response is for a range of a
+    content that long. If it isn't, **dest** forgets its content length.
+
+    The body is streamed in **DOWNLOAD_CHUNK_SIZE** chunks into a per-thread
+    buffer and thrown away, so we never hold more than one chunk of it in
+    memory. The time is taken when the last byte was received. '''
     headers = {'Range': byte_range, 'Accept-Encoding': 'identity'}
+    buf = _get_download_buffer()
     start_time = time.time()
+    end_time = start_time
     # TODO:
     # - What other exceptions can this throw?
-    # - Do we have to read the content, or did requests already do so?
     try:
-        requests_utils.get(session, dest.url, headers=headers)
+        with requests_utils.get(session, dest.url, headers=headers,
+                                stream=True) as resp:
+            if content_length is not None:
+                error = check_content_range(
+                    resp.status_code, resp.headers, content_length)
+                if error is not None:
+                    dest.content_length = None
+                    return False, error
+            while True:
+                num_read = resp.raw.readinto(buf)
+                if not num_read:
+                    break
+                end_time = time.time()
     except requests.exceptions.ConnectionError as e:
         return False, e
     except requests.exceptions.ReadTimeout as e:
         return False, e
-    end_time = time.time()
+    # Since we are reading from the raw stream, errors while receiving the
+    # body come straight from urllib3 instead of being wrapped by requests
+    except urllib3.exceptions.HTTPError as e:
+        return False, e
     return True, end_time - start_time
 
 
@@ -80,9 +126,15 @@ def measure_rtt_to_server(session, conf, dest, content_length):
     rtts = []
     size = conf.getint('scanner', 'min_download_size')
     log.debug('Measuring RTT to %s', dest.url)
-    for _ in range(0, conf.getint('scanner', 'num_rtts')):
+    # One more request than RTTs: the first one opens the stream. Its
+    # response also tells us if the content is still what we think it is,
+    # which is all a HEAD would have told us. Its time includes building the
+    # stream and the TLS handshake, so it isn't an RTT.
+    for i in range(0, conf.getint('scanner', 'num_rtts') + 1):
         random_range = get_random_range_string(content_length, size)
-        success, data = timed_recv_from_server(session, dest, random_range)
+        success, data = timed_recv_from_server(
+            session, dest, random_range,
+            content_length=content_length if i == 0 else None)
         if not success:
             # data is an exception
             log.warning('While measuring the RTT to %s we hit an exception '
@@ -92,7 +144,8 @@ def measure_rtt_to_server(session, conf, dest, content_length):
         assert success
         # data is an RTT
         assert isinstance(data, float) or isinstance(data, int)
-        rtts.append(data)
+        if i > 0:
+            rtts.append(data)
     return rtts
 
 
@@ -131,6 +184,30 @@ def measure_bandwidth_to_server(session, conf, dest, content_length):
     return results
 
 
+def pick_helper_exit(conf, rl, dest, relay):
+    ''' Return a random exit that can exit to **dest** to help measure
+    **relay**, or None if there isn't one. We want an exit with a bandwidth
+    between 1.25 and 2 times the relay's. If there is none, the range is
+    widened by scanner.helper_exit_widen_factor up to
+    scanner.helper_exit_widen_steps times. '''
+    min_bw = round(relay.bandwidth*1.25)
+    max_bw = max(round(relay.bandwidth*2.00), 100)
+    factor = conf.getfloat('scanner', 'helper_exit_widen_factor')
+    steps = conf.getint('scanner', 'helper_exit_widen_steps')
+    for step in range(0, steps + 1):
+        exit = rl.random_exit_to(dest.hostname, dest.port, min_bw, max_bw,
+                                 exclude_fp=relay.fingerprint)
+        if exit is not None:
+            return exit
+        if step < steps:
+            min_bw = round(min_bw / factor)
+            max_bw = round(max_bw * factor)
+            log.debug('No exits to help measure %s %s, looking between %d '
+                      'and %d', relay.nickname, relay.fingerprint[0:8],
+                      min_bw, max_bw)
+    return None
+
+
 def measure_relay(args, conf, destinations, cb, rl, relay):
     s = requests_utils.make_session(
         cb.controller, conf.getfloat('general', 'http_timeout'))
@@ -141,17 +218,12 @@ def measure_relay(args, conf, destinations, cb, rl, relay):
                     relay.nickname, relay.fingerprint[0:8])
         return None
     # Pick an exit
-    exits = rl.exits_can_exit_to(dest.hostname, dest.port)
-    exits = [e for e in exits if e.fingerprint != relay.fingerprint]
-    exits = stem_utils.only_relays_with_bandwidth(
-        cb.controller, exits, min_bw=round(relay.bandwidth*1.25),
-        max_bw=max(round(relay.bandwidth*2.00), 100))
-    if len(exits) < 1:
+    exit = pick_helper_exit(conf, rl, dest, relay)
+    if exit is None:
         log.warning('No available exits to help measure %s %s', relay.nickname,
                     relay.fingerprint[0:8])
         # TODO: Return ResultError of some sort
         return None
-    exit = rng.choice(exits)
     # Build the circuit
     log.debug('We selected exit %s %s (cw=%d) to help measure %s %s (cw=%d)',
               exit.nickname, exit.fingerprint[0:8], exit.bandwidth,
@@ -168,23 +240,37 @@ def measure_relay(args, conf, destinations, cb, rl, relay):
     log.debug('Built circ %s %s for relay %s %s', circ_id,
               stem_utils.circuit_str(cb.controller, circ_id), relay.nickname,
               relay.fingerprint[0:8])
-    # Make a connection to the destionation webserver and make sure it can
-    # still help us measure
-    is_usable, usable_data = dest.is_usable(circ_id, s, cb.controller)
-    if not is_usable:
-        log.warning('When measuring %s %s the destination seemed to have '
-                    'stopped being usable: %s', relay.nickname,
-                    relay.fingerprint[0:8], usable_data)
-        cb.close_circuit(circ_id)
-        # TODO: Return a different/new type of ResultError?
-        msg = 'The destination seemed to have stopped being usable'
-        return [
-            ResultErrorStream(relay, circ_fps, dest.url, our_nick, msg=msg),
-        ]
-    assert is_usable
-    assert 'content_length' in usable_data
+    content_length = dest.content_length
+    if content_length is None:
+        # Make a connection to the destionation webserver and make sure it
+        # can still help us measure
+        is_usable, usable_data = dest.is_usable(circ_id, s, cb.controller)
+        if not is_usable:
+            log.warning('When measuring %s %s the destination seemed to have '
+                        'stopped being usable: %s', relay.nickname,
+                        relay.fingerprint[0:8], usable_data)
+            cb.close_circuit(circ_id)
+            # TODO: Return a different/new type of ResultError?
+            msg = 'The destination seemed to have stopped being usable'
+            return [
+                ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                                  msg=msg),
+            ]
+        assert is_usable
+        assert 'content_length' in usable_data
+        content_length = usable_data['content_length']
+    with streams_attached_to_circuit(s, cb.controller, circ_id):
+        return _measure_relay_over_circuit(
+            conf, s, cb, dest, relay, circ_fps, circ_id, content_length)
+
+
+def _measure_relay_over_circuit(conf, s, cb, dest, relay, circ_fps, circ_id,
+                                content_length):
+    ''' The rest of measure_relay(), once the circuit is built and we know the
+    **content_length** of **dest**. Closes the circuit. '''
+    our_nick = conf['scanner']['nickname']
     # FIRST: measure RTT
-    rtts = measure_rtt_to_server(s, conf, dest, usable_data['content_length'])
+    rtts = measure_rtt_to_server(s, conf, dest, content_length)
     if rtts is None:
         log.warning('Unable to measure RTT to %s via relay %s %s',
                     dest.url, relay.nickname, relay.fingerprint[0:8])
@@ -196,7 +282,7 @@ def measure_relay(args, conf, destinations, cb, rl, relay):
         ]
     # SECOND: measure bandwidth
     bw_results = measure_bandwidth_to_server(
-        s, conf, dest, usable_data['content_length'])
+        s, conf, dest, content_length)
     if bw_results is None:
         log.warning('Unable to measure bandwidth to %s via relay %s %s',
                     dest.url, relay.nickname, relay.fingerprint[0:8])
@@ -258,21 +344,72 @@ def _next_expected_amount(expected_amount, result_time, download_times,
     return expected_amount
 
 
-def result_putter(result_dump):
+class WorkerSlots:
+    ''' Counts the free measurement workers so that a new measurement can be
+    started the moment a running one finishes, and keeps track of how long a
+    free worker waited for its next measurement (the submission latency).
+    Also knows which relays are being measured, so that a relay is never
+    measured twice at once. '''
+    def __init__(self, num_slots):
+        assert num_slots > 0
+        self._sem = Semaphore(num_slots)
+        self._lock = Lock()
+        self._freed_at = deque()
+        self._in_flight = set()
+
+    def is_measuring(self, fingerprint):
+        with self._lock:
+            return fingerprint in self._in_flight
+
+    def acquire(self, fingerprint=None):
+        ''' Block until a worker is free, and take it to measure the relay
+        with **fingerprint**. Return how many seconds the worker was free
+        before we took it, or None if it was never busy. '''
+        self._sem.acquire()
+        with self._lock:
+            if fingerprint is not None:
+                self._in_flight.add(fingerprint)
+            if not self._freed_at:
+                return None
+            return time.time() - self._freed_at.popleft()
+
+    def release(self, fingerprint=None):
+        ''' Call when the measurement of the relay with **fingerprint**
+        finishes, no matter how '''
+        with self._lock:
+            self._in_flight.discard(fingerprint)
+            self._freed_at.append(time.time())
+        self._sem.release()
+
+
+def result_putter(result_dump, worker_slots=None, target=None):
     ''' Create a function that takes a single argument -- the measurement
-    result -- and return that function so it can be used by someone else '''
+    result -- and return that function so it can be used by someone else. If
+    given **worker_slots**, the function frees the worker slot measuring
+    **target** after handing off the result. '''
     def closure(measurement_result):
-        return result_dump.queue.put(measurement_result)
+        try:
+            return result_dump.queue.put(measurement_result)
+        finally:
+            if worker_slots is not None:
+                worker_slots.release(
+                    None if target is None else target.fingerprint)
     return closure
 
 
-def result_putter_error(target):
+def result_putter_error(target, worker_slots=None):
     ''' Create a function that takes a single argument -- an error from a
-    measurement -- and return that function so it can be used by someone else
+    measurement -- and return that function so it can be used by someone else.
+    If given **worker_slots**, the function frees the worker slot measuring
+    **target**.
     '''
     def closure(err):
-        log.error('Unhandled exception caught while measuring %s: %s %s',
-                  target.nickname, type(err), err)
+        try:
+            log.error('Unhandled exception caught while measuring %s: %s %s',
+                      target.nickname, type(err), err)
+        finally:
+            if worker_slots is not None:
+                worker_slots.release(target.fingerprint)
     return closure
 
 
@@ -293,7 +430,9 @@ def write_start_ts(conf):
             fd.write(generator_started)
 
 
-def run_speedtest(args, conf):
+def run_speedtest(args, conf, rd=None):
+    ''' Measure relays until interrupted. Results go to the ResultDump **rd**,
+    or to a new one if not given. '''
     write_start_ts(conf)
     controller, _ = stem_utils.init_controller(
         path=conf['tor']['control_socket'])
@@ -311,31 +450,60 @@ def run_speedtest(args, conf):
             'even lead to messed up results.', conf['tor']['control_socket'])
         time.sleep(15)
     assert stem_utils.is_controller_okay(controller)
+    if not stem_utils.reports_socks_usernames(controller):
+        fail_hard('Tor %s is too old. sbws needs tor %s or newer to attach '
+                  'its streams to the right circuits.',
+                  controller.get_version(),
+                  stem_utils.SOCKS_USERNAME_IN_STREAM_EVENTS)
     cb = CB(args, conf, controller)
     rl = RelayList(args, conf, controller)
-    rd = ResultDump(args, conf, end_event)
+    if rd is None:
+        rd = ResultDump(args, conf, end_event)
     rp = RelayPrioritizer(args, conf, rl, rd)
     destinations, error_msg = DestinationList.from_config(
         conf, cb, rl, controller)
     if not destinations:
         fail_hard(error_msg)
+    if conf['scanner']['engine'] == 'asyncio':
+        # Only import it when asked for since it needs Python 3.5+
+        from ..lib.asyncengine import AsyncMeasurementEngine
+        engine = AsyncMeasurementEngine(
+            args, conf, controller, cb, rl, rd, rp, destinations, end_event)
+        engine.run()
+        return
     max_pending_results = conf.getint('scanner', 'measurement_threads')
     pool = Pool(max_pending_results)
-    pending_results = []
+    worker_slots = WorkerSlots(max_pending_results)
     while True:
+        latencies = []
+        num_dispatched = 0
         for target in rp.best_priority():
+            # Only we add relays, so it can't start being measured again
+            # while we wait for a worker
+            if worker_slots.is_measuring(target.fingerprint):
+                log.debug('Already measuring %s %s', target.nickname,
+                          target.fingerprint[0:8])
+                continue
+            latency = worker_slots.acquire(target.fingerprint)
+            if latency is not None:
+                latencies.append(latency)
             log.debug('Measuring %s %s', target.nickname,
                       target.fingerprint[0:8])
-            callback = result_putter(rd)
-            callback_err = result_putter_error(target)
-            async_result = pool.apply_async(
+            num_dispatched += 1
+            callback = result_putter(rd, worker_slots, target)
+            callback_err = result_putter_error(target, worker_slots)
+            pool.apply_async(
                 dispatch_worker_thread,
                 [args, conf, destinations, cb, rl, target],
                 {}, callback, callback_err)
-            pending_results.append(async_result)
-            while len(pending_results) >= max_pending_results:
-                time.sleep(5)
-                pending_results = [r for r in pending_results if not r.ready()]
+        if latencies:
+            log.info('Free workers waited %.3f secs on average (%.3f max) '
+                     'for their next measurement', mean(latencies),
+                     max(latencies))
+        if num_dispatched == 0:
+            # Everything with the best priority is already being measured, so
+            # give some measurements a chance to finish
+            time.sleep(1)
 
 
 def gen_parser(sub):
@@ -347,7 +515,9 @@ def gen_parser(sub):
                    description=d)
 
 
-def main(args, conf):
+def check_conf(args, conf):
+    ''' Fail hard if we can't scan with **conf**. Creates the datadir if
+    needed. '''
     if not is_initted(args.directory):
         fail_hard('Sbws isn\'t initialized. Try sbws init')
 
@@ -360,8 +530,14 @@ def main(args, conf):
         fail_hard('Max download size %d cannot be smaller than min %d',
                   max_dl, min_dl)
 
+    if conf['scanner']['engine'] == 'asyncio' and sys.version_info < (3, 5):
+        fail_hard('The asyncio engine needs Python 3.5 or newer')
+
     os.makedirs(conf['paths']['datadir'], exist_ok=True)
 
+
+def main(args, conf):
+    check_conf(args, conf)
     try:
         run_speedtest(args, conf)
     except KeyboardInterrupt as e:
@@ -0,0 +1,106 @@
+''' Run the scanner, generate and cleanup in one process. '''
+from ..lib.resultdump import ResultDump
+from sbws.globals import fail_hard
+from argparse import ArgumentDefaultsHelpFormatter
+from threading import Thread
+import sbws.core.cleanup
+import sbws.core.generate
+import sbws.core.scanner
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    ''' Calls **func** without arguments every **interval** seconds.
+
+    :param str name: what to call the job in logs
+    :param float interval: seconds from the start of a run to the next one
+    :param callable func: the job
+    '''
+    def __init__(self, name, interval, func):
+        assert interval > 0
+        self.name = name
+        self.interval = interval
+        self.func = func
+        # Run as soon as the jobs are started
+        self.next_run = time.time()
+
+    def run(self):
+        start = time.time()
+        self.next_run = start + self.interval
+        log.debug('Running the %s job', self.name)
+        try:
+            self.func()
+        except Exception:
+            log.exception('The %s job failed', self.name)
+            return
+        log.debug('The %s job took %.3f seconds', self.name,
+                  time.time() - start)
+
+
+def run_jobs(jobs, end_event):
+    ''' Run each of the PeriodicJob **jobs** when it is due, one at a time,
+    until **end_event** is set '''
+    while not end_event.is_set():
+        job = min(jobs, key=lambda j: j.next_run)
+        if end_event.wait(max(0, job.next_run - time.time())):
+            break
+        job.run()
+
+
+def generate_job(args, conf, rd):
+    ''' Return a function that publishes a v3bw file made from the results
+    the ResultDump **rd** has in memory '''
+    sketch_k = conf.getint('general', 'quantile_sketch_k') or None
+
+    def closure():
+        results = rd.result_fields(sbws.core.generate.RESULT_FIELDS,
+                                   success_only=True, sketch_k=sketch_k)
+        text = sbws.core.generate.v3bw_text(args, conf, results)
+        if text is None:
+            return
+        sbws.core.generate.publish_v3bw(args, conf, text)
+    return closure
+
+
+def cleanup_job(conf):
+    def closure():
+        sbws.core.cleanup.clean_datadir(conf)
+    return closure
+
+
+def gen_parser(sub):
+    d = 'Run the scanner, and periodically generate a v3bw file and clean up '\
+        'the datadir in the same process. The v3bw files are made from the '\
+        'results the scanner has in memory instead of from the datadir. '\
+        'v3bw files are published every generate.publish_interval seconds '\
+        'and the datadir is cleaned up every cleanup.interval seconds'
+    p = sub.add_parser('service', description=d,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    sbws.core.generate.add_v3bw_arguments(p)
+
+
+def main(args, conf):
+    sbws.core.scanner.check_conf(args, conf)
+    if args.scale_constant < 1:
+        fail_hard('--scale-constant must be positive')
+    sbws.core.cleanup.check_days(conf)
+    end_event = sbws.core.scanner.end_event
+    rd = ResultDump(args, conf, end_event)
+    jobs = [
+        PeriodicJob('generate', conf.getint('generate', 'publish_interval'),
+                    generate_job(args, conf, rd)),
+        PeriodicJob('cleanup', conf.getint('cleanup', 'interval'),
+                    cleanup_job(conf)),
+    ]
+    jobs_thread = Thread(target=run_jobs, args=(jobs, end_event))
+    jobs_thread.start()
+    try:
+        sbws.core.scanner.run_speedtest(args, conf, rd=rd)
+    except KeyboardInterrupt as e:
+        raise e
+    finally:
+        end_event.set()
+        jobs_thread.join()
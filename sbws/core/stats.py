@@ -1,30 +1,31 @@
 from sbws.globals import (fail_hard, is_initted)
-from sbws.lib.resultdump import Result
-from sbws.lib.resultdump import ResultError
-from sbws.lib.resultdump import ResultErrorCircuit
-from sbws.lib.resultdump import ResultErrorStream
 from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import _ResultType
+from sbws.lib.resultdump import download_speed
+from sbws.lib.resultdump import summarize_results
+from sbws.util.quantiles import KLLSketch
 from sbws.lib.resultdump import load_recent_results_in_datadir
 from argparse import ArgumentDefaultsHelpFormatter
 import os
 from datetime import datetime
 from datetime import timedelta
 from statistics import mean
+import heapq
 import logging
 
 log = logging.getLogger(__name__)
 
 
-def _print_stats_error_types(data):
+def _print_stats_error_types(summaries):
     counts = {'total': 0}
-    for fp in data:
-        results = data[fp]
-        for result in results:
-            if result.type not in counts:
-                log.debug('Found a %s for the first time', result.type)
-                counts[result.type] = 0
-            counts[result.type] += 1
-            counts['total'] += 1
+    for summary in summaries.values():
+        for result_type, number in summary.num_per_type.items():
+            if result_type not in counts:
+                log.debug('Found a %s for the first time',
+                          _ResultType(result_type))
+                counts[result_type] = 0
+            counts[result_type] += number
+            counts['total'] += number
     for count_type in counts:
         if count_type == 'total':
             continue
@@ -35,18 +36,35 @@ def _print_stats_error_types(data):
             number, counts['total'], 100*number/counts['total'], count_type))
 
 
-def _result_type_per_relay(data, result_type):
+def _result_type_per_relay(summaries, result_type):
+    ''' Return how many results of **result_type** (a _ResultType, or None
+    for all of them) each relay has '''
     out = {}
-    for fp in data:
-        out[fp] = len([r for r in data[fp] if isinstance(r, result_type)])
+    for fp, summary in summaries.items():
+        if result_type is None:
+            out[fp] = summary.num_results
+        else:
+            out[fp] = summary.num_per_type.get(result_type.value, 0)
     return out
 
 
-def _get_box_plot_values(iterable):
+def _get_box_plot_values(iterable, sketch_k=None):
     ''' Reutrn the min, q1, med, q1, and max of the input list or iterable.
     This function is NOT perfect, and I think that's fine for basic statistical
     needs. Instead of median, it will return low or high median. Same for q1
-    and q3. '''
+    and q3.
+
+    With **sketch_k**, use a KLLSketch with that k instead of sorting all the
+    values. The min and max are still exact. '''
+    if sketch_k:
+        sketch = KLLSketch(sketch_k)
+        low = high = None
+        for value in iterable:
+            sketch.add(value)
+            low = value if low is None else min(low, value)
+            high = value if high is None else max(high, value)
+        q1, med, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+        return [low, q1, med, q3, high]
     if not isinstance(iterable, list):
         iterable = list(iterable)
     iterable.sort()
@@ -58,23 +76,24 @@ def _get_box_plot_values(iterable):
             iterable[q3_idx], iterable[length-1]]
 
 
-def _print_results_type_box_plot(data, result_type):
-    per_relay = _result_type_per_relay(data, result_type)
-    bp = _get_box_plot_values(per_relay.values())
-    print('For {}: min={} q1={} med={} q3={} max={}'.format(
-        result_type.__name__, *bp))
+def _print_results_type_box_plot(summaries, name, result_type,
+                                 sketch_k=None):
+    per_relay = _result_type_per_relay(summaries, result_type)
+    bp = _get_box_plot_values(per_relay.values(), sketch_k=sketch_k)
+    print('For {}: min={} q1={} med={} q3={} max={}'.format(name, *bp))
 
 
-def _print_averages(data):
-    mean_success = mean([
-        len([r for r in data[fp] if isinstance(r, ResultSuccess)])
-        for fp in data])
+def _print_averages(summaries, sketch_k=None):
+    mean_success = mean([s.num_success for s in summaries.values()])
     print('Mean {:.2f} successful measurements per '
           'relay'.format(mean_success))
-    _print_results_type_box_plot(data, Result)
-    _print_results_type_box_plot(data, ResultSuccess)
-    _print_results_type_box_plot(data, ResultErrorCircuit)
-    _print_results_type_box_plot(data, ResultErrorStream)
+    for name, result_type in [
+            ('Result', None),
+            ('ResultSuccess', _ResultType.Success),
+            ('ResultErrorCircuit', _ResultType.ErrorCircuit),
+            ('ResultErrorStream', _ResultType.ErrorStream)]:
+        _print_results_type_box_plot(summaries, name, result_type,
+                                     sketch_k=sketch_k)
 
 
 def _results_into_bandwidths(results, limit=5):
@@ -86,15 +105,16 @@ def _results_into_bandwidths(results, limit=5):
     :param int limit: The maximum number of bandwidths to return
     :returns: list of up to `limit` bandwidths, with the largest first
     '''
-    downloads = []
-    for result in results:
-        assert isinstance(result, ResultSuccess)
-        for dl in result.downloads:
-            downloads.append(dl['amount'] / dl['duration'])
-    return sorted(downloads, reverse=True)[:limit]
+    def bandwidths():
+        for result in results:
+            assert isinstance(result, ResultSuccess)
+            for dl in result.downloads:
+                yield download_speed(dl)
+    # Without keeping all of them
+    return heapq.nlargest(limit, bandwidths())
 
 
-def print_stats(args, data):
+def print_stats(args, data, sketch_k=None):
     '''
     Called from main to print various statistics about the organized **data**
     to stdout.
@@ -102,36 +122,37 @@ def print_stats(args, data):
     :param argparse.Namespace args: command line arguments
     :param dict data: keyed by relay fingerprint, and with values of
         :class:`sbws.lib.resultdump.Result` subclasses
+    :param int sketch_k: if given, calculate quartiles with a
+        :class:`sbws.util.quantiles.KLLSketch` with this k
     '''
-    results = []
-    for fp in data:
-        results.extend(data[fp])
-    assert len([r for r in results if not isinstance(r, Result)]) == 0
-    error_results = [r for r in results if isinstance(r, ResultError)]
-    success_results = [r for r in results if isinstance(r, ResultSuccess)]
-    percent_success_results = 100 * len(success_results) / len(results)
+    summaries = summarize_results(data)
+    num_results = sum([s.num_results for s in summaries.values()])
+    num_success = sum([s.num_success for s in summaries.values()])
+    num_errors = num_results - num_success
+    percent_success_results = 100 * num_success / num_results
+    success_results = [r for fp in data for r in data[fp]
+                       if isinstance(r, ResultSuccess)]
     fastest_transfers = _results_into_bandwidths(success_results)
     fastest_transfer = 0 if len(fastest_transfers) < 1 else \
         fastest_transfers[0]
-    first_time = min([r.time for r in results])
-    last_time = max([r.time for r in results])
+    first_time = min([s.oldest_time for s in summaries.values()])
+    last_time = max([s.newest_time for s in summaries.values()])
     first = datetime.utcfromtimestamp(first_time)
     first = first - timedelta(microseconds=first.microsecond)
     last = datetime.utcfromtimestamp(last_time)
     last = last - timedelta(microseconds=last.microsecond)
     duration = last - first
     print(len(data), 'relays have recent results')
-    _print_averages(data)
-    print(len(results), 'total results, and {:.1f}% are successes'.format(
+    _print_averages(summaries, sketch_k=sketch_k)
+    print(num_results, 'total results, and {:.1f}% are successes'.format(
         percent_success_results))
-    print(len(success_results), 'success results and',
-          len(error_results), 'error results')
+    print(num_success, 'success results and', num_errors, 'error results')
     print('The fastest download was {:.2f} KiB/s'.format(
         fastest_transfer/1024))
     print('Results come from', first, 'to', last, 'over a period of',
           duration)
     if args.error_types:
-        _print_stats_error_types(data)
+        _print_stats_error_types(summaries)
 
 
 def gen_parser(sub):
@@ -146,6 +167,10 @@ def gen_parser(sub):
                        description=d)
     p.add_argument('--error-types', action='store_true',
                    help='Also print information about each error type')
+    p.add_argument('--load-processes', default=None, type=int,
+                   help='Parse this many result files at a time in worker '
+                   'processes. Defaults to general.load_processes in the '
+                   'configuration')
 
 
 def main(args, conf):
@@ -161,11 +186,17 @@ def main(args, conf):
     datadir = conf['paths']['datadir']
     if not os.path.isdir(datadir):
         fail_hard('%s does not exist', datadir)
+    if args.load_processes is not None and args.load_processes < 1:
+        fail_hard('--load-processes must be positive')
 
     fresh_days = conf.getint('general', 'data_period')
     results = load_recent_results_in_datadir(
-        fresh_days, datadir, success_only=False)
+        fresh_days, datadir, success_only=False,
+        result_store=conf['general']['result_store'],
+        processes=args.load_processes or
+        conf.getint('general', 'load_processes'))
     if len(results) < 1:
         log.warning('No fresh results')
         return
-    print_stats(args, results)
+    print_stats(args, results,
+                sketch_k=conf.getint('general', 'quantile_sketch_k') or None)
@@ -12,6 +12,11 @@ PKG_DIR = os.path.abspath(os.path.dirname(__file__))
 
 SOCKET_TIMEOUT = 60  # seconds
 
+# How many bytes of a download to read at a time. Downloads are read into a
+# buffer of this size and then discarded, so this is also about how much
+# memory a single measurement needs for its downloads.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes
+
 # This is a dictionary of torrc options we always want to set when launching
 # Tor and that do not depend on any runtime configuration
 TORRC_STARTING_POINT = {
@@ -0,0 +1,404 @@
+''' An asyncio based measurement engine. Instead of giving each measurement
+its own thread like the default engine does, this keeps many measurements in
+flight on one event loop. Circuit builds are awaited through CIRC events,
+streams are attached by their SOCKS source port, and the HTTP requests are
+made with :mod:`sbws.util.asyncio_http`.
+
+This module needs Python 3.5 or newer. It is only imported when the scanner is
+configured with ``engine = asyncio``. '''
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
+from stem import CircStatus, CircuitExtensionFailed, InvalidRequest
+from stem import ProtocolError
+from stem.control import EventType
+from ..core.scanner import (get_random_range_string, _should_keep_result,
+                            _next_expected_amount, pick_helper_exit)
+from .resultdump import ResultSuccess, ResultErrorCircuit, ResultErrorStream
+from .destination import check_content_range
+import sbws.util.stem as stem_utils
+from sbws.util.asyncio_http import (socks_tcp_connect, socks_connect,
+                                    AsyncHTTPConnection, AsyncHTTPError)
+
+log = logging.getLogger(__name__)
+
+# Errors we expect from a single HTTP request made over Tor
+_HTTP_ERRORS = (AsyncHTTPError, asyncio.TimeoutError, OSError, ValueError)
+
+
+class CircuitEventWaiter:
+    ''' Turns CIRC events into asyncio futures so that circuit builds can be
+    awaited instead of blocked on.
+
+    Tor can tell us about a circuit being built before we even know the
+    circuit's ID, so we remember the final status of a limited number of
+    circuits that nobody was waiting on yet. '''
+    MAX_EARLY_STATUSES = 1000
+
+    def __init__(self, loop, controller):
+        self._loop = loop
+        self._controller = controller
+        self._waiters = {}
+        self._early = OrderedDict()
+        self._lock = Lock()
+        stem_utils.add_event_listener(
+            controller, self._listener, EventType.CIRC)
+
+    def close(self):
+        stem_utils.remove_event_listener(self._controller, self._listener)
+
+    def _listener(self, event):
+        ''' Called from stem's event thread '''
+        if event.status not in [CircStatus.BUILT, CircStatus.FAILED,
+                                CircStatus.CLOSED]:
+            return
+        with self._lock:
+            fut = self._waiters.pop(event.id, None)
+            if fut is None:
+                self._early[event.id] = event.status
+                while len(self._early) > self.MAX_EARLY_STATUSES:
+                    self._early.popitem(last=False)
+                return
+        self._loop.call_soon_threadsafe(
+            self._resolve, fut, event.status)
+
+    @staticmethod
+    def _resolve(fut, status):
+        if not fut.done():
+            fut.set_result(status == CircStatus.BUILT)
+
+    def wait(self, circ_id):
+        ''' Return a future that will be True once **circ_id** is built or
+        False if it fails to build. Must be called from the event loop. '''
+        fut = self._loop.create_future()
+        with self._lock:
+            status = self._early.pop(circ_id, None)
+            if status is None:
+                self._waiters[circ_id] = fut
+        if status is not None:
+            self._resolve(fut, status)
+        return fut
+
+    def forget(self, circ_id):
+        with self._lock:
+            self._waiters.pop(circ_id, None)
+
+
+class AsyncMeasurementEngine:
+    ''' Measure the relays returned by the **RelayPrioritizer**, keeping up to
+    ``scanner.asyncio_measurements`` measurements in flight at once, until
+    **end_event** is set. Results are put on the **ResultDump** queue just like
+    the threaded engine does. '''
+    def __init__(self, args, conf, controller, circuit_builder, relay_list,
+                 result_dump, relay_prioritizer, destinations, end_event):
+        self._args = args
+        self._conf = conf
+        self._controller = controller
+        self._cb = circuit_builder
+        self._rl = relay_list
+        self._rd = result_dump
+        self._rp = relay_prioritizer
+        self._destinations = destinations
+        self._end_event = end_event
+        self._max_in_flight = conf.getint('scanner', 'asyncio_measurements')
+        self._circuit_timeout = conf.getint('general', 'circuit_timeout')
+        self._http_timeout = conf.getfloat('general', 'http_timeout')
+        self._our_nick = conf['scanner']['nickname']
+        self._executor = ThreadPoolExecutor(
+            max_workers=conf.getint('scanner', 'measurement_threads'))
+        self._in_flight = set()
+        self._tasks = set()
+        self._loop = None
+        self._circ_waiter = None
+        self._attacher = None
+        self._socks_addr = None
+
+    def run(self):
+        # Blocks on Tor, so done once here instead of on the event loop
+        self._socks_addr = stem_utils.get_socks_info(self._controller)
+        self._loop = asyncio.new_event_loop()
+        self._circ_waiter = CircuitEventWaiter(self._loop, self._controller)
+        self._attacher = stem_utils.stream_attacher(self._controller)
+        try:
+            self._loop.run_until_complete(self._dispatch())
+        finally:
+            self._circ_waiter.close()
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self._loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+
+    def _in_thread(self, func, *a, **kw):
+        ''' Run the blocking **func** in our thread pool and return something
+        to await for its return value '''
+        return self._loop.run_in_executor(
+            self._executor, functools.partial(func, *a, **kw))
+
+    async def _dispatch(self):
+        sem = asyncio.Semaphore(self._max_in_flight)
+        while not self._end_event.is_set():
+            targets = await self._in_thread(
+                lambda: list(self._rp.best_priority()))
+            num_dispatched = 0
+            for target in targets:
+                if self._end_event.is_set():
+                    break
+                if target.fingerprint in self._in_flight:
+                    log.debug('Already measuring %s %s', target.nickname,
+                              target.fingerprint[0:8])
+                    continue
+                await sem.acquire()
+                log.debug('Measuring %s %s', target.nickname,
+                          target.fingerprint[0:8])
+                self._in_flight.add(target.fingerprint)
+                num_dispatched += 1
+                task = self._loop.create_task(self._measure_and_put(target))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                task.add_done_callback(lambda _: sem.release())
+            if num_dispatched == 0:
+                # Everything with the best priority is already being measured,
+                # so give some measurements a chance to finish
+                await asyncio.sleep(1)
+        # Let the measurements that are still going finish
+        for _ in range(0, self._max_in_flight):
+            await sem.acquire()
+
+    async def _measure_and_put(self, relay):
+        try:
+            result = await self.measure_relay(relay)
+        except Exception as e:
+            log.exception('Unhandled exception caught while measuring %s: '
+                          '%s %s', relay.nickname, type(e), e)
+        else:
+            self._rd.queue.put(result)
+        finally:
+            self._in_flight.discard(relay.fingerprint)
+
+    async def _build_circuit(self, path):
+        c = self._controller
+        for _ in range(0, 3):
+            try:
+                circ_id = await self._in_thread(
+                    c.new_circuit, path, await_build=False)
+            except (InvalidRequest, CircuitExtensionFailed,
+                    ProtocolError) as e:
+                log.warning(e)
+                continue
+            try:
+                built = await asyncio.wait_for(
+                    self._circ_waiter.wait(circ_id), self._circuit_timeout)
+            except asyncio.TimeoutError:
+                log.warning('Timed out building circuit %s', circ_id)
+                self._circ_waiter.forget(circ_id)
+                await self._in_thread(self._cb.close_circuit, circ_id)
+                continue
+            if built:
+                return circ_id
+            log.debug('Circuit %s failed to build', circ_id)
+        return None
+
+    async def _connect(self, dest, circ_id):
+        ''' Open a stream to **dest** over **circ_id** and return an
+        AsyncHTTPConnection using it '''
+        url = urlparse(dest.url)
+        sock = await socks_tcp_connect(self._loop, self._socks_addr)
+        port = sock.getsockname()[1]
+        self._attacher.register_source_port(port, circ_id)
+        try:
+            await asyncio.wait_for(socks_connect(
+                self._loop, sock, dest.hostname, dest.port),
+                self._http_timeout)
+            return await AsyncHTTPConnection.open(
+                self._loop, sock, url, self._http_timeout)
+        except BaseException:
+            sock.close()
+            raise
+        finally:
+            self._attacher.unregister_source_port(port)
+
+    async def _check_destination(self, conn, dest):
+        ''' The asyncio version of **connect_to_destination_over_circuit**'s
+        usability checks. Return True and the content length, or False and a
+        string stating what the issue is. '''
+        error_prefix = 'When sending HTTP HEAD to {}, '.format(dest.url)
+        max_dl = self._conf.getint('scanner', 'max_download_size')
+        try:
+            head = await conn.request('HEAD', urlparse(dest.url).path)
+        except _HTTP_ERRORS as e:
+            return False, error_prefix + 'we hit an exception: {}'.format(e)
+        if head.status_code != 200:
+            return False, error_prefix + 'we expected HTTP code 200 not '\
+                '{}'.format(head.status_code)
+        if 'content-length' not in head.headers:
+            return False, error_prefix + 'we except the header '\
+                'Content-Length to exist in the response'
+        content_length = int(head.headers['content-length'])
+        if max_dl > content_length:
+            return False, error_prefix + 'our maximum configured download '\
+                'size is {} but the content is only {}'.format(
+                    max_dl, content_length)
+        return True, content_length
+
+    async def _timed_recv_from_server(self, conn, dest, byte_range,
+                                      content_length=None):
+        headers = {'Range': byte_range, 'Accept-Encoding': 'identity'}
+        start_time = time.time()
+        try:
+            resp = await conn.request('GET', urlparse(dest.url).path, headers)
+        except _HTTP_ERRORS as e:
+            return False, e
+        if content_length is not None:
+            error = check_content_range(
+                resp.status_code, resp.headers, content_length)
+            if error is not None:
+                dest.content_length = None
+                return False, error
+        return True, time.time() - start_time
+
+    async def _measure_rtt_to_server(self, conn, dest, content_length):
+        conf = self._conf
+        rtts = []
+        size = conf.getint('scanner', 'min_download_size')
+        log.debug('Measuring RTT to %s', dest.url)
+        for i in range(0, conf.getint('scanner', 'num_rtts')):
+            random_range = get_random_range_string(content_length, size)
+            # Also checks the content is still what we think it is
+            success, data = await self._timed_recv_from_server(
+                conn, dest, random_range,
+                content_length=content_length if i == 0 else None)
+            if not success:
+                log.warning('While measuring the RTT to %s we hit an '
+                            'exception (does the webserver support Range '
+                            'requests?): %s', dest.url, data)
+                return None
+            rtts.append(data)
+        return rtts
+
+    async def _measure_bandwidth_to_server(self, conn, dest, content_length):
+        conf = self._conf
+        results = []
+        num_downloads = conf.getint('scanner', 'num_downloads')
+        expected_amount = conf.getint('scanner', 'initial_read_request')
+        min_dl = conf.getint('scanner', 'min_download_size')
+        max_dl = conf.getint('scanner', 'max_download_size')
+        download_times = {
+            'toofast': conf.getfloat('scanner', 'download_toofast'),
+            'min': conf.getfloat('scanner', 'download_min'),
+            'target': conf.getfloat('scanner', 'download_target'),
+            'max': conf.getfloat('scanner', 'download_max'),
+        }
+        while len(results) < num_downloads:
+            random_range = get_random_range_string(
+                content_length, expected_amount)
+            success, data = await self._timed_recv_from_server(
+                conn, dest, random_range)
+            if not success:
+                log.warning('While measuring the bandwidth to %s we hit an '
+                            'exception (does the webserver support Range '
+                            'requests?): %s', dest.url, data)
+                return None
+            if _should_keep_result(
+                    expected_amount == max_dl, data, download_times):
+                results.append({
+                    'duration': data, 'amount': expected_amount})
+            expected_amount = _next_expected_amount(
+                expected_amount, data, download_times, min_dl, max_dl)
+        return results
+
+    async def measure_relay(self, relay):
+        ''' The asyncio version of **sbws.core.scanner.measure_relay** '''
+        our_nick = self._our_nick
+        dest = await self._in_thread(self._destinations.next)
+        if not dest:
+            log.warning('Unable to get destination to measure %s %s',
+                        relay.nickname, relay.fingerprint[0:8])
+            return None
+        exit = await self._in_thread(
+            pick_helper_exit, self._conf, self._rl, dest, relay)
+        if exit is None:
+            log.warning('No available exits to help measure %s %s',
+                        relay.nickname, relay.fingerprint[0:8])
+            return None
+        log.debug('We selected exit %s %s (cw=%d) to help measure %s %s '
+                  '(cw=%d)', exit.nickname, exit.fingerprint[0:8],
+                  exit.bandwidth, relay.nickname, relay.fingerprint[0:8],
+                  relay.bandwidth)
+        circ_fps = [relay.fingerprint, exit.fingerprint]
+        circ_id = await self._build_circuit(circ_fps)
+        if not circ_id:
+            log.warning('Could not build circuit involving %s',
+                        relay.nickname)
+            msg = 'Unable to complete circuit'
+            return [
+                ResultErrorCircuit(relay, circ_fps, dest.url, our_nick,
+                                   msg=msg),
+            ]
+        conn = None
+        try:
+            try:
+                conn = await self._connect(dest, circ_id)
+            except _HTTP_ERRORS as e:
+                log.warning('When measuring %s %s we could not connect to '
+                            '%s: %s', relay.nickname, relay.fingerprint[0:8],
+                            dest.url, e)
+                msg = 'The destination seemed to have stopped being usable'
+                return [
+                    ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                                      msg=msg),
+                ]
+            content_length = dest.content_length
+            if content_length is None:
+                is_usable, usable_data = await self._check_destination(
+                    conn, dest)
+                if not is_usable:
+                    log.warning('When measuring %s %s the destination seemed '
+                                'to have stopped being usable: %s',
+                                relay.nickname, relay.fingerprint[0:8],
+                                usable_data)
+                    msg = 'The destination seemed to have stopped being '\
+                        'usable'
+                    return [
+                        ResultErrorStream(relay, circ_fps, dest.url,
+                                          our_nick, msg=msg),
+                    ]
+                content_length = usable_data
+                dest.content_length = content_length
+            rtts = await self._measure_rtt_to_server(
+                conn, dest, content_length)
+            if rtts is None:
+                log.warning('Unable to measure RTT to %s via relay %s %s',
+                            dest.url, relay.nickname, relay.fingerprint[0:8])
+                msg = 'Something bad happened while measuring RTTs'
+                return [
+                    ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                                      msg=msg),
+                ]
+            bw_results = await self._measure_bandwidth_to_server(
+                conn, dest, content_length)
+            if bw_results is None:
+                log.warning('Unable to measure bandwidth to %s via relay '
+                            '%s %s', dest.url, relay.nickname,
+                            relay.fingerprint[0:8])
+                msg = 'Something bad happened while measuring bandwidth'
+                return [
+                    ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                                      msg=msg),
+                ]
+            return [
+                ResultSuccess(rtts, bw_results, relay, circ_fps, dest.url,
+                              our_nick),
+            ]
+        finally:
+            if conn is not None:
+                conn.close()
+            await self._in_thread(self._cb.close_circuit, circ_id)
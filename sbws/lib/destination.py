@@ -1,16 +1,48 @@
 import logging
 import random
+from contextlib import contextmanager
 import time
 from threading import RLock
 import requests
 from urllib.parse import urlparse
-from stem.control import EventType
 import sbws.util.stem as stem_utils
 import sbws.util.requests as requests_utils
 
 log = logging.getLogger(__name__)
 
 
+@contextmanager
+def streams_attached_to_circuit(session, cont, circ_id):
+    ''' While in this context, the streams the Requests **session** opens are
+    attached to **circ_id**, no matter how many other threads are opening
+    streams too '''
+    attacher = stem_utils.stream_attacher(cont)
+    username = stem_utils.circuit_socks_username(circ_id)
+    requests_utils.set_socks_username(session, username)
+    attacher.register_socks_username(username, circ_id)
+    try:
+        yield
+    finally:
+        attacher.unregister_socks_username(username)
+
+
+def check_content_range(status_code, headers, content_length):
+    ''' Check the response to a Range request for part of a content we think
+    is **content_length** bytes long. **headers** must be case insensitive or
+    have lower case keys. Return None if the response looks right, otherwise a
+    string stating what the issue is. '''
+    if status_code != 206:
+        return 'we expected HTTP code 206 not {}'.format(status_code)
+    if 'content-range' not in headers:
+        return 'we expected the header Content-Range to exist in the response'
+    # bytes start-end/total
+    total = headers['content-range'].rpartition('/')[2]
+    if total != str(content_length):
+        return 'we expected the content to be {} bytes long, not {}'.format(
+            content_length, total)
+    return None
+
+
 def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
     '''
     Connect to **dest* over the given **circ_id** using the given Requests
@@ -34,7 +66,8 @@ def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
     that we don't care about.
 
     As of the time of writing, you'll find that sbws/core/scanner.py uses this
-    function in order to obtain that stream over which to perform measurements.
+    function in order to obtain that stream over which to perform measurements
+    when it doesn't know the destination's content length yet.
     You will also find in sbws/lib/destination.py (this file) this function
     being used to determine if a Destination is usable. The first relies on the
     persistent stream side effect, the second ignores it (and in fact throws it
@@ -50,19 +83,16 @@ def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
     '''
     assert isinstance(dest, Destination)
     error_prefix = 'When sending HTTP HEAD to {}, '.format(dest.url)
-    with stem_utils.stream_building_lock:
-        listener = stem_utils.attach_stream_to_circuit_listener(cont, circ_id)
-        stem_utils.add_event_listener(cont, listener, EventType.STREAM)
+    with streams_attached_to_circuit(session, cont, circ_id):
         try:
             # TODO:
             # - What other exceptions can this throw?
             head = requests_utils.head(session, dest.url)
         except (requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout) as e:
-            return False, 'Could not connect to {} over circ {} {}: {}'.format(
-                dest.url, circ_id, stem_utils.circuit_str(cont, circ_id), e)
-        finally:
-            stem_utils.remove_event_listener(cont, listener)
+            return False, 'Could not connect to {} over circ {} {}: '\
+                '{}'.format(dest.url, circ_id,
+                            stem_utils.circuit_str(cont, circ_id), e)
     if head.status_code != requests.codes.ok:
         return False, error_prefix + 'we expected HTTP code '\
             '{} not {}'.format(requests.codes.ok, head.status_code)
@@ -80,6 +110,9 @@ def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
 class Destination:
     def __init__(self, url, default_path, max_dl):
         self._max_dl = max_dl
+        # What the last usability check found, so measurements don't need to
+        # send a HEAD to learn it again. None when unknown.
+        self.content_length = None
         u = urlparse(url)
         # these things should have been verified in verify_config
         assert u.scheme in ['http', 'https']
@@ -92,10 +125,13 @@ class Destination:
 
     def is_usable(self, circ_id, session, cont):
         ''' Use **connect_to_destination_over_circuit** to determine if this
-        destination is usable and return what it returns. Just a small wrapper.
+        destination is usable and return what it returns. Remembers the content
+        length it finds in **content_length**.
         '''
-        return connect_to_destination_over_circuit(
+        is_usable, data = connect_to_destination_over_circuit(
             self, circ_id, session, cont, self._max_dl)
+        self.content_length = data['content_length'] if is_usable else None
+        return is_usable, data
 
     @property
     def url(self):
@@ -143,6 +179,9 @@ class DestinationList:
         self._usability_test_timeout = \
             conf.getfloat('general', 'http_timeout')
         self._usability_lock = RLock()
+        # So that the exits to each destination are known before measuring
+        for dest in dests:
+            relay_list.index_exits_to(dest.hostname, dest.port)
 
     def _should_perform_usability_test(self):
         return self._last_usability_test + self._usability_test_interval <\
@@ -158,11 +197,10 @@ class DestinationList:
         for dest in self._all_dests:
             possible_exits = self._rl.exits_can_exit_to(
                 dest.hostname, dest.port)
-            # Keep the fastest 10% of exits, or 3, whichever is larger
+            # Keep the fastest 10% of exits, or 3, whichever is larger. They
+            # are sorted from slowest to fastest.
             num_keep = int(max(3, len(possible_exits) * 0.1))
-            possible_exits = sorted(
-                possible_exits, key=lambda e: e.bandwidth, reverse=True)
-            exits = possible_exits[0:num_keep]
+            exits = possible_exits[-num_keep:]
             # Try three times to build a circuit to test this destination
             circ_id = None
             for _ in range(0, 3):
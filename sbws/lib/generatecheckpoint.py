@@ -0,0 +1,204 @@
+''' Lets ``sbws generate --incremental`` read only the results written since
+its last run.
+
+A checkpoint in the datadir remembers how many bytes of each result file were
+already read and the fields generate needs of every result read so far, in
+hourly expiry buckets. Each run reads the bytes appended since the last one,
+drops the buckets that are no longer valid, and gives back the same field
+dictionary :func:`sbws.lib.resultdump.load_recent_result_fields_in_datadir`
+would have. '''
+import os
+import time
+import pickle
+import logging
+from .resultdump import _add_result_fields
+from .resultdump import _json_loads
+from .resultdump import _keep_line
+from .resultdump import _read_result_lines
+from .resultdump import _recent_result_days
+from .resultdump import _recent_result_fnames
+from .resultdump import _warn_no_recent_results
+from .resultdump import _ResultType
+from sbws.globals import RESULT_VERSION
+from sbws.util.filelock import FileLock
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_FNAME = 'generate.checkpoint'
+# Increase when what a GenerateCheckpoint keeps changes
+CHECKPOINT_VERSION = 1
+# Results are expired a bucket at a time, except in the bucket with the oldest
+# results that are still valid
+BUCKET_SECONDS = 60*60
+
+
+def checkpoint_fname(datadir):
+    return os.path.join(datadir, CHECKPOINT_FNAME)
+
+
+def _result_file_key(rel_fname):
+    ''' Sorts result files the same way _recent_result_fnames() orders them:
+    by day, then the datadir before its subdirectories, then name '''
+    return (os.path.basename(rel_fname)[:len('YYYY-MM-DD')],
+            rel_fname.count(os.sep), rel_fname)
+
+
+class GenerateCheckpoint:
+    ''' The **fields** of every valid result read so far from the result
+    files in a datadir, and how far each file was read.
+
+    :param int fresh_days: days results are valid for
+    :param tuple fields: the result fields to keep
+    :param bool success_only: whether to only keep successful results
+    '''
+    def __init__(self, fresh_days, fields, success_only=False):
+        self.version = CHECKPOINT_VERSION
+        self.result_version = RESULT_VERSION
+        self.fresh_days = fresh_days
+        self.fields = tuple(fields)
+        self.success_only = success_only
+        # Relative to the datadir: how many bytes of the file were read
+        self.offsets = {}
+        # Bucket number: list of (order, fingerprint, time, field values).
+        # order is (file key, byte offset of the line), which sorts results
+        # in the order a full load would have read them.
+        self.buckets = {}
+
+    def is_usable(self, datadir, fresh_days, fields, success_only=False):
+        ''' Return True if this checkpoint can be updated from the result
+        files in **datadir** to give the same results a full load with the
+        given arguments would '''
+        if self.version != CHECKPOINT_VERSION or \
+                self.result_version != RESULT_VERSION or \
+                self.fresh_days != fresh_days or \
+                self.fields != tuple(fields) or \
+                self.success_only != success_only:
+            return False
+        recent_days = _recent_result_days(fresh_days)
+        for rel_fname, offset in self.offsets.items():
+            if _result_file_key(rel_fname)[0] not in recent_days:
+                continue
+            fname = os.path.join(datadir, rel_fname)
+            # Results we have were removed from the file
+            if not os.path.isfile(fname) or os.path.getsize(fname) < offset:
+                log.info('%s changed since the last checkpoint', fname)
+                return False
+        return True
+
+    def read_new_results(self, datadir, oldest_allowed):
+        ''' Read the results written to the recent result files in
+        **datadir** since the last time and keep the ones made at or after
+        **oldest_allowed**. Return how many were kept. '''
+        success = _ResultType.Success.value
+        num_kept = 0
+        for fname in _recent_result_fnames(self.fresh_days, datadir):
+            rel_fname = os.path.relpath(fname, datadir)
+            file_key = _result_file_key(rel_fname)
+            offset = self.offsets.get(rel_fname, 0)
+            for line in _read_result_lines(fname, offset=offset):
+                line_offset = offset
+                offset += len(line.encode('utf-8'))
+                if not _keep_line(line, self.success_only, None):
+                    continue
+                rd = _json_loads(line)
+                if rd.get('version') != RESULT_VERSION:
+                    continue
+                if self.success_only and rd['type'] != success:
+                    continue
+                if rd['time'] < oldest_allowed:
+                    continue
+                bucket = int(rd['time'] // BUCKET_SECONDS)
+                if bucket not in self.buckets:
+                    self.buckets[bucket] = []
+                self.buckets[bucket].append((
+                    (file_key, line_offset), rd['fingerprint'], rd['time'],
+                    tuple(rd.get(field) for field in self.fields)))
+                num_kept += 1
+            self.offsets[rel_fname] = offset
+        return num_kept
+
+    def expire(self, oldest_allowed):
+        ''' Forget the results made before **oldest_allowed**, and the
+        offsets of result files that can't have valid results anymore '''
+        oldest_bucket = int(oldest_allowed // BUCKET_SECONDS)
+        for bucket in list(self.buckets.keys()):
+            if bucket < oldest_bucket:
+                del self.buckets[bucket]
+        if oldest_bucket in self.buckets:
+            self.buckets[oldest_bucket] = [
+                entry for entry in self.buckets[oldest_bucket]
+                if entry[2] >= oldest_allowed]
+        recent_days = _recent_result_days(self.fresh_days)
+        for rel_fname in list(self.offsets.keys()):
+            if _result_file_key(rel_fname)[0] not in recent_days:
+                del self.offsets[rel_fname]
+
+    def result_fields(self, sketch_k=None):
+        ''' Return the results we have as a field dictionary, like
+        :func:`sbws.lib.resultdump.load_result_file_fields` does '''
+        entries = [entry for bucket in self.buckets.values()
+                   for entry in bucket]
+        entries.sort(key=lambda entry: entry[0])
+        data = {}
+        for _, fp, _, values in entries:
+            rd = dict(zip(self.fields, values))
+            rd['fingerprint'] = fp
+            _add_result_fields(data, rd, self.fields, sketch_k=sketch_k)
+        return data
+
+
+def load_checkpoint(fname):
+    ''' Return the GenerateCheckpoint saved in **fname**, or None if there
+    isn't one that can be read '''
+    try:
+        with open(fname, 'rb') as fd:
+            checkpoint = pickle.load(fd)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning('Ignoring the generate checkpoint %s because it can\'t '
+                    'be read: %s', fname, e)
+        return None
+    if not isinstance(checkpoint, GenerateCheckpoint):
+        return None
+    return checkpoint
+
+
+def write_checkpoint(fname, checkpoint):
+    ''' Save **checkpoint** to **fname**, replacing it atomically '''
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fd:
+        pickle.dump(checkpoint, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def load_recent_result_fields_incrementally(fresh_days, datadir, fields,
+                                            success_only=False,
+                                            sketch_k=None):
+    ''' Like :func:`sbws.lib.resultdump.load_recent_result_fields_in_datadir`
+    with the file result store, but only reads the results written since the
+    last call, using the checkpoint in **datadir**. The checkpoint is created
+    or rebuilt when it is missing or can't be used. '''
+    assert isinstance(fresh_days, int)
+    assert os.path.isdir(datadir)
+    fname = checkpoint_fname(datadir)
+    oldest_allowed = time.time() - fresh_days * 24*60*60
+    with FileLock(fname):
+        checkpoint = load_checkpoint(fname)
+        if checkpoint is None or not checkpoint.is_usable(
+                datadir, fresh_days, fields, success_only=success_only):
+            log.info('Reading all recent results to make a new generate '
+                     'checkpoint')
+            checkpoint = GenerateCheckpoint(
+                fresh_days, fields, success_only=success_only)
+        checkpoint.expire(oldest_allowed)
+        num_new = checkpoint.read_new_results(datadir, oldest_allowed)
+        log.debug('Read %d new results since the last generate checkpoint',
+                  num_new)
+        write_checkpoint(fname, checkpoint)
+    data = checkpoint.result_fields(sketch_k=sketch_k)
+    if len(data) == 0:
+        _warn_no_recent_results(fresh_days, datadir)
+    return data
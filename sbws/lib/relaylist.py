@@ -1,8 +1,19 @@
 import sbws.util.stem as stem_utils
 from stem import Flag
-from stem import DescriptorUnavailable
+from stem import ControllerError
+from stem.control import EventType
+from stem.descriptor import DocumentHandler
+from stem.descriptor import parse_file
+from threading import Lock
+from threading import Thread
 from stem.util.connection import is_valid_ipv4_address
 from stem.util.connection import is_valid_ipv6_address
+from bisect import bisect_left
+from bisect import bisect_right
+import base64
+import hashlib
+import io
+import os
 import random
 import time
 import logging
@@ -11,23 +22,124 @@ from sbws.globals import resolve
 log = logging.getLogger(__name__)
 
 
+def _microdescriptor_digest(desc):
+    ''' The digest of the microdescriptor **desc**, as in a microdescriptor
+    consensus. Microdescriptor.digest() does this since stem 1.8. '''
+    digest = hashlib.sha256(str(desc).encode('utf-8')).digest()
+    return base64.b64encode(digest).decode('ascii').rstrip('=')
+
+
+def _exit_index_entry(exits):
+    ''' The exits sorted by bandwidth, and their bandwidths to bisect '''
+    return exits, [exit.bandwidth for exit in exits]
+
+
+# The bit of each flag in a relay's flag bitmask
+_FLAG_BITS = {flag: 1 << i for i, flag in enumerate(Flag)}
+
+
+class RelayTable:
+    ''' The relays in one consensus, indexed so that finding them by flag or
+    fingerprint doesn't look at every relay.
+
+    Every relay has an index into **relays**, found by fingerprint, and a flag
+    bitmask. The tuples of relays with each flag are made once, and the ones
+    of relays without a flag the first time they are asked for. They are
+    shared by everyone asking.
+    '''
+    def __init__(self, relays):
+        self.relays = tuple(relays)
+        self._index = {}
+        self._masks = []
+        with_flag = {flag: [] for flag in _FLAG_BITS}
+        for i, relay in enumerate(self.relays):
+            self._index[relay.fingerprint] = i
+            mask = 0
+            for flag in relay.flags:
+                if flag in _FLAG_BITS:
+                    mask |= _FLAG_BITS[flag]
+                    with_flag[flag].append(relay)
+            self._masks.append(mask)
+        self._with_flag = {flag: tuple(relays)
+                           for flag, relays in with_flag.items()}
+        # Made when first asked for
+        self._without_flag = {}
+
+    def __len__(self):
+        return len(self.relays)
+
+    def relay(self, fingerprint):
+        ''' The relay with **fingerprint**, or None '''
+        i = self._index.get(fingerprint)
+        return None if i is None else self.relays[i]
+
+    def with_flag(self, flag):
+        return self._with_flag.get(flag, ())
+
+    def without_flag(self, flag):
+        relays = self._without_flag.get(flag)
+        if relays is None:
+            bit = _FLAG_BITS.get(flag, 0)
+            relays = tuple(relay for relay, mask in zip(
+                self.relays, self._masks) if not mask & bit)
+            self._without_flag[flag] = relays
+        return relays
+
+
+class RelaySnapshot:
+    ''' Everything RelayList keeps about the relays in one consensus: their
+    RelayTable, the exit policies of the exits without one (see
+    RelayList._load_exit_policies()), and the exits that can exit to each
+    (host, port) asked about.
+
+    A refresh makes a new one and replaces the old one with one assignment.
+    Anyone taking one reference to a snapshot sees relays, policies and exits
+    of the same consensus.
+    '''
+    def __init__(self, table, exit_policies, exit_index):
+        self.table = table
+        self.exit_policies = exit_policies
+        # (host, port): the exits that can exit there sorted by bandwidth, and
+        # their bandwidths
+        self.exit_index = exit_index
+
+
 class RelayList:
     ''' Keeps a list of all relays in the current Tor network and updates it
     transparently in the background. Provides useful interfaces for getting
     only relays of a certain type.
+
+    The relays are refreshed in a background thread when Tor tells us about a
+    new consensus or new network statuses, and at least every
+    REFRESH_INTERVAL seconds. Until a refresh is done, the old relays keep
+    being used, so asking for them never waits for Tor.
     '''
     REFRESH_INTERVAL = 300  # seconds
 
     def __init__(self, args, conf, controller):
         self._controller = controller
         self.rng = random.SystemRandom()
+        self._snapshot = RelaySnapshot(RelayTable(()), {}, {})
+        # Every (host, port) asked about so far. Each refresh indexes the
+        # exits that can exit to all of them.
+        self._exit_destinations = set()
+        self._exit_destinations_lock = Lock()
+        # Only one refresh runs at a time. Asking for one while another runs
+        # makes it run again when it is done.
+        self._refresh_state_lock = Lock()
+        self._refreshing = False
+        self._refresh_again = False
         self._refresh()
+        stem_utils.add_event_listener(
+            controller, self._new_network_status_listener,
+            EventType.NEWCONSENSUS)
+        stem_utils.add_event_listener(
+            controller, self._new_network_status_listener, EventType.NS)
 
     @property
     def relays(self):
-        if time.time() >= self._last_refresh + self.REFRESH_INTERVAL:
-            self._refresh()
-        return self._relays
+        self._refresh_if_needed()
+        return self._snapshot.table.relays
 
     @property
     def fast(self):
@@ -54,6 +166,11 @@ class RelayList:
     def authorities(self):
         return self._relays_with_flag(Flag.AUTHORITY)
 
+    @property
+    def non_authorities(self):
+        ''' Returns relays without the Authority flag '''
+        return self._relays_without_flag(Flag.AUTHORITY)
+
     @property
     def unmeasured(self):
         ''' SEEMS BROKEN in stem 1.6.0 as it always returns no relays '''
@@ -70,18 +187,78 @@ class RelayList:
 
     def exits_can_exit_to(self, host, port):
         '''
-        Return exits that can MOST LIKELY exit to the given host:port. **host**
-        can be a hostname, but be warned that we will resolve it locally and
-        use the first (arbitrary/unknown order) result when checking exit
-        policies, which is different than what other parts of the code may do
-        (leaving it up to the exit to resolve the name).
+        Return exits that can MOST LIKELY exit to the given host:port, from
+        slowest to fastest. **host** can be a hostname, but be warned that we
+        will resolve it locally and use the first (arbitrary/unknown order)
+        result when checking exit policies, which is different than what other
+        parts of the code may do (leaving it up to the exit to resolve the
+        name).
 
         An exit can only MOST LIKELY not just because of the above DNS
         disconnect, but also because fundamentally our Tor client is most
         likely using microdescriptors which do not have full information about
         exit policies.
+
+        The answer for each host:port is worked out once per consensus, the
+        first time it is asked for and then every time the relays are
+        refreshed, so this is usually just a dictionary lookup without any
+        DNS or calls to Tor. Returns a tuple that must not be changed.
         '''
-        c = self._controller
+        self._refresh_if_needed()
+        return self._exits_to(host, port)[0]
+
+    def random_exit_to(self, host, port, min_bw, max_bw, exclude_fp=None):
+        ''' Return a random exit that can MOST LIKELY exit to host:port (see
+        exits_can_exit_to()) with a bandwidth between **min_bw** and
+        **max_bw** inclusive, or None if there isn't one. The exit with the
+        fingerprint **exclude_fp** is never returned. '''
+        self._refresh_if_needed()
+        exits, bandwidths = self._exits_to(host, port)
+        start = bisect_left(bandwidths, min_bw)
+        end = bisect_right(bandwidths, max_bw)
+        if start >= end:
+            return None
+        i = self.rng.randrange(start, end)
+        if exits[i].fingerprint != exclude_fp:
+            return exits[i]
+        if end - start == 1:
+            return None
+        # Pick one of the others. There's only one exit with a fingerprint.
+        j = self.rng.randrange(start, end - 1)
+        return exits[j if j < i else j + 1]
+
+    def _exits_to(self, host, port):
+        snapshot = self._snapshot
+        entry = snapshot.exit_index.get((host, port))
+        if entry is None:
+            entry = self._index_exits_to(snapshot, host, port)
+        return entry
+
+    def index_exits_to(self, host, port):
+        ''' Work out which exits can exit to host:port now and every time the
+        relays are refreshed, so that exits_can_exit_to() doesn't have to.
+        Returns the exits and their bandwidths. '''
+        self._refresh_if_needed()
+        return self._index_exits_to(self._snapshot, host, port)
+
+    def _index_exits_to(self, snapshot, host, port):
+        entry = _exit_index_entry(self._find_exits_that_can_exit_to(
+            snapshot.table.with_flag(Flag.EXIT), snapshot.exit_policies,
+            host, port))
+        with self._exit_destinations_lock:
+            # A refresh looks for new destinations with the lock held just
+            # before replacing the snapshot. If it already replaced it, the
+            # entry goes in the old one and the next lookup indexes it again.
+            self._exit_destinations.add((host, port))
+        snapshot.exit_index[(host, port)] = entry
+        return entry
+
+    def _find_exits_that_can_exit_to(self, all_exits, exit_policies, host,
+                                     port):
+        ''' Return a tuple of the **all_exits** that can exit to host:port,
+        sorted by bandwidth. **exit_policies** has the exit policies of the
+        exits without one, see _load_exit_policies(). See
+        exits_can_exit_to(). '''
         if not is_valid_ipv4_address(host) and not is_valid_ipv6_address(host):
             # It certainly isn't perfect trying to guess if an exit can connect
             # to an ipv4/6 address based on the DNS result we got locally. But
@@ -92,19 +269,17 @@ class RelayList:
             host = resolve(host)[0]
         assert is_valid_ipv4_address(host) or is_valid_ipv6_address(host)
         exits = []
-        for exit in self.exits:
+        for exit in all_exits:
             # If we have the exit policy already, easy
             if exit.exit_policy:
                 policy = exit.exit_policy
             else:
-                # Otherwise ask Tor for the microdescriptor and assume the exit
-                # won't work if the desc isn't available
-                try:
-                    fp = exit.fingerprint
-                    policy = c.get_microdescriptor(fp).exit_policy
-                except DescriptorUnavailable as e:
-                    log.debug(e)
+                # Otherwise use the one in its microdescriptor and assume the
+                # exit won't work if the desc isn't available
+                if exit.fingerprint not in exit_policies:
+                    log.debug('No microdescriptor for %s', exit.fingerprint)
                     continue
+                policy = exit_policies[exit.fingerprint][1]
             # There's a weird KeyError we sometimes hit when checking
             # policy.can_exit_to()... so catch that and log about it. Maybe
             # someday it can be fixed?
@@ -114,25 +289,181 @@ class RelayList:
             except KeyError as e:
                 log.exception('Got that KeyError in stem again...: %s', e)
                 continue
-        return exits
+        exits.sort(key=lambda e: e.bandwidth)
+        return tuple(exits)
 
     def random_relay(self):
         relays = self.relays
         return self.rng.choice(relays)
 
+    def relay(self, fingerprint):
+        ''' Returns the relay with **fingerprint**, or None if it isn't in
+        the consensus '''
+        self._refresh_if_needed()
+        return self._snapshot.table.relay(fingerprint)
+
     def _relays_with_flag(self, flag):
-        relays = self.relays
-        return [r for r in relays if flag in r.flags]
+        self._refresh_if_needed()
+        return self._snapshot.table.with_flag(flag)
 
     def _relays_without_flag(self, flag):
-        relays = self.relays
-        return [r for r in relays if flag not in r.flags]
+        self._refresh_if_needed()
+        return self._snapshot.table.without_flag(flag)
 
     def _init_relays(self):
         c = self._controller
         assert stem_utils.is_controller_okay(c)
         return [ns for ns in c.get_network_statuses()]
 
+    def _load_exit_policies(self, exits, old_policies):
+        ''' Return the exit policies of the **exits** that don't have one,
+        by fingerprint, with the digest of the microdescriptor each came from.
+
+        Tor's network statuses don't say which microdescriptor an exit has, so
+        the digests are read from Tor's microdescriptor consensus every time.
+        Policies in **old_policies**, from the last refresh, are kept for the
+        digests that didn't change. The others are read from all the
+        microdescriptors Tor has at once. Only the exits still without a
+        policy after that, like all of them when we can't get the digests, are
+        asked for one at a time. '''
+        old_by_digest = {digest: policy
+                         for digest, policy in old_policies.values()}
+        digests = self._microdescriptor_digests()
+        policies = {}
+        # Digest: the exit with that microdescriptor
+        missing = {}
+        leftovers = []
+        for exit in exits:
+            if exit.exit_policy:
+                continue
+            digest = digests.get(exit.fingerprint)
+            if digest is None:
+                leftovers.append(exit)
+            elif digest in old_by_digest:
+                policies[exit.fingerprint] = (digest, old_by_digest[digest])
+            else:
+                missing[digest] = exit
+        num_kept = len(policies)
+        num_missing = len(missing) + len(leftovers)
+        c = self._controller
+        if missing:
+            try:
+                # Before tor 0.3.5.1, stem reads Tor's cached-microdescs
+                # instead
+                for desc in c.get_microdescriptors():
+                    digest = _microdescriptor_digest(desc)
+                    exit = missing.pop(digest, None)
+                    if exit is not None:
+                        policies[exit.fingerprint] = (
+                            digest, desc.exit_policy)
+            except (ControllerError, OSError) as e:
+                log.warning('Unable to get the microdescriptors from Tor: %s',
+                            e)
+            leftovers.extend(missing.values())
+        for exit in leftovers:
+            # Assume the exit won't work if the desc isn't available
+            try:
+                desc = c.get_microdescriptor(exit.fingerprint)
+            except ControllerError as e:
+                log.debug(e)
+                continue
+            policies[exit.fingerprint] = (
+                _microdescriptor_digest(desc), desc.exit_policy)
+        log.debug('Loaded %d of %d new exit policies, %d of them asked for '
+                  'one at a time', len(policies) - num_kept, num_missing,
+                  len(leftovers))
+        return policies
+
+    def _microdescriptor_digests(self):
+        ''' Return the digest of each relay's microdescriptor by fingerprint,
+        from Tor's microdescriptor consensus. It is asked for with GETINFO
+        since tor 0.4.3.1, and read from the cached-microdesc-consensus file
+        in Tor's DataDirectory before that. Returns an empty dictionary if we
+        can't get it. '''
+        c = self._controller
+        try:
+            consensus = c.get_info(
+                'dir/status-vote/current/consensus-microdesc').encode('utf-8')
+        except ControllerError as e:
+            log.debug('Unable to get the microdescriptor consensus: %s', e)
+            consensus = self._read_cached_microdesc_consensus()
+            if consensus is None:
+                return {}
+        return {entry.fingerprint: entry.microdescriptor_digest
+                for entry in parse_file(
+                    io.BytesIO(consensus),
+                    'network-status-microdesc-consensus-3 1.0',
+                    document_handler=DocumentHandler.ENTRIES)}
+
+    def _read_cached_microdesc_consensus(self):
+        c = self._controller
+        try:
+            datadir = c.get_conf('DataDirectory')
+            if not datadir:
+                return None
+            fname = os.path.join(datadir, 'cached-microdesc-consensus')
+            with open(fname, 'rb') as fd:
+                return fd.read()
+        except (ControllerError, OSError) as e:
+            log.warning('Unable to read Tor\'s microdescriptor consensus, so '
+                        'the exit policies of exits without one will be asked '
+                        'for one at a time: %s', e)
+            return None
+
+    def _new_network_status_listener(self, event):
+        log.debug('Got a %s event, refreshing the relays', event.type)
+        self._refresh_in_background()
+
+    def _refresh_if_needed(self):
+        ''' Refresh the relays in the background if they are older than
+        REFRESH_INTERVAL. Never waits for the refresh. '''
+        if time.time() >= self._last_refresh + self.REFRESH_INTERVAL:
+            self._refresh_in_background(again=False)
+
+    def _refresh_in_background(self, again=True):
+        ''' Refresh the relays in a new thread. If a refresh is already
+        running, refresh again after it if **again**, because what it got from
+        Tor may already be old. '''
+        with self._refresh_state_lock:
+            if self._refreshing:
+                self._refresh_again = self._refresh_again or again
+                return
+            self._refreshing = True
+        Thread(target=self._refresh_thread, daemon=True).start()
+
+    def _refresh_thread(self):
+        while True:
+            try:
+                self._refresh()
+            except Exception:
+                log.exception('Unable to refresh the relays. Using the old '
+                              'ones.')
+                # Don't try again until the next event or interval
+                self._last_refresh = time.time()
+            with self._refresh_state_lock:
+                if not self._refresh_again:
+                    self._refreshing = False
+                    return
+                self._refresh_again = False
+
     def _refresh(self):
-        self._relays = self._init_relays()
+        ''' Get the relays from Tor and work out everything we keep about
+        them, then replace the old ones '''
+        table = RelayTable(self._init_relays())
+        exits = table.with_flag(Flag.EXIT)
+        exit_policies = self._load_exit_policies(
+            exits, self._snapshot.exit_policies)
+        exit_index = {}
+        while True:
+            with self._exit_destinations_lock:
+                destinations = self._exit_destinations - exit_index.keys()
+                if not destinations:
+                    # Nothing new was asked about while we were indexing
+                    self._snapshot = RelaySnapshot(
+                        table, exit_policies, exit_index)
+                    break
+            for host, port in destinations:
+                exit_index[(host, port)] = _exit_index_entry(
+                    self._find_exits_that_can_exit_to(
+                        exits, exit_policies, host, port))
         self._last_refresh = time.time()
@@ -1,14 +1,19 @@
 from decimal import Decimal
 from ..lib.resultdump import ResultDump
-from ..lib.resultdump import Result
-from ..lib.resultdump import ResultError
 from ..lib.relaylist import RelayList
-import copy
+from collections import namedtuple
+import heapq
 import time
 import logging
 
 log = logging.getLogger(__name__)
 
+# What the heap in best_priority() holds for each relay. **index** is unique,
+# so entries compare (as tuples) by priority and then consensus order, and
+# never by fingerprint or relay.
+PriorityEntry = namedtuple(
+    'PriorityEntry', ['priority', 'index', 'fingerprint', 'relay'])
+
 
 class RelayPrioritizer:
     def __init__(self, args, conf, relay_list, result_dump):
@@ -44,51 +49,41 @@ class RelayPrioritizer:
         with equal weight as successful results, then it would take a while to
         get around to giving the relay another chance at a getting a successful
         measurement.
+
+        The sum of the freshness of a relay's results is the sum of weight *
+        result time minus <oldest_allowed> times the sum of the weights, where
+        the weight is 1 for successes and less for errors. The ResultDump keeps
+        both sums in every relay's RelaySummary as results come and go, so
+        calculating all priorities is O(relays) and picking the best ones is a
+        few heap pops.
         '''
         fn_tstart = Decimal(time.time())
-        relays = copy.deepcopy(self.relay_list.relays)
-        if not self.measure_authorities:
-            relays = [r for r in relays
-                      if r not in self.relay_list.authorities]
+        if self.measure_authorities:
+            relays = self.relay_list.relays
+        else:
+            relays = self.relay_list.non_authorities
         rd = self.result_dump
-        for relay in relays:
-            results = rd.results_for_relay(relay)
-            priority = 0
-            # The time before which we do not consider results valid anymore
-            oldest_allowed = time.time() - self.fresh_seconds
-            for result in results:
-                assert isinstance(result, Result)
-                # Ignore results that are too far in the past
-                if result.time < oldest_allowed:
-                    continue
-                # Calculate freshness as the remaining time until this result
-                # is no longer valid
-                freshness = result.time - oldest_allowed
-                if isinstance(result, ResultError):
-                    # Reduce the freshness for results containing errors so
-                    # that they are not de-prioritized as much. This way, we
-                    # will come back to them sooner to try again.
-                    assert result.freshness_reduction_factor >= 0.0
-                    assert result.freshness_reduction_factor <= 1.0
-                    log.debug('Cutting freshness for a %s result by %d%% for '
-                              '%s', result.type.value,
-                              result.freshness_reduction_factor * 100,
-                              relay.nickname)
-                    freshness *= max(1.0-result.freshness_reduction_factor, 0)
-                priority += freshness
-            relay.priority = priority
-        # Sort the relays by their priority, with the smallest (best) priority
-        # relays at the front
-        relays = sorted(relays, key=lambda r: r.priority)
-        cutoff = max(int(len(relays) * self.fraction_to_return),
+        # The time before which we do not consider results valid anymore
+        oldest_allowed = time.time() - self.fresh_seconds
+        # The ResultDump keeps a summary of each relay's results up to date as
+        # results arrive and expire, so we don't have to look at any results
+        # here. Results older than oldest_allowed are expired first.
+        freshness = {s.fingerprint: s.freshness(oldest_allowed)
+                     for s in rd.iter_summaries(oldest_allowed)}
+        heap = [PriorityEntry(
+                    freshness.get(relay.fingerprint, 0), i,
+                    relay.fingerprint, relay)
+                for i, relay in enumerate(relays)]
+        heapq.heapify(heap)
+        cutoff = max(int(len(heap) * self.fraction_to_return),
                      self.min_to_return)
         fn_tstop = Decimal(time.time())
         fn_tdelta = (fn_tstop - fn_tstart) * 1000
         log.info('Spent %f msecs calculating relay best priority', fn_tdelta)
-        # Finally, slowly return the relays to the caller (after removing the
-        # priority member we polluted the variable with ...)
-        for relay in relays[0:cutoff]:
+        # Finally, slowly return the relays with the smallest (best) priority
+        # to the caller
+        for _ in range(0, min(cutoff, len(heap))):
+            entry = heapq.heappop(heap)
             log.debug('Returning next relay %s with priority %f',
-                      relay.nickname, relay.priority)
-            del(relay.priority)
-            yield relay
+                      entry.relay.nickname, entry.priority)
+            yield entry.relay
@@ -1,8 +1,16 @@
+import gc
+import io
 import os
 import json
 import time
+import heapq
+import pickle
 import logging
 from glob import glob
+from collections import deque
+from sys import intern
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from threading import Thread
 from threading import Event
 from threading import RLock
@@ -14,9 +22,21 @@ from enum import Enum
 from stem.descriptor.router_status_entry import RouterStatusEntryV3
 from sbws.globals import RESULT_VERSION
 from sbws.util.filelock import DirectoryLock
+from sbws.util.quantiles import KLLSketch
 
 log = logging.getLogger(__name__)
 
+RESULT_SNAPSHOT_FNAME = 'results.snapshot'
+# Increase when what write_result_snapshot() saves changes
+RESULT_SNAPSHOT_VERSION = 1
+
+try:
+    # orjson decodes result lines several times faster than json and gives
+    # back exactly the same values
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 
 def merge_result_dicts(d1, d2):
     '''
@@ -31,29 +51,77 @@ def merge_result_dicts(d1, d2):
     return d1
 
 
-def load_result_file(fname, success_only=False):
+def merge_result_field_dicts(d1, d2):
+    '''
+    Like merge_result_dicts(), but for the field dictionaries returned by
+    load_result_file_fields().
+    '''
+    for key in d2:
+        if key not in d1:
+            d1[key] = d2[key]
+            continue
+        for field, values in d2[key].items():
+            if isinstance(values, KLLSketch):
+                d1[key][field].merge(values)
+            else:
+                d1[key][field].extend(values)
+    return d1
+
+
+def _read_result_lines(fname, offset=0):
+    ''' Yield the lines of the result file **fname** from byte **offset**
+    on. The bytes are copied while holding the directory lock, but the lines
+    are split and decoded one at a time after it is released, so parallel
+    loaders and the scanner don't wait on each other while lines are parsed,
+    and there is never more than one copy of the file in memory '''
+    with DirectoryLock(os.path.dirname(fname)):
+        with open(fname, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            fd.seek(offset)
+            data = fd.read(max(size - offset, 0))
+    for line in io.BytesIO(data):
+        yield line.decode('utf-8')
+
+
+def _keep_line(line, success_only, fingerprint):
+    ''' Cheap checks on an undecoded result line. Returns False if the line
+    can't be a result we want, so it doesn't need decoding. Passing these
+    checks doesn't mean the result is wanted: the decoded result must be
+    checked too. '''
+    if success_only and '"success"' not in line:
+        return False
+    if fingerprint is not None and fingerprint not in line:
+        return False
+    return True
+
+
+def load_result_file(fname, success_only=False, fingerprint=None, offset=0):
     ''' Reads in all lines from the given file, and parses them into Result
-    structures (or subclasses of Result). Optionally only keeps ResultSuccess.
+    structures (or subclasses of Result). Optionally only keeps ResultSuccess
+    and optionally only keeps results for the relay with **fingerprint**.
+    Optionally starts reading at byte **offset** instead of the beginning.
     Returns all kept Results as a result dictionary. This function does not
     care about the age of the results '''
     assert os.path.isfile(fname)
     d = {}
     num_total = 0
     num_ignored = 0
-    with DirectoryLock(os.path.dirname(fname)):
-        with open(fname, 'rt') as fd:
-            for line in fd:
-                num_total += 1
-                r = Result.from_dict(json.loads(line.strip()))
-                if r is None:
-                    num_ignored += 1
-                    continue
-                if success_only and isinstance(r, ResultError):
-                    continue
-                fp = r.fingerprint
-                if fp not in d:
-                    d[fp] = []
-                d[fp].append(r)
+    for line in _read_result_lines(fname, offset=offset):
+        num_total += 1
+        if not _keep_line(line, success_only, fingerprint):
+            continue
+        r = Result.from_dict(_json_loads(line))
+        if r is None:
+            num_ignored += 1
+            continue
+        if success_only and isinstance(r, ResultError):
+            continue
+        fp = r.fingerprint
+        if fingerprint is not None and fp != fingerprint:
+            continue
+        if fp not in d:
+            d[fp] = []
+        d[fp].append(r)
     num_kept = sum([len(d[fp]) for fp in d])
     log.debug('Keeping %d/%d read lines from %s', num_kept, num_total, fname)
     if num_ignored > 0:
@@ -62,6 +130,93 @@ def load_result_file(fname, success_only=False):
     return d
 
 
+def download_speed(download):
+    ''' The speed of one of a ResultSuccess' downloads, in bytes/second '''
+    return download['amount'] / download['duration']
+
+
+# The fields whose values can be kept in a quantile sketch instead of a list,
+# and how to turn each of their values into a number
+_SKETCH_FIELDS = {
+    'rtts': None,
+    'downloads': download_speed,
+}
+
+
+def _new_field_values(field, sketch_k):
+    if sketch_k and field in _SKETCH_FIELDS:
+        return KLLSketch(sketch_k)
+    return []
+
+
+def _add_result_fields(data, rd, fields, sketch_k=None):
+    ''' Add the **fields** of the decoded result dict **rd** to the relay's
+    entry in the field dictionary **data**. List values are flattened into the
+    relay's list for that field. Fields the result doesn't have are skipped.
+
+    With **sketch_k**, the rtts and the download speeds are added to a
+    KLLSketch with that k instead of a list, so they take bounded memory. '''
+    fp = rd['fingerprint']
+    if fp not in data:
+        data[fp] = {field: _new_field_values(field, sketch_k)
+                    for field in fields}
+    relay_fields = data[fp]
+    for field in fields:
+        value = rd.get(field)
+        if value is None:
+            continue
+        values = relay_fields[field]
+        if isinstance(values, KLLSketch):
+            to_number = _SKETCH_FIELDS[field]
+            values.update(value if to_number is None else
+                          [to_number(v) for v in value])
+        elif isinstance(value, list):
+            values.extend(value)
+        else:
+            values.append(value)
+
+
+def load_result_file_fields(fname, fields, oldest_allowed=0,
+                            success_only=False, fingerprint=None, data=None,
+                            sketch_k=None):
+    ''' Like load_result_file(), but without building Result objects. Only
+    keeps the given **fields** of each result made at or after
+    **oldest_allowed**, and returns a field dictionary: keys of relay
+    fingerprints and values of dicts mapping each field name to the list of
+    that field's values for the relay, in file order. Fields with list values,
+    like rtts and downloads, are flattened into one list.
+
+    If **data** is given, add the fields to that field dictionary and return
+    it. See _add_result_fields() for **sketch_k**. '''
+    assert os.path.isfile(fname)
+    data = {} if data is None else data
+    success = _ResultType.Success.value
+    num_total = 0
+    num_kept = 0
+    num_ignored = 0
+    for line in _read_result_lines(fname):
+        num_total += 1
+        if not _keep_line(line, success_only, fingerprint):
+            continue
+        rd = _json_loads(line)
+        if rd.get('version') != RESULT_VERSION:
+            num_ignored += 1
+            continue
+        if success_only and rd['type'] != success:
+            continue
+        if fingerprint is not None and rd['fingerprint'] != fingerprint:
+            continue
+        if rd['time'] < oldest_allowed:
+            continue
+        _add_result_fields(data, rd, fields, sketch_k=sketch_k)
+        num_kept += 1
+    log.debug('Keeping %d/%d read lines from %s', num_kept, num_total, fname)
+    if num_ignored > 0:
+        log.warning('Had to ignore %d results due to not knowing how to '
+                    'parse them.', num_ignored)
+    return data
+
+
 def trim_results(fresh_days, result_dict):
     ''' Given a result dictionary, remove all Results that are no longer valid
     and return the new dictionary '''
@@ -82,53 +237,264 @@ def trim_results(fresh_days, result_dict):
     return out_results
 
 
-def load_recent_results_in_datadir(fresh_days, datadir, success_only=False):
+def load_recent_results_in_datadir(fresh_days, datadir, success_only=False,
+                                   result_store='files', fingerprint=None,
+                                   processes=1):
     ''' Given a data directory, read all results files in it that could have
     results in them that are still valid. Trim them, and return the valid
-    Results as a list '''
+    Results as a list. Optionally only keep ResultSuccess and optionally only
+    keep results for the relay with **fingerprint**.
+
+    With **processes** greater than 1, parse that many result files at a time
+    in worker processes. The results are the same either way.
+
+    With **result_store** 'sqlite', read the results from the datadir's SQLite
+    result store instead of the result files. '''
     assert isinstance(fresh_days, int)
     assert os.path.isdir(datadir)
+    if result_store == 'sqlite':
+        return _load_recent_results_in_db(
+            fresh_days, datadir, success_only=success_only,
+            fingerprint=fingerprint)
     results = {}
+    load = partial(load_result_file, success_only=success_only,
+                   fingerprint=fingerprint)
+    for new_results in _map_result_files(
+            load, _recent_result_fnames(fresh_days, datadir), processes):
+        results = merge_result_dicts(results, new_results)
+    results = trim_results(fresh_days, results)
+    num_res = sum([len(results[fp]) for fp in results])
+    if num_res == 0:
+        _warn_no_recent_results(fresh_days, datadir)
+    return results
+
+
+def load_recent_result_fields_in_datadir(fresh_days, datadir, fields,
+                                         success_only=False,
+                                         result_store='files',
+                                         fingerprint=None, processes=1,
+                                         sketch_k=None):
+    ''' Like load_recent_results_in_datadir(), but only keeps the given
+    **fields** of the valid results, in a field dictionary as returned by
+    load_result_file_fields(). Much faster than building all the Results when
+    the caller doesn't need them, like sbws generate. '''
+    assert isinstance(fresh_days, int)
+    assert os.path.isdir(datadir)
+    oldest_allowed = time.time() - fresh_days * 24*60*60
+    if result_store == 'sqlite':
+        from .resultstore import SQLiteResultStore, results_db_fname
+        store = SQLiteResultStore(results_db_fname(datadir))
+        data = store.load_result_fields(
+            oldest_allowed, fields, success_only=success_only,
+            fingerprint=fingerprint, sketch_k=sketch_k)
+        if len(data) == 0:
+            _warn_no_recent_results_in_db(fresh_days, datadir)
+        return data
+    data = {}
+    load = partial(load_result_file_fields, fields=fields,
+                   oldest_allowed=oldest_allowed, success_only=success_only,
+                   fingerprint=fingerprint, sketch_k=sketch_k)
+    for new_data in _map_result_files(
+            load, _recent_result_fnames(fresh_days, datadir), processes):
+        data = merge_result_field_dicts(data, new_data)
+    if len(data) == 0:
+        _warn_no_recent_results(fresh_days, datadir)
+    return data
+
+
+def _map_result_files(load, fnames, processes):
+    ''' Yield load(fname) for each of **fnames**, in order. With **processes**
+    greater than 1, call load() in that many worker processes. **load** must
+    be picklable, like a module-level function or a partial of one. '''
+    processes = min(processes, len(fnames))
+    if processes <= 1:
+        for fname in fnames:
+            yield load(fname)
+        return
+    log.debug('Loading %d result files in %d processes', len(fnames),
+              processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # map() returns the results in the order of fnames, so merging them
+        # gives the same result dictionary as loading them one by one
+        for d in executor.map(load, fnames):
+            yield d
+
+
+def _recent_result_days(fresh_days):
+    ''' Return the YYYY-MM-DD days whose result files could have results in
+    them that are still valid '''
     today = datetime.utcfromtimestamp(time.time())
     data_period = fresh_days + 2
     oldest_day = today - timedelta(days=data_period)
+    days = set()
     working_day = oldest_day
     while working_day <= today:
-        # Cannot use ** and recursive=True in glob() because we support 3.4
-        # So instead settle on finding files in the datadir and one
-        # subdirectory below the datadir that fit the form of YYYY-MM-DD*.txt
-        d = working_day.date()
-        patterns = [os.path.join(datadir, '{}*.txt'.format(d)),
-                    os.path.join(datadir, '*', '{}*.txt'.format(d))]
-        for pattern in patterns:
-            for fname in glob(pattern):
-                new_results = load_result_file(
-                    fname, success_only=success_only)
-                results = merge_result_dicts(results, new_results)
+        days.add(str(working_day.date()))
         working_day += timedelta(days=1)
-    results = trim_results(fresh_days, results)
-    num_res = sum([len(results[fp]) for fp in results])
-    if num_res == 0:
-        log.warning('Results files that are valid not found. '
-                    'Probably sbws scanner was not run first or '
-                    'it ran more than %d days ago or '
-                    'it was using a different datadir than %s.', data_period,
-                    datadir)
+    return days
+
+
+def _recent_result_fnames(fresh_days, datadir):
+    ''' Return the result files in **datadir** that could have results in
+    them that are still valid, oldest day first '''
+    days = _recent_result_days(fresh_days)
+    # Cannot use ** and recursive=True in glob() because we support 3.4
+    # So instead settle on finding files in the datadir and one
+    # subdirectory below the datadir that fit the form of YYYY-MM-DD*.txt
+    fnames = []
+    patterns = [os.path.join(datadir, '*.txt'),
+                os.path.join(datadir, '*', '*.txt')]
+    for depth, pattern in enumerate(patterns):
+        for fname in glob(pattern):
+            day = os.path.basename(fname)[:len('YYYY-MM-DD')]
+            if day in days:
+                fnames.append((day, depth, fname))
+    return [fname for _, _, fname in sorted(fnames)]
+
+
+def _warn_no_recent_results(fresh_days, datadir):
+    log.warning('Results files that are valid not found. '
+                'Probably sbws scanner was not run first or '
+                'it ran more than %d days ago or '
+                'it was using a different datadir than %s.', fresh_days + 2,
+                datadir)
+
+
+def _warn_no_recent_results_in_db(fresh_days, datadir):
+    from .resultstore import results_db_fname
+    log.warning('Results that are valid not found in %s. Probably sbws '
+                'scanner was not run first or it ran more than %d days '
+                'ago or it was using a different datadir or result '
+                'store.', results_db_fname(datadir), fresh_days)
+
+
+def _load_recent_results_in_db(fresh_days, datadir, success_only=False,
+                               fingerprint=None):
+    # Imported here because resultstore needs the Result classes from here
+    from .resultstore import SQLiteResultStore, results_db_fname
+    oldest_allowed = time.time() - fresh_days * 24*60*60
+    store = SQLiteResultStore(results_db_fname(datadir))
+    results = store.load_results(
+        oldest_allowed, success_only=success_only, fingerprint=fingerprint)
+    if len(results) == 0:
+        _warn_no_recent_results_in_db(fresh_days, datadir)
     return results
 
 
 def write_result_to_datadir(result, datadir):
     ''' Can be called from any thread '''
-    assert isinstance(result, Result)
+    write_results_to_datadir([result], datadir)
+
+
+def write_results_to_datadir(results, datadir, fsync=False):
+    ''' Write all the given results to their daily result files while
+    holding the directory lock once, with one write per file. If **fsync**,
+    make sure they are on disk before returning. Can be called from any
+    thread '''
     assert os.path.isdir(datadir)
-    dt = datetime.utcfromtimestamp(result.time)
-    ext = '.txt'
-    result_fname = os.path.join(
-        datadir, '{}{}'.format(dt.date(), ext))
+    lines_per_fname = {}
+    for result in results:
+        assert isinstance(result, Result)
+        dt = datetime.utcfromtimestamp(result.time)
+        ext = '.txt'
+        result_fname = os.path.join(
+            datadir, '{}{}'.format(dt.date(), ext))
+        if result_fname not in lines_per_fname:
+            lines_per_fname[result_fname] = []
+        lines_per_fname[result_fname].append('{}\n'.format(str(result)))
     with DirectoryLock(datadir):
-        log.debug('Writing a result to %s', result_fname)
-        with open(result_fname, 'at') as fd:
-            fd.write('{}\n'.format(str(result)))
+        for result_fname, lines in lines_per_fname.items():
+            log.debug('Writing %d results to %s', len(lines), result_fname)
+            with open(result_fname, 'at') as fd:
+                fd.write(''.join(lines))
+                if fsync:
+                    fd.flush()
+                    os.fsync(fd.fileno())
+
+
+def write_result_snapshot(fname, datadir, fresh_days, data):
+    ''' Save the result dictionary **data** to the snapshot file **fname**,
+    replacing it atomically. **data** must have exactly the valid results
+    that are in the result files in **datadir** right now. Their sizes are
+    saved with **data** as the high-water mark the snapshot is up to date
+    with, so nothing may write to them while this runs. '''
+    offsets = {}
+    for result_fname in _recent_result_fnames(fresh_days, datadir):
+        offsets[os.path.relpath(result_fname, datadir)] = \
+            os.path.getsize(result_fname)
+    snapshot = {
+        'version': RESULT_SNAPSHOT_VERSION,
+        'result_version': RESULT_VERSION,
+        'time': time.time(),
+        'fresh_days': fresh_days,
+        'offsets': offsets,
+        'data': data,
+    }
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fd:
+        pickle.dump(snapshot, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_fname, fname)
+    log.debug('Saved a snapshot of %d results to %s',
+              sum([len(data[fp]) for fp in data]), fname)
+
+
+def load_result_snapshot(fname, datadir, fresh_days):
+    ''' Load the snapshot file **fname** written by write_result_snapshot()
+    and add the results written to the result files in **datadir** after it.
+    Return the valid results as a result dictionary, the same as
+    load_recent_results_in_datadir() would, or None if there is no snapshot
+    or it can't be used. '''
+    # Unpickling makes a lot of objects that are all kept, so the garbage
+    # collector would only slow it down (by more than half)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(fname, 'rb') as fd:
+            snapshot = pickle.load(fd)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning('Ignoring the result snapshot %s because it can\'t be '
+                    'read: %s', fname, e)
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != RESULT_SNAPSHOT_VERSION or \
+            snapshot['result_version'] != RESULT_VERSION or \
+            snapshot['fresh_days'] != fresh_days or \
+            snapshot['time'] < time.time() - fresh_days * 24*60*60:
+        log.info('Not using the result snapshot %s because it is stale',
+                 fname)
+        return None
+    offsets = snapshot['offsets']
+    recent_days = _recent_result_days(fresh_days)
+    fnames = _recent_result_fnames(fresh_days, datadir)
+    rel_fnames = set([os.path.relpath(f, datadir) for f in fnames])
+    for rel_fname, offset in offsets.items():
+        # A result file the snapshot has results from is gone or shorter
+        # than it was, so the snapshot doesn't match the result files
+        if os.path.basename(rel_fname)[:len('YYYY-MM-DD')] in recent_days \
+                and (rel_fname not in rel_fnames or offset > os.path.getsize(
+                    os.path.join(datadir, rel_fname))):
+            log.info('Not using the result snapshot %s because %s changed '
+                     'since it was saved', fname, rel_fname)
+            return None
+    data = snapshot['data']
+    num_snapshot = sum([len(data[fp]) for fp in data])
+    num_new = 0
+    for result_fname in fnames:
+        new_results = load_result_file(
+            result_fname,
+            offset=offsets.get(os.path.relpath(result_fname, datadir), 0))
+        num_new += sum([len(new_results[fp]) for fp in new_results])
+        data = merge_result_dicts(data, new_results)
+    log.info('Loaded %d results from the result snapshot %s and %d newer '
+             'ones from the result files', num_snapshot, fname, num_new)
+    return trim_results(fresh_days, data)
 
 
 class _StrEnum(str, Enum):
@@ -145,43 +511,63 @@ class _ResultType(_StrEnum):
 
 class Result:
     ''' A simple struct to pack a measurement result into so that other code
-    can be confident it is handling a well-formed result. '''
+    can be confident it is handling a well-formed result.
+
+    ResultDump keeps days of Results for every relay in memory, so they are
+    kept small: no per-instance __dict__, the strings that repeat across
+    Results are interned, and lists are kept as tuples. The properties give
+    back the same values the Result was made with. '''
+    __slots__ = ('_fingerprint', '_nickname', '_address', '_circ',
+                 '_dest_url', '_scanner', '_time')
 
     class Relay:
         ''' Implements just enough of a stem RouterStatusEntryV3 for this
         Result class to be happy '''
+        __slots__ = ('fingerprint', 'nickname', 'address')
+
         def __init__(self, fingerprint, nickname, address):
             self.fingerprint = fingerprint
             self.nickname = nickname
             self.address = address
 
     def __init__(self, relay, circ, dest_url, scanner_nick, t=None):
-        self._relay = Result.Relay(relay.fingerprint, relay.nickname,
-                                   relay.address)
-        self._circ = circ
-        self._dest_url = dest_url
-        self._scanner = scanner_nick
+        self._fingerprint = intern(relay.fingerprint)
+        self._nickname = intern(relay.nickname)
+        self._address = intern(relay.address)
+        self._circ = tuple(intern(fp) for fp in circ)
+        self._dest_url = intern(dest_url)
+        self._scanner = intern(scanner_nick)
         self._time = time.time() if t is None else t
 
+    def __getstate__(self):
+        # Much faster to pickle and unpickle than the default for __slots__,
+        # which matters for the ResultDump snapshot
+        return (self._fingerprint, self._nickname, self._address, self._circ,
+                self._dest_url, self._scanner, self._time)
+
+    def __setstate__(self, state):
+        (self._fingerprint, self._nickname, self._address, self._circ,
+         self._dest_url, self._scanner, self._time) = state
+
     @property
     def type(self):
         raise NotImplementedError()
 
     @property
     def fingerprint(self):
-        return self._relay.fingerprint
+        return self._fingerprint
 
     @property
     def nickname(self):
-        return self._relay.nickname
+        return self._nickname
 
     @property
     def address(self):
-        return self._relay.address
+        return self._address
 
     @property
     def circ(self):
-        return self._circ
+        return list(self._circ)
 
     @property
     def dest_url(self):
@@ -242,10 +628,19 @@ class Result:
 
 
 class ResultError(Result):
+    __slots__ = ('_msg',)
+
     def __init__(self, *a, msg=None, **kw):
         super().__init__(*a, **kw)
         self._msg = msg
 
+    def __getstate__(self):
+        return super().__getstate__() + (self._msg,)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-1])
+        self._msg = state[-1]
+
     @property
     def type(self):
         return _ResultType.Error
@@ -288,6 +683,8 @@ class ResultError(Result):
 
 
 class ResultErrorCircuit(ResultError):
+    __slots__ = ()
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
 
@@ -324,6 +721,8 @@ class ResultErrorCircuit(ResultError):
 
 
 class ResultErrorStream(ResultError):
+    __slots__ = ()
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
 
@@ -345,6 +744,8 @@ class ResultErrorStream(ResultError):
 
 
 class ResultErrorAuth(ResultError):
+    __slots__ = ()
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
 
@@ -379,10 +780,22 @@ class ResultErrorAuth(ResultError):
 
 
 class ResultSuccess(Result):
+    __slots__ = ('_rtts', '_downloads')
+
     def __init__(self, rtts, downloads, *a, **kw):
         super().__init__(*a, **kw)
-        self._rtts = rtts
-        self._downloads = downloads
+        self._rtts = tuple(rtts)
+        # duration, amount, duration, amount, ... instead of a dict per
+        # download
+        self._downloads = tuple(value for dl in downloads
+                                for value in (dl['duration'], dl['amount']))
+
+    def __getstate__(self):
+        return super().__getstate__() + (self._rtts, self._downloads)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-2])
+        self._rtts, self._downloads = state[-2:]
 
     @property
     def type(self):
@@ -390,11 +803,13 @@ class ResultSuccess(Result):
 
     @property
     def rtts(self):
-        return self._rtts
+        return list(self._rtts)
 
     @property
     def downloads(self):
-        return self._downloads
+        return [{'duration': duration, 'amount': amount}
+                for duration, amount in zip(self._downloads[0::2],
+                                            self._downloads[1::2])]
 
     @staticmethod
     def from_dict(d):
@@ -414,9 +829,116 @@ class ResultSuccess(Result):
         return d
 
 
+class RelaySummary:
+    ''' What we know about one relay's results without looking at them: how
+    many there are of each type, when the oldest and newest were made, and
+    the sums its freshness is calculated from (see
+    RelayPrioritizer.best_priority()). ResultDump keeps one per relay up to
+    date as results are added and expire, so using it costs the same no matter
+    how many results the relay has. '''
+    __slots__ = ('fingerprint', 'nickname', 'num_results', 'num_per_type',
+                 'oldest_time', 'newest_time', '_weighted_time', '_weight')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.nickname = None
+        self.num_results = 0
+        # Keyed by the result type's value, like 'success' or 'error-circ'
+        self.num_per_type = {}
+        self.oldest_time = None
+        self.newest_time = None
+        self._weighted_time = 0.0
+        self._weight = 0.0
+
+    @property
+    def num_success(self):
+        return self.num_per_type.get(_ResultType.Success.value, 0)
+
+    @property
+    def num_errors(self):
+        return self.num_results - self.num_success
+
+    @staticmethod
+    def _freshness_weight(result):
+        ''' How much a result counts towards its relay's freshness '''
+        if isinstance(result, ResultError):
+            assert result.freshness_reduction_factor >= 0.0
+            assert result.freshness_reduction_factor <= 1.0
+            return max(1.0 - result.freshness_reduction_factor, 0)
+        return 1.0
+
+    def add_result(self, result):
+        ''' Count the new Result **result** for this relay '''
+        assert result.fingerprint == self.fingerprint
+        self.num_results += 1
+        result_type = result.type.value
+        self.num_per_type[result_type] = \
+            self.num_per_type.get(result_type, 0) + 1
+        if self.newest_time is None or result.time >= self.newest_time:
+            self.newest_time = result.time
+            self.nickname = result.nickname
+        if self.oldest_time is None or result.time < self.oldest_time:
+            self.oldest_time = result.time
+        weight = self._freshness_weight(result)
+        self._weighted_time += weight * result.time
+        self._weight += weight
+
+    def remove_result(self, result, results_left):
+        ''' Stop counting the Result **result**. **results_left** are the
+        relay's remaining results, in time order. '''
+        assert results_left
+        self.num_results -= 1
+        self.num_per_type[result.type.value] -= 1
+        self.oldest_time = results_left[0].time
+        self.newest_time = results_left[-1].time
+        weight = self._freshness_weight(result)
+        self._weighted_time -= weight * result.time
+        self._weight -= weight
+
+    def freshness(self, oldest_allowed):
+        ''' Return the sum of the freshness of the relay's results, where a
+        result's freshness is the time between **oldest_allowed** and when it
+        was made, reduced for errors. '''
+        return self._weighted_time - oldest_allowed * self._weight
+
+    def copy(self):
+        summary = RelaySummary(self.fingerprint)
+        summary.nickname = self.nickname
+        summary.num_results = self.num_results
+        summary.num_per_type = dict(self.num_per_type)
+        summary.oldest_time = self.oldest_time
+        summary.newest_time = self.newest_time
+        summary._weighted_time = self._weighted_time
+        summary._weight = self._weight
+        return summary
+
+
+def summarize_results(result_dict):
+    ''' Return a dictionary with a RelaySummary for each relay in the result
+    dictionary **result_dict** '''
+    summaries = {}
+    for fp in result_dict:
+        summary = RelaySummary(fp)
+        for result in result_dict[fp]:
+            summary.add_result(result)
+        summaries[fp] = summary
+    return summaries
+
+
 class ResultDump:
     ''' Runs the enter() method in a new thread and collects new Results on its
-    queue. Writes them to daily result files in the data directory '''
+    queue. Writes them to daily result files in the data directory, or to its
+    SQLite result store with ``general.result_store = sqlite``.
+
+    Results are written in batches of up to ``scanner.result_batch_size``
+    results, and a batch is never kept for more than
+    ``scanner.result_batch_age`` seconds. Whatever is left is written when
+    **end_event** is set.
+
+    Every ``scanner.result_snapshot_interval`` seconds, and when stopping, a
+    snapshot of the results in memory is saved to the datadir so that the
+    next ResultDump can start from it instead of parsing every recent
+    result. '''
     def __init__(self, args, conf, end_event):
         assert os.path.isdir(conf['paths']['datadir'])
         assert isinstance(end_event, Event)
@@ -424,8 +946,31 @@ class ResultDump:
         self.fresh_days = conf.getint('general', 'data_period')
         self.datadir = conf['paths']['datadir']
         self.end_event = end_event
+        self.batch_size = conf.getint('scanner', 'result_batch_size')
+        self.batch_age = conf.getfloat('scanner', 'result_batch_age')
+        self.fsync = conf.getboolean('scanner', 'result_fsync')
+        self.result_store = conf['general']['result_store']
+        self.snapshot_interval = conf.getint(
+            'scanner', 'result_snapshot_interval')
+        self.snapshot_fname = os.path.join(
+            self.datadir, RESULT_SNAPSHOT_FNAME)
+        self._last_snapshot = time.time()
+        self._store = None
+        if self.result_store == 'sqlite':
+            from .resultstore import SQLiteResultStore, results_db_fname
+            self._store = SQLiteResultStore(
+                results_db_fname(self.datadir), fsync=self.fsync)
+        self._batch = []
+        self._batch_started = None
         self.data = None
+        # A RelaySummary of the results in self.data for each relay
+        self._summaries = {}
+        # A min-heap of (time, fingerprint) with an entry for every result in
+        # self.data, so we know which results to expire next
+        self._expiry = []
         self.data_lock = RLock()
+        # Set once self.data has the recent results
+        self.data_loaded = Event()
         self.thread = Thread(target=self.enter)
         self.queue = Queue()
         self.thread.start()
@@ -436,9 +981,117 @@ class ResultDump:
         with self.data_lock:
             fp = result.fingerprint
             if fp not in self.data:
-                self.data[fp] = []
-            self.data[fp].append(result)
-            self.data = trim_results(self.fresh_days, self.data)
+                self.data[fp] = deque()
+            results = self.data[fp]
+            # Keep each relay's results in time order. Results almost always
+            # arrive in order, so this is almost always an append.
+            i = len(results)
+            while i > 0 and results[i-1].time > result.time:
+                i -= 1
+            if i == len(results):
+                results.append(result)
+            else:
+                results.insert(i, result)
+            heapq.heappush(self._expiry, (result.time, fp))
+            if fp not in self._summaries:
+                self._summaries[fp] = RelaySummary(fp)
+            self._summaries[fp].add_result(result)
+            self._expire_results()
+
+    def _expire_results(self, oldest_allowed=None):
+        ''' Remove results that are no longer fresh from self.data and their
+        relays' summaries, and return the removed results. Results made before
+        **oldest_allowed** are no longer fresh, but none that are fresh for
+        ``general.data_period`` are removed. Each result is removed exactly
+        once, so this is cheap no matter how many results we have. Must hold
+        data_lock. '''
+        own_oldest_allowed = time.time() - self.fresh_days * 24*60*60
+        if oldest_allowed is None or oldest_allowed > own_oldest_allowed:
+            oldest_allowed = own_oldest_allowed
+        removed = []
+        while self._expiry and self._expiry[0][0] < oldest_allowed:
+            _, fp = heapq.heappop(self._expiry)
+            # A relay's results are in time order, so the oldest one of them
+            # is the one the expiry heap just gave us
+            results = self.data[fp]
+            removed.append(results.popleft())
+            if not results:
+                del self.data[fp]
+        for result in removed:
+            self._remove_from_summary(result)
+        return removed
+
+    def _index_data(self):
+        ''' (Re)build everything we keep about self.data to make storing and
+        expiring results cheap. Must hold data_lock. '''
+        self._expiry = []
+        for fp in self.data:
+            # A deque, so that the oldest result can be removed cheaply
+            self.data[fp] = deque(sorted(self.data[fp], key=lambda r: r.time))
+            self._expiry.extend((r.time, fp) for r in self.data[fp])
+        heapq.heapify(self._expiry)
+        self._summaries = summarize_results(self.data)
+
+    def _remove_from_summary(self, result):
+        ''' Must hold data_lock '''
+        fp = result.fingerprint
+        if fp not in self.data:
+            # No results left, so don't bother keeping the rounding errors
+            self._summaries.pop(fp, None)
+            return
+        self._summaries[fp].remove_result(result, self.data[fp])
+
+    def relay_freshness(self, fingerprint, oldest_allowed):
+        ''' Return the sum of the freshness of the results we have for the
+        relay with **fingerprint**, or 0 if we have none. See
+        RelaySummary.freshness() '''
+        with self.data_lock:
+            self._expire_results(oldest_allowed)
+            if fingerprint not in self._summaries:
+                return 0
+            return self._summaries[fingerprint].freshness(oldest_allowed)
+
+    def summary_for_relay(self, fingerprint):
+        ''' Return a copy of the RelaySummary of the results we have for the
+        relay with **fingerprint**, or None if we have none '''
+        with self.data_lock:
+            if fingerprint not in self._summaries:
+                return None
+            return self._summaries[fingerprint].copy()
+
+    def iter_summaries(self, oldest_allowed=None):
+        ''' Return an iterator over copies of the RelaySummary of every relay
+        we have results for. They are all copied at the same time, so they
+        are consistent with each other.
+
+        Results only expire when new ones are stored, so when the summaries
+        are for RelaySummary.freshness() with **oldest_allowed**, pass it
+        to expire the results made before it first. Otherwise they would
+        count less than nothing. '''
+        with self.data_lock:
+            if oldest_allowed is not None:
+                self._expire_results(oldest_allowed)
+            summaries = [s.copy() for s in self._summaries.values()]
+        return iter(summaries)
+
+    def result_fields(self, fields, success_only=False, sketch_k=None):
+        ''' Return the given **fields** of the results we have in a field
+        dictionary, like :func:`load_recent_result_fields_in_datadir` would
+        give from the results we wrote. Waits for the recent results to be
+        loaded first. '''
+        self.data_loaded.wait()
+        with self.data_lock:
+            # Results are never changed, so a copy of the lists is enough
+            data = {fp: list(self.data[fp]) for fp in self.data}
+        fields_data = {}
+        for fp in data:
+            for result in data[fp]:
+                if success_only and not isinstance(result, ResultSuccess):
+                    continue
+                rd = {field: getattr(result, field, None) for field in fields}
+                rd['fingerprint'] = fp
+                _add_result_fields(fields_data, rd, fields, sketch_k=sketch_k)
+        return fields_data
 
     def handle_result(self, result):
         ''' Call from ResultDump thread. If we are shutting down, ignores
@@ -451,16 +1104,80 @@ class ResultDump:
                       type(result).__name__, nick, fp)
             return
         self.store_result(result)
-        write_result_to_datadir(result, self.datadir)
+        self._batch_result(result)
         log.info('%s %s finished measurement with %s', nick, fp[0:8],
                  type(result).__name__)
 
+    def _batch_result(self, result):
+        ''' Call from ResultDump thread '''
+        if not self._batch:
+            self._batch_started = time.time()
+        self._batch.append(result)
+        if len(self._batch) >= self.batch_size:
+            self.flush_results()
+
+    def flush_results(self):
+        ''' Write the results we have been batching to the datadir. Call from
+        ResultDump thread '''
+        if not self._batch:
+            return
+        if self._store is not None:
+            self._store.write_results(self._batch)
+        else:
+            write_results_to_datadir(
+                self._batch, self.datadir, fsync=self.fsync)
+        self._batch = []
+        self._batch_started = None
+
+    def _flush_results_if_old(self):
+        if self._batch and \
+                time.time() - self._batch_started >= self.batch_age:
+            self.flush_results()
+
+    def _snapshots_enabled(self):
+        # The SQLite result store doesn't need them: loading from it is
+        # already cheap
+        return self.snapshot_interval > 0 and self._store is None
+
+    def _load_data(self):
+        ''' Call from ResultDump thread '''
+        if self._snapshots_enabled():
+            data = load_result_snapshot(
+                self.snapshot_fname, self.datadir, self.fresh_days)
+            if data is not None:
+                return data
+        return load_recent_results_in_datadir(
+            self.fresh_days, self.datadir, result_store=self.result_store)
+
+    def write_snapshot(self):
+        ''' Write the results we have been batching and then a snapshot of
+        all our results to the datadir. Call from ResultDump thread '''
+        if not self._snapshots_enabled():
+            return
+        self.flush_results()
+        with self.data_lock:
+            # Results are never changed, so a copy of the lists is enough
+            data = {fp: list(self.data[fp]) for fp in self.data}
+        # Only this thread writes results, so the result files still match
+        # data without holding the lock while the snapshot is written
+        write_result_snapshot(
+            self.snapshot_fname, self.datadir, self.fresh_days, data)
+        self._last_snapshot = time.time()
+
+    def _write_snapshot_if_old(self):
+        if self._snapshots_enabled() and \
+                time.time() - self._last_snapshot >= self.snapshot_interval:
+            self.write_snapshot()
+
     def enter(self):
         ''' Main loop for the ResultDump thread '''
         with self.data_lock:
-            self.data = load_recent_results_in_datadir(
-                self.fresh_days, self.datadir)
+            self.data = self._load_data()
+            self._index_data()
+        self.data_loaded.set()
         while not (self.end_event.is_set() and self.queue.empty()):
+            self._flush_results_if_old()
+            self._write_snapshot_if_old()
             try:
                 event = self.queue.get(timeout=1)
             except Empty:
@@ -479,6 +1196,8 @@ class ResultDump:
                 log.warning('The only thing we should ever receive in the '
                             'result thread is a Result or list of Results. '
                             'Ignoring %s', type(data))
+        self.flush_results()
+        self.write_snapshot()
 
     def results_for_relay(self, relay):
         assert isinstance(relay, RouterStatusEntryV3)
@@ -486,4 +1205,5 @@ class ResultDump:
         with self.data_lock:
             if fp not in self.data:
                 return []
-            return self.data[fp]
+            # A copy, since we remove old results from the original
+            return list(self.data[fp])
@@ -0,0 +1,250 @@
+''' An SQLite backed alternative to the datadir's daily result files.
+
+Results are kept as the same JSON lines the result files contain, next to the
+columns we need to find them quickly: fingerprint, time and type. With
+``general.result_store = sqlite``, ResultDump writes results here and
+:func:`sbws.lib.resultdump.load_recent_results_in_datadir` reads them from here
+with indexed range queries instead of parsing every recent line. '''
+import os
+import re
+import gzip
+import sqlite3
+import logging
+from .resultdump import Result
+from .resultdump import _ResultType
+from .resultdump import _add_result_fields
+from .resultdump import _json_loads
+from sbws.globals import RESULT_VERSION
+from sbws.util.filelock import DirectoryLock
+
+log = logging.getLogger(__name__)
+
+RESULTS_DB_FNAME = 'results.db'
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS results (
+        fingerprint TEXT NOT NULL,
+        time REAL NOT NULL,
+        type TEXT NOT NULL,
+        line TEXT NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS results_fingerprint_time
+        ON results (fingerprint, time)''',
+    'CREATE INDEX IF NOT EXISTS results_type_time ON results (type, time)',
+    'CREATE INDEX IF NOT EXISTS results_time ON results (time)',
+    # How many bytes of each result file were imported, so nothing is
+    # imported twice. fname is relative to the datadir and without .gz.
+    '''CREATE TABLE IF NOT EXISTS imported_result_files (
+        fname TEXT PRIMARY KEY,
+        size INTEGER NOT NULL
+    )''',
+]
+
+
+def results_db_fname(datadir):
+    return os.path.join(datadir, RESULTS_DB_FNAME)
+
+
+class SQLiteResultStore:
+    ''' Stores and finds Results in an SQLite database. Opens a new connection
+    for every call, so it can be used from any thread or process.
+
+    :param str fname: the database file. It is created if needed.
+    :param bool fsync: whether every write must be on disk before returning.
+    '''
+    def __init__(self, fname, fsync=False):
+        self._fname = fname
+        self._fsync = fsync
+        conn = self._connect()
+        try:
+            # WAL lets generate/stats read while the scanner writes
+            conn.execute('PRAGMA journal_mode = WAL')
+            with conn:
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._fname, timeout=60)
+        conn.execute('PRAGMA synchronous = {}'.format(
+            'FULL' if self._fsync else 'NORMAL'))
+        return conn
+
+    def write_results(self, results):
+        ''' Store all the given Results in one transaction '''
+        rows = []
+        for result in results:
+            assert isinstance(result, Result)
+            rows.append((result.fingerprint, result.time, result.type.value,
+                         str(result)))
+        self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO results (fingerprint, time, type, line) '
+                    'VALUES (?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+
+    def load_results(self, oldest_allowed, success_only=False,
+                     fingerprint=None):
+        ''' Return a result dictionary with the Results made at or after
+        **oldest_allowed**, optionally only ResultSuccess and optionally only
+        for the relay with **fingerprint**. Each relay's results are in time
+        order. '''
+        query, params = self._lines_query(
+            oldest_allowed, success_only, fingerprint)
+        d = {}
+        num_total = 0
+        num_ignored = 0
+        conn = self._connect()
+        try:
+            for line, in conn.execute(query, params):
+                num_total += 1
+                r = Result.from_dict(_json_loads(line))
+                if r is None:
+                    num_ignored += 1
+                    continue
+                fp = r.fingerprint
+                if fp not in d:
+                    d[fp] = []
+                d[fp].append(r)
+        finally:
+            conn.close()
+        log.debug('Read %d results from %s', num_total - num_ignored,
+                  self._fname)
+        if num_ignored > 0:
+            log.warning('Had to ignore %d results due to not knowing how to '
+                        'parse them.', num_ignored)
+        return d
+
+    def load_result_fields(self, oldest_allowed, fields, success_only=False,
+                           fingerprint=None, sketch_k=None):
+        ''' Like load_results(), but only keeps the given **fields** of each
+        result in a field dictionary, like
+        :func:`sbws.lib.resultdump.load_result_file_fields` does. '''
+        query, params = self._lines_query(
+            oldest_allowed, success_only, fingerprint)
+        d = {}
+        num_total = 0
+        num_ignored = 0
+        conn = self._connect()
+        try:
+            for line, in conn.execute(query, params):
+                num_total += 1
+                rd = _json_loads(line)
+                if rd.get('version') != RESULT_VERSION:
+                    num_ignored += 1
+                    continue
+                _add_result_fields(d, rd, fields, sketch_k=sketch_k)
+        finally:
+            conn.close()
+        log.debug('Read %d results from %s', num_total - num_ignored,
+                  self._fname)
+        if num_ignored > 0:
+            log.warning('Had to ignore %d results due to not knowing how to '
+                        'parse them.', num_ignored)
+        return d
+
+    @staticmethod
+    def _lines_query(oldest_allowed, success_only, fingerprint):
+        query = 'SELECT line FROM results WHERE time >= ?'
+        params = [oldest_allowed]
+        if success_only:
+            query += ' AND type = ?'
+            params.append(_ResultType.Success.value)
+        if fingerprint is not None:
+            query += ' AND fingerprint = ?'
+            params.append(fingerprint)
+        query += ' ORDER BY time'
+        return query, params
+
+    def delete_results_older_than(self, oldest_allowed, dry_run=False):
+        ''' Delete results made before **oldest_allowed** and return how many
+        there were '''
+        conn = self._connect()
+        try:
+            with conn:
+                num, = conn.execute(
+                    'SELECT COUNT(*) FROM results WHERE time < ?',
+                    (oldest_allowed,)).fetchone()
+                if not dry_run:
+                    conn.execute('DELETE FROM results WHERE time < ?',
+                                 (oldest_allowed,))
+        finally:
+            conn.close()
+        return num
+
+    def import_result_file(self, fname, name=None):
+        ''' Import the results in the .txt or .txt.gz result file **fname**
+        that weren't imported yet and return how many were imported. The lines
+        are stored as they are, without building Result objects for them.
+
+        How much of the file was imported is remembered by **name**, which
+        defaults to **fname** without .gz, so a file compressed by sbws
+        cleanup after it was imported is not imported again. A file that is
+        still being written can be imported again later: only the lines added
+        since are imported, and a line that isn't finished yet is left for
+        then. '''
+        if name is None:
+            name = fname[:-len('.gz')] if fname.endswith('.gz') else fname
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(fname, 'rb') as fd:
+            data = fd.read()
+        end = data.rfind(b'\n') + 1
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    'SELECT size FROM imported_result_files WHERE fname = ?',
+                    (name,)).fetchone()
+                offset = 0 if row is None else row[0]
+                if end <= offset:
+                    log.debug('Already imported %s', fname)
+                    return 0
+                rows = []
+                for line in data[offset:end].decode('utf-8').split('\n'):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    d = _json_loads(line)
+                    rows.append(
+                        (d['fingerprint'], d['time'], d['type'], line))
+                conn.execute(
+                    'INSERT OR REPLACE INTO imported_result_files '
+                    '(fname, size) VALUES (?, ?)', (name, end))
+                conn.executemany(
+                    'INSERT INTO results (fingerprint, time, type, line) '
+                    'VALUES (?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+        return len(rows)
+
+
+def import_result_files(store, datadir):
+    ''' Import all the .txt and .txt.gz result files in **datadir** and the
+    directories below it into the SQLiteResultStore **store**. Return how many
+    results were imported. Only the results added since the last import are
+    imported. '''
+    assert os.path.isdir(datadir)
+    regex = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}.*\.txt(\.gz)?$')
+    num_imported = 0
+    with DirectoryLock(datadir):
+        for root, dirs, files in os.walk(datadir):
+            for f in sorted(files):
+                if not regex.match(f):
+                    continue
+                fname = os.path.join(root, f)
+                # Files of the same day in different subdirectories have the
+                # same name
+                name = os.path.relpath(fname, datadir)
+                if name.endswith('.gz'):
+                    name = name[:-len('.gz')]
+                num = store.import_result_file(fname, name=name)
+                log.info('Imported %d results from %s', num, fname)
+                num_imported += num
+    return num_imported
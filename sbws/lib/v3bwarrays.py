@@ -0,0 +1,149 @@
+''' A NumPy version of what ``sbws generate`` computes for every relay.
+
+The successful results of all relays are put in columns: one array per value
+(time, download amount and duration, rtt) next to an array with the index of
+the relay each value belongs to. Per relay medians and maximums are then
+computed for all relays at once, the bandwidths are scaled in bulk, and the
+v3bw lines are formatted in one pass. The values are exactly the ones the pure
+Python :class:`sbws.core.generate.V3BWLine` gives: both round halves to even
+and do the same floating point operations.
+
+NumPy is optional. Use :func:`have_numpy` to know if this module can be used.
+'''
+from itertools import chain
+from operator import itemgetter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+V3BW_LINE_FORMAT = 'node_id=${} bw={} nick={} rtt={} time={}'
+
+
+def have_numpy():
+    return np is not None
+
+
+def _group_index(lengths):
+    ''' Given how many values each group has, return the group of every value
+    when they are all concatenated '''
+    return np.repeat(np.arange(len(lengths), dtype=np.int64),
+                     np.asarray(lengths, dtype=np.int64))
+
+
+def grouped_median(groups, values, num_groups):
+    ''' Return the median of the **values** in each group, like
+    statistics.median() would give for each of them. **groups** has the group
+    of each value, between 0 and **num_groups** - 1. Every group must have at
+    least one value. '''
+    # Sort the values by group and then by value. Sorting integers made of
+    # the group and the rank of the value is several times faster than
+    # lexsort() or a stable argsort() by group.
+    num = len(values)
+    by_value = np.argsort(values)
+    keys = np.empty(num, dtype=np.int64)
+    keys[by_value] = np.arange(num, dtype=np.int64)
+    keys += groups * num
+    keys.sort()
+    sorted_values = values[by_value[keys % num]]
+    counts = np.bincount(groups, minlength=num_groups)
+    assert np.all(counts > 0)
+    starts = np.cumsum(counts) - counts
+    low = sorted_values[starts + (counts - 1) // 2]
+    high = sorted_values[starts + counts // 2]
+    return (low + high) / 2
+
+
+def grouped_max(groups, values, num_groups):
+    ''' Return the biggest of the **values** in each group '''
+    maxs = np.full(num_groups, -np.inf)
+    np.maximum.at(maxs, groups, values)
+    return maxs
+
+
+class V3BWColumns:
+    ''' The v3bw lines of many relays, one array per column.
+
+    Use :meth:`from_result_fields` to make them from the field dictionary
+    generate loads. The bandwidths are in KiB like V3BWLine's.
+    '''
+    def __init__(self, fps, nicks, bw, rtt, time):
+        assert have_numpy()
+        assert len(fps) == len(nicks) == len(bw) == len(rtt) == len(time)
+        self.fps = fps
+        self.nicks = nicks
+        self.bw = bw
+        self.rtt = rtt
+        self.time = time
+
+    def __len__(self):
+        return len(self.fps)
+
+    @staticmethod
+    def from_result_fields(data):
+        ''' Make the lines from the field dictionary **data**, which must
+        have the nickname, time, rtts and downloads of successful results as
+        lists, in the order of its keys '''
+        fps = list(data.keys())
+        fields = [data[fp] for fp in fps]
+        nicks = [f['nickname'][0] for f in fields]
+        num = len(fps)
+        downloads = [f['downloads'] for f in fields]
+        dl_groups = _group_index([len(dls) for dls in downloads])
+        num_dls = len(dl_groups)
+        amounts = np.fromiter(
+            map(itemgetter('amount'), chain.from_iterable(downloads)),
+            np.float64, count=num_dls)
+        durations = np.fromiter(
+            map(itemgetter('duration'), chain.from_iterable(downloads)),
+            np.float64, count=num_dls)
+        rtts = [f['rtts'] for f in fields]
+        rtt_groups = _group_index([len(r) for r in rtts])
+        rtt_values = np.fromiter(chain.from_iterable(rtts), np.float64,
+                                 count=len(rtt_groups))
+        times = [f['time'] for f in fields]
+        time_groups = _group_index([len(t) for t in times])
+        time_values = np.fromiter(chain.from_iterable(times), np.float64,
+                                  count=len(time_groups))
+        speed = grouped_median(dl_groups, amounts / durations, num)
+        # convert to KiB and make sure the answer is at least 1
+        bw = np.maximum(np.rint(speed / 1024), 1).astype(np.int64)
+        # convert to ms
+        rtt = np.rint(grouped_median(
+            rtt_groups, np.rint(rtt_values * 1000), num)).astype(np.int64)
+        time = np.rint(grouped_max(time_groups, time_values, num)).astype(
+            np.int64)
+        return V3BWColumns(fps, nicks, bw, rtt, time)
+
+    def sort_by_bw(self):
+        ''' Sort the lines by bandwidth, biggest first. Lines with the same
+        bandwidth stay in the order they were in. '''
+        order = np.argsort(-self.bw, kind='stable')
+        self.fps = [self.fps[i] for i in order]
+        self.nicks = [self.nicks[i] for i in order]
+        self.bw = self.bw[order]
+        self.rtt = self.rtt[order]
+        self.time = self.time[order]
+
+    def total_bw(self):
+        return int(self.bw.sum())
+
+    def mean_bw(self):
+        return self.total_bw() / len(self)
+
+    def scale(self, scale):
+        ''' Scale the bandwidths so they add up to about **scale** '''
+        total = self.total_bw()
+        # In case total is zero, it will run on ZeroDivision
+        assert total > 0
+        ratio = scale / total
+        self.bw = np.rint(self.bw * ratio).astype(np.int64)
+
+    def lines(self):
+        ''' Return all the lines as one string, each ending with a newline '''
+        if len(self) == 0:
+            return ''
+        return '\n'.join([
+            V3BW_LINE_FORMAT.format(*line) for line in zip(
+                self.fps, self.bw.tolist(), self.nicks, self.rtt.tolist(),
+                self.time.tolist())]) + '\n'
@@ -2,8 +2,10 @@
 """Classes and functions that create the bandwidth measurements document
 (v3bw) used by bandwidth authorities."""
 
+import os
 import time
 import logging
+from datetime import datetime
 from sbws import __version__
 from sbws.globals import SPEC_VERSION
 
@@ -19,6 +21,8 @@ ORDERED_K = ['timestamp', 'version', 'software', 'software_version']
 ALLOWED_K = ORDERED_KV + ['earliest_bandwidth', 'generator_started']
 TERMINATOR = '===='
 LINE_TERMINATOR = TERMINATOR + LINE_SEP
+# Format of the time in the names of the history copies of v3bw files
+HISTORY_DT_FRMT = '%Y%m%d-%H%M%S'
 
 
 class V3BwHeader(object):
@@ -144,3 +148,62 @@ class V3BwHeader(object):
         if self.version == '1.1.0':
             return self.strv110()
         return self.strv200
+
+
+def _write_file_atomically(fname, text):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wt') as fd:
+        fd.write(text)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def _replace_symlink(fname, target):
+    ''' Make the symbolic link **fname** point to **target**, replacing
+    it atomically '''
+    tmp_fname = fname + '.tmp'
+    if os.path.lexists(tmp_fname):
+        os.remove(tmp_fname)
+    os.symlink(target, tmp_fname)
+    os.replace(tmp_fname, fname)
+
+
+def _is_special_file(fname):
+    ''' Whether **fname** is something like /dev/stdout that must be
+    written to as it is '''
+    if fname.startswith('/dev/'):
+        return True
+    real_fname = os.path.realpath(fname)
+    return os.path.exists(real_fname) and not os.path.isfile(real_fname)
+
+
+def write_v3bw(fname, text, history_dname=None, timestamp=None):
+    """Write the v3bw document **text** to **fname** so that anyone reading
+    **fname** sees either the whole old document or the whole new one.
+
+    When **fname** is a symbolic link, it is pointed to the history copy if
+    there is one. Otherwise the file it points to is replaced. Something else
+    than a regular file, for example /dev/stdout, is simply written to.
+
+    :param str history_dname: if given, also keep a copy of the document in
+        this directory, named after **timestamp** and **fname**
+    :param int timestamp: when the document was made. Defaults to now.
+    :returns: the name of the history copy, or None
+    """
+    history_fname = None
+    if history_dname:
+        os.makedirs(history_dname, exist_ok=True)
+        timestamp = timestamp or int(time.time())
+        history_fname = os.path.join(history_dname, '{}-{}'.format(
+            datetime.utcfromtimestamp(timestamp).strftime(HISTORY_DT_FRMT),
+            os.path.basename(fname)))
+        _write_file_atomically(history_fname, text)
+    if _is_special_file(fname):
+        with open(fname, 'wt') as fd:
+            fd.write(text)
+    elif os.path.islink(fname) and history_fname is not None:
+        _replace_symlink(fname, os.path.abspath(history_fname))
+    else:
+        _write_file_atomically(os.path.realpath(fname), text)
+    return history_fname
@@ -1,5 +1,6 @@
 import sbws.core.cleanup
 import sbws.core.scanner
+import sbws.core.service
 import sbws.core.generate
 import sbws.core.init
 import sbws.core.stats
@@ -36,6 +37,8 @@ def main():
                     'a': def_args, 'kw': def_kwargs},
         'scanner': {'f': sbws.core.scanner.main,
                     'a': def_args, 'kw': def_kwargs},
+        'service': {'f': sbws.core.service.main,
+                    'a': def_args, 'kw': def_kwargs},
         'generate': {'f': sbws.core.generate.main,
                      'a': def_args, 'kw': def_kwargs},
         'init': {'f': sbws.core.init.main,
@@ -0,0 +1,204 @@
+''' Just enough of a SOCKS5 client and an HTTP/1.1 client on top of asyncio
+streams for the asyncio measurement engine to make HEAD and range GET requests
+through Tor.
+
+This module needs Python 3.5 or newer. Nothing imports it unless the asyncio
+engine was asked for. '''
+import asyncio
+import ipaddress
+import socket
+import ssl
+import struct
+import logging
+from sbws.globals import DOWNLOAD_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+_SOCKS_VERSION = 5
+_SOCKS_NO_AUTH = 0
+_SOCKS_CMD_CONNECT = 1
+_SOCKS_ATYP_IPV4 = 1
+_SOCKS_ATYP_DOMAIN = 3
+_SOCKS_ATYP_IPV6 = 4
+
+
+class AsyncHTTPError(Exception):
+    ''' Something went wrong while talking SOCKS or HTTP. The message says
+    what. '''
+    pass
+
+
+class HTTPResponse:
+    ''' The parts of an HTTP response we care about. The body is never kept.
+    '''
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+async def _sock_recv_exactly(loop, sock, num_bytes):
+    data = b''
+    while len(data) < num_bytes:
+        chunk = await loop.sock_recv(sock, num_bytes - len(data))
+        if not chunk:
+            raise AsyncHTTPError('SOCKS server closed the connection')
+        data += chunk
+    return data
+
+
+async def socks_tcp_connect(loop, socks_addr):
+    ''' Open a TCP connection to the SOCKS server at the (address, port) tuple
+    **socks_addr** and return the non-blocking socket. Callers use
+    getsockname() on it to learn the source port Tor will see before telling
+    Tor where to connect with **socks_connect**. '''
+    host, port = socks_addr
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, (host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+async def socks_connect(loop, sock, host, port):
+    ''' Ask the SOCKS5 server on the other end of **sock** to connect us to
+    **host**:**port**. The hostname is sent as is so that the exit resolves
+    it. '''
+    await loop.sock_sendall(
+        sock, bytes([_SOCKS_VERSION, 1, _SOCKS_NO_AUTH]))
+    version, method = await _sock_recv_exactly(loop, sock, 2)
+    if version != _SOCKS_VERSION or method != _SOCKS_NO_AUTH:
+        raise AsyncHTTPError('SOCKS server refused our auth method')
+    host_bytes = host.encode('idna')
+    request = bytes([_SOCKS_VERSION, _SOCKS_CMD_CONNECT, 0,
+                     _SOCKS_ATYP_DOMAIN, len(host_bytes)]) + \
+        host_bytes + struct.pack('!H', port)
+    await loop.sock_sendall(sock, request)
+    version, reply, _, atyp = await _sock_recv_exactly(loop, sock, 4)
+    if version != _SOCKS_VERSION:
+        raise AsyncHTTPError('Got a non-SOCKS5 reply from the SOCKS server')
+    if reply != 0:
+        raise AsyncHTTPError(
+            'SOCKS server could not connect to {}:{} (reply {})'.format(
+                host, port, reply))
+    if atyp == _SOCKS_ATYP_IPV4:
+        await _sock_recv_exactly(loop, sock, 4 + 2)
+    elif atyp == _SOCKS_ATYP_IPV6:
+        await _sock_recv_exactly(loop, sock, 16 + 2)
+    elif atyp == _SOCKS_ATYP_DOMAIN:
+        length, = await _sock_recv_exactly(loop, sock, 1)
+        await _sock_recv_exactly(loop, sock, length + 2)
+    else:
+        raise AsyncHTTPError('Unknown address type {} in SOCKS reply'.format(
+            atyp))
+
+
+def _is_ip_address(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+class AsyncHTTPConnection:
+    ''' A persistent HTTP/1.1 connection to one host over an already
+    established SOCKS connection. Every request uses the same stream, just
+    like a requests Session does. '''
+    def __init__(self, reader, writer, hostname, timeout):
+        self._reader = reader
+        self._writer = writer
+        self._hostname = hostname
+        self._timeout = timeout
+
+    @staticmethod
+    async def open(loop, sock, url, timeout):
+        ''' Wrap the connected SOCKS socket **sock** in asyncio streams, doing
+        TLS first if **url** is https. **url** is a parsed url. '''
+        ssl_ctx = None
+        server_hostname = None
+        if url.scheme == 'https':
+            ssl_ctx = ssl.create_default_context()
+            if not _is_ip_address(url.hostname):
+                server_hostname = url.hostname
+            else:
+                ssl_ctx.check_hostname = False
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            sock=sock, ssl=ssl_ctx, server_hostname=server_hostname),
+            timeout)
+        return AsyncHTTPConnection(reader, writer, url.netloc, timeout)
+
+    def close(self):
+        self._writer.close()
+
+    async def _wait(self, awaitable):
+        ''' Wait for one read or write, for at most the timeout '''
+        return await asyncio.wait_for(awaitable, self._timeout)
+
+    async def _read_head(self):
+        status_line = await self._wait(self._reader.readline())
+        if not status_line:
+            raise AsyncHTTPError('Connection closed before a response')
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise AsyncHTTPError('Bad status line {}'.format(status_line))
+        status_code = int(parts[1])
+        headers = {}
+        while True:
+            line = await self._wait(self._reader.readline())
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return HTTPResponse(status_code, headers)
+
+    async def _discard(self, num_bytes):
+        while num_bytes > 0:
+            chunk = await self._wait(self._reader.read(
+                min(num_bytes, DOWNLOAD_CHUNK_SIZE)))
+            if not chunk:
+                raise AsyncHTTPError('Connection closed in the middle of the '
+                                     'response body')
+            num_bytes -= len(chunk)
+
+    async def _discard_chunked(self):
+        while True:
+            size_line = await self._wait(self._reader.readline())
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Trailers, if any, and the final empty line
+                while (await self._wait(self._reader.readline())).strip():
+                    pass
+                return
+            await self._discard(size + 2)
+
+    async def _request(self, method, path, headers):
+        lines = ['{} {} HTTP/1.1'.format(method, path),
+                 'Host: {}'.format(self._hostname),
+                 'Connection: keep-alive']
+        lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self._wait(self._writer.drain())
+        resp = await self._read_head()
+        if method == 'HEAD':
+            return resp
+        if resp.headers.get('transfer-encoding', '').lower() == 'chunked':
+            await self._discard_chunked()
+        elif 'content-length' in resp.headers:
+            await self._discard(int(resp.headers['content-length']))
+        else:
+            raise AsyncHTTPError('Response has neither Content-Length nor '
+                                 'chunked Transfer-Encoding')
+        return resp
+
+    async def request(self, method, path, headers=None):
+        ''' Send a request and read (and throw away) the response body.
+        Return an **HTTPResponse**. Raises asyncio.TimeoutError if the server
+        doesn't send anything for longer than the timeout. A long download
+        that keeps making progress is not cut short, so its time can still be
+        used to pick the next download size. '''
+        return await self._request(method, path, headers or {})
@@ -100,6 +100,7 @@ def validate_config(conf):
     errors = []
     errors.extend(_validate_general(conf))
     errors.extend(_validate_cleanup(conf))
+    errors.extend(_validate_generate(conf))
     errors.extend(_validate_scanner(conf))
     errors.extend(_validate_tor(conf))
     errors.extend(_validate_paths(conf))
@@ -115,6 +116,20 @@ def _validate_cleanup(conf):
     ints = {
         'stale_days': {'minimum': 1, 'maximum': None},
         'rotten_days': {'minimum': 1, 'maximum': None},
+        'interval': {'minimum': 1, 'maximum': None},
+    }
+    all_valid_keys = list(ints.keys())
+    errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
+    errors.extend(_validate_section_ints(conf, sec, ints, err_tmpl))
+    return errors
+
+
+def _validate_generate(conf):
+    errors = []
+    sec = 'generate'
+    err_tmpl = Template('$sec/$key ($val): $e')
+    ints = {
+        'publish_interval': {'minimum': 1, 'maximum': None},
     }
     all_valid_keys = list(ints.keys())
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
@@ -129,14 +144,21 @@ def _validate_general(conf):
     ints = {
         'data_period': {'minimum': 1, 'maximum': None},
         'circuit_timeout': {'minimum': 1, 'maximum': None},
+        'load_processes': {'minimum': 1, 'maximum': None},
+        'quantile_sketch_k': {'minimum': 0, 'maximum': None},
     }
     floats = {
         'http_timeout': {'minimum': 0.0, 'maximum': None},
     }
-    all_valid_keys = list(ints.keys()) + list(floats.keys())
+    choices = {
+        'result_store': ['files', 'sqlite'],
+    }
+    all_valid_keys = list(ints.keys()) + list(floats.keys()) + \
+        list(choices.keys())
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
     errors.extend(_validate_section_ints(conf, sec, ints, err_tmpl))
     errors.extend(_validate_section_floats(conf, sec, floats, err_tmpl))
+    errors.extend(_validate_section_choices(conf, sec, choices, err_tmpl))
     return errors
 
 
@@ -146,7 +168,7 @@ def _validate_paths(conf):
     err_tmpl = Template('$sec/$key ($val): $e')
     unvalidated_keys = [
         'datadir', 'sbws_home', 'v3bw_fname', 'tor_control_socket',
-        'started_filepath']
+        'started_filepath', 'v3bw_history_dname']
     all_valid_keys = unvalidated_keys
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
     return errors
@@ -163,18 +185,33 @@ def _validate_scanner(conf):
         'measurement_threads': {'minimum': 1, 'maximum': None},
         'min_download_size': {'minimum': 1, 'maximum': None},
         'max_download_size': {'minimum': 1, 'maximum': None},
+        'asyncio_measurements': {'minimum': 1, 'maximum': None},
+        'result_batch_size': {'minimum': 1, 'maximum': None},
+        'result_snapshot_interval': {'minimum': 0, 'maximum': None},
+        'helper_exit_widen_steps': {'minimum': 0, 'maximum': None},
+    }
+    choices = {
+        'engine': ['threads', 'asyncio'],
     }
     floats = {
         'download_toofast': {'minimum': 0.001, 'maximum': None},
         'download_min': {'minimum': 0.001, 'maximum': None},
         'download_target': {'minimum': 0.001, 'maximum': None},
         'download_max': {'minimum': 0.001, 'maximum': None},
+        'result_batch_age': {'minimum': 0.0, 'maximum': None},
+        'helper_exit_widen_factor': {'minimum': 1.0, 'maximum': None},
+    }
+    bools = {
+        'result_fsync': {},
     }
     all_valid_keys = list(ints.keys()) + list(floats.keys()) + \
+        list(choices.keys()) + list(bools.keys()) + \
         ['nickname', 'started_filepath']
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
     errors.extend(_validate_section_ints(conf, sec, ints, err_tmpl))
     errors.extend(_validate_section_floats(conf, sec, floats, err_tmpl))
+    errors.extend(_validate_section_choices(conf, sec, choices, err_tmpl))
+    errors.extend(_validate_section_bools(conf, sec, bools, err_tmpl))
     valid, error_msg = _validate_nickname(conf[sec], 'nickname')
     if not valid:
         errors.append(err_tmpl.substitute(
@@ -331,6 +368,17 @@ def _validate_section_bools(conf, sec, bools, tmpl):
     return errors
 
 
+def _validate_section_choices(conf, sec, choices, tmpl):
+    errors = []
+    section = conf[sec]
+    for key in choices:
+        valid, error = _validate_choice(section, key, choices[key])
+        if not valid:
+            errors.append(tmpl.substitute(
+                sec=sec, key=key, val=section[key], e=error))
+    return errors
+
+
 def _validate_section_fingerprints(conf, sec, fps, tmpl):
     errors = []
     section = conf[sec]
@@ -390,6 +438,13 @@ def _validate_boolean(section, key):
     return True, ''
 
 
+def _validate_choice(section, key, choices):
+    value = section[key]
+    if value not in choices:
+        return False, 'Must be one of {}'.format(', '.join(choices))
+    return True, ''
+
+
 def _validate_float(section, key, minimum=None, maximum=None):
     try:
         value = section.getfloat(key)
@@ -1,5 +1,6 @@
 import sbws.core.cleanup
 import sbws.core.scanner
+import sbws.core.service
 import sbws.core.generate
 import sbws.core.init
 import sbws.core.stats
@@ -27,6 +28,7 @@ def create_parser():
     sub = p.add_subparsers(dest='command')
     sbws.core.cleanup.gen_parser(sub)
     sbws.core.scanner.gen_parser(sub)
+    sbws.core.service.gen_parser(sub)
     sbws.core.generate.gen_parser(sub)
     sbws.core.init.gen_parser(sub)
     sbws.core.stats.gen_parser(sub)
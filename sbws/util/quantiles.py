@@ -0,0 +1,140 @@
+''' A KLL quantile sketch: approximate quantiles of a stream of numbers in
+bounded memory.
+
+See Karnin, Lang and Liberty, "Optimal Quantile Approximation in Streams"
+(2016). The sketch keeps a stack of compactors. Items in the compactor at
+height h each stand for 2**h of the items that were added. When the sketch
+gets too big, the lowest full compactor is sorted and every other item of it
+moves up a height. With parameter k, the rank of a returned quantile is off by
+about 1.7/k of the number of items at most, with high probability, and the
+sketch keeps about 3k items no matter how many are added.
+
+Sketches of different parts of the data, for example of different result
+files parsed by different processes, can be merged into a sketch of all of it.
+'''
+from bisect import bisect_left
+from itertools import accumulate
+from math import ceil
+from random import Random
+from statistics import median
+
+
+class KLLSketch:
+    ''' Approximate quantiles of the numbers given to update() and merge().
+
+    Until the sketch first compacts (about k numbers), it still has every
+    number, and quantiles and the median are exact.
+
+    :param int k: accuracy parameter. Bigger is more accurate and uses more
+        memory.
+    :param int seed: seed for the coin flips made when compacting, so the
+        same numbers in the same order always give the same sketch
+    '''
+    # Each compactor below the top one can hold this much less than the one
+    # above it
+    _C = 2 / 3
+
+    def __init__(self, k=200, seed=0):
+        assert k >= 8
+        self.k = k
+        self.count = 0
+        self._compactors = [[]]
+        self._size = 0
+        self._max_size = 0
+        self._rng = Random(seed)
+        self._update_max_size()
+
+    def __len__(self):
+        return self.count
+
+    def _capacity(self, height):
+        depth = len(self._compactors) - height - 1
+        return int(ceil(self._C ** depth * self.k)) + 1
+
+    def _update_max_size(self):
+        self._max_size = sum([self._capacity(h)
+                              for h in range(0, len(self._compactors))])
+
+    def _grow(self):
+        self._compactors.append([])
+        self._update_max_size()
+
+    def _compact(self, height):
+        ''' Move every other item of the compactor at **height** up one
+        height, starting with the first or the second one by coin flip '''
+        items = self._compactors[height]
+        items.sort()
+        if height + 1 == len(self._compactors):
+            self._grow()
+        # An odd one out stays where it is
+        keep = [items.pop()] if len(items) % 2 else []
+        offset = self._rng.randint(0, 1)
+        self._compactors[height + 1].extend(items[offset::2])
+        self._size -= len(items) - len(items) // 2
+        self._compactors[height] = keep
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for height, items in enumerate(self._compactors):
+                if len(items) >= self._capacity(height):
+                    self._compact(height)
+                    break
+            else:
+                break
+
+    def add(self, value):
+        self._compactors[0].append(value)
+        self._size += 1
+        self.count += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        ''' Add everything the KLLSketch **other** has seen to this sketch '''
+        assert isinstance(other, KLLSketch)
+        while len(self._compactors) < len(other._compactors):
+            self._grow()
+        for height, items in enumerate(other._compactors):
+            self._compactors[height].extend(items)
+            self._size += len(items)
+        self.count += other.count
+        self._compress()
+
+    def _is_exact(self):
+        return len(self._compactors[0]) == self.count
+
+    def _weighted_items(self):
+        items = [(value, 2 ** height)
+                 for height, values in enumerate(self._compactors)
+                 for value in values]
+        items.sort()
+        return items
+
+    def quantile(self, q):
+        ''' Return the value that a fraction **q** of the values are smaller
+        than or equal to. The sketch must not be empty. '''
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        ''' Return quantile(q) for each q in **qs**. The items are only
+        sorted once for all of them. '''
+        assert all([0 <= q <= 1 for q in qs])
+        assert self.count > 0
+        items = self._weighted_items()
+        # How many values are smaller than or equal to each item
+        ranks = list(accumulate([weight for _, weight in items]))
+        total = ranks[-1]
+        last = len(items) - 1
+        return [items[min(bisect_left(ranks, q * total), last)][0]
+                for q in qs]
+
+    def median(self):
+        ''' Return the median, the same as statistics.median() would as long
+        as the sketch is still exact '''
+        if self._is_exact():
+            return median(self._compactors[0])
+        return self.quantile(0.5)
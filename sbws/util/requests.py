@@ -4,15 +4,29 @@ import sbws.util.stem as stem_utils
 
 def make_session(controller, timeout):
     s = requests.Session()
-    socks_info = stem_utils.get_socks_info(controller)
-    s.proxies = {
-        'http': 'socks5h://{}:{}'.format(*socks_info),
-        'https': 'socks5h://{}:{}'.format(*socks_info),
-    }
+    s.sbws_socks_info = stem_utils.get_socks_info(controller)
+    set_socks_username(s, None)
     s.sbws_timeout = timeout
     return s
 
 
+def set_socks_username(s, username):
+    ''' Make the session **s** open its streams with the SOCKS **username**,
+    or without one if it is None. Tor never puts streams with different
+    usernames on the same circuit, and sbws uses them to know which circuit a
+    new stream is for. '''
+    if username is None:
+        auth = ''
+    else:
+        # Tor needs a password too, but doesn't care what it is
+        auth = '{}:sbws@'.format(username)
+    url = 'socks5h://{}{}:{}'.format(auth, *s.sbws_socks_info)
+    s.proxies = {
+        'http': url,
+        'https': url,
+    }
+
+
 def get(s, url, **kw):
     return s.get(url, timeout=s.sbws_timeout, **kw)
 
@@ -1,10 +1,11 @@
-from stem.control import (Controller, Listener)
+from stem.control import (Controller, Listener, EventType)
 from stem import (SocketError, InvalidRequest, UnsatisfiableRequest)
 from stem.connection import IncorrectSocketType
 import stem.process
 from stem.descriptor.router_status_entry import RouterStatusEntryV3
+from stem.version import Version
 from configparser import ConfigParser
-from threading import RLock
+from threading import Lock
 import copy
 import logging
 import os
@@ -12,7 +13,6 @@ from sbws.globals import fail_hard
 from sbws.globals import TORRC_STARTING_POINT
 
 log = logging.getLogger(__name__)
-stream_building_lock = RLock()
 
 
 def fp_or_nick_to_relay(controller, fp_nick):
@@ -26,23 +26,98 @@ def fp_or_nick_to_relay(controller, fp_nick):
     return controller.get_network_status(fp_nick, default=None)
 
 
-def attach_stream_to_circuit_listener(controller, circ_id):
-    ''' Returns a function that should be given to add_event_listener(). It
-    looks for newly created streams and attaches them to the given circ_id '''
+class StreamAttacher:
+    ''' A single, long-lived STREAM event listener that attaches new streams
+    to the circuit registered for them. A stream is recognized either by the
+    SOCKS source port it came from or by the SOCKS username it was opened
+    with, so any number of streams can be opened at the same time.
+
+    Use :func:`stream_attacher` to get the one of a controller.
+
+    >>> attacher = stream_attacher(controller)
+    >>> attacher.register_socks_username(username, circ_id)
+    >>> # open streams with username
+    >>> attacher.unregister_socks_username(username)
+
+    Recognizing streams by SOCKS username needs a tor that reports them in
+    STREAM events. See :func:`reports_socks_usernames`.
+    '''
+    def __init__(self, controller):
+        self._controller = controller
+        self._circ_for_port = {}
+        self._circ_for_username = {}
+        self._lock = Lock()
+        add_event_listener(controller, self._listener, EventType.STREAM)
+
+    def register_source_port(self, source_port, circ_id):
+        with self._lock:
+            self._circ_for_port[source_port] = circ_id
+
+    def unregister_source_port(self, source_port):
+        with self._lock:
+            self._circ_for_port.pop(source_port, None)
+
+    def register_socks_username(self, username, circ_id):
+        with self._lock:
+            self._circ_for_username[username] = circ_id
+
+    def unregister_socks_username(self, username):
+        with self._lock:
+            self._circ_for_username.pop(username, None)
+
+    def close(self):
+        remove_event_listener(self._controller, self._listener)
+
+    def _circuit_for_stream(self, st):
+        username = st.keyword_args.get('SOCKS_USERNAME')
+        with self._lock:
+            if username is not None and username in self._circ_for_username:
+                return self._circ_for_username[username]
+            return self._circ_for_port.get(st.source_port)
+
+    def _listener(self, st):
+        if st.status != 'NEW' or st.purpose != 'USER':
+            return
+        circ_id = self._circuit_for_stream(st)
+        if circ_id is None:
+            return
+        log.debug('Attaching stream %s to circ %s', st.id, circ_id)
+        try:
+            self._controller.attach_stream(st.id, circ_id)
+        except (UnsatisfiableRequest, InvalidRequest) as e:
+            log.warning('Couldn\'t attach stream to circ %s: %s', circ_id, e)
+
+
+_stream_attacher_lock = Lock()
+
+
+def stream_attacher(controller):
+    ''' Return the StreamAttacher of **controller**, starting it the first
+    time '''
+    with _stream_attacher_lock:
+        # Kept on the controller so it goes away with it
+        attacher = getattr(controller, '_sbws_stream_attacher', None)
+        if attacher is None:
+            attacher = StreamAttacher(controller)
+            controller._sbws_stream_attacher = attacher
+        return attacher
+
+
+# The first tor that gives the SOCKS username of new streams in STREAM events
+SOCKS_USERNAME_IN_STREAM_EVENTS = Version('0.4.3.1-alpha')
+
+
+def reports_socks_usernames(controller):
+    ''' Return whether the tor of **controller** gives the SOCKS username of
+    new streams in STREAM events. Without them, the streams sbws opens with
+    Requests can't be attached to their circuits and just time out. '''
     assert is_controller_okay(controller)
+    return controller.get_version() >= SOCKS_USERNAME_IN_STREAM_EVENTS
 
-    def closure_stream_event_listener(st):
-        if st.status == 'NEW' and st.purpose == 'USER':
-            log.debug('Attaching stream %s to circ %s %s', st.id, circ_id,
-                      circuit_str(controller, circ_id))
-            try:
-                controller.attach_stream(st.id, circ_id)
-            except (UnsatisfiableRequest, InvalidRequest) as e:
-                log.warning('Couldn\'t attach stream to circ %s: %s',
-                            circ_id, e)
-        else:
-            pass
-    return closure_stream_event_listener
+
+def circuit_socks_username(circ_id):
+    ''' The SOCKS username to open the streams meant for **circ_id** with '''
+    return 'sbws-circ-{}'.format(circ_id)
 
 
 def add_event_listener(controller, func, event):
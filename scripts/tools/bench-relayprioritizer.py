@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# File: bench-relayprioritizer.py
+# Copyright/License: CC0
+'''
+Time RelayPrioritizer.best_priority() and measure how much memory it
+allocates on a synthetic consensus, without needing Tor or a datadir.
+'''
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from threading import RLock
+from unittest.mock import MagicMock
+from sbws.lib.relaylist import RelayList
+from sbws.lib.relaylist import RelaySnapshot
+from sbws.lib.relaylist import RelayTable
+from sbws.lib.relayprioritizer import RelayPrioritizer
+from sbws.lib.resultdump import ResultDump
+from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import ResultErrorCircuit
+from stem import Flag
+import random
+import time
+import tracemalloc
+
+
+class FakeRelay:
+    ''' Just enough of a stem RouterStatusEntryV3 '''
+    def __init__(self, i, flags):
+        self.fingerprint = '{:040X}'.format(i)
+        self.nickname = 'relay{}'.format(i)
+        self.address = '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255,
+                                            i & 255)
+        self.flags = flags
+        self.bandwidth = random.randint(1, 100000)
+
+
+class FakeRelayList(RelayList):
+    ''' A RelayList that never talks to Tor '''
+    def __init__(self, relays):
+        self._snapshot = RelaySnapshot(RelayTable(relays), {}, {})
+        self._last_refresh = float('inf')
+
+
+class FakeResultDump(ResultDump):
+    ''' A ResultDump without its thread or datadir '''
+    def __init__(self, fresh_days):
+        self.fresh_days = fresh_days
+        self.data = {}
+        self._summaries = {}
+        self.data_lock = RLock()
+
+
+def make_relays(num_relays, num_authorities):
+    relays = []
+    for i in range(0, num_relays):
+        flags = [Flag.FAST, Flag.RUNNING, Flag.VALID]
+        if i < num_authorities:
+            flags.append(Flag.AUTHORITY)
+        if random.random() < 0.15:
+            flags.append(Flag.EXIT)
+        relays.append(FakeRelay(i, flags))
+    return relays
+
+
+def make_result_dump(relays, results_per_relay, fresh_days):
+    rd = FakeResultDump(fresh_days)
+    now = time.time()
+    circ = ['A' * 40, 'B' * 40]
+    dest_url = 'http://example.com/sbws.bin'
+    for relay in relays:
+        for _ in range(0, results_per_relay):
+            t = now - random.random() * fresh_days * 24*60*60
+            if random.random() < 0.1:
+                r = ResultErrorCircuit(relay, circ, dest_url, 'bench',
+                                       msg='bench', t=t)
+            else:
+                r = ResultSuccess([0.5], [{'duration': 6, 'amount': 1000}],
+                                  relay, circ, dest_url, 'bench', t=t)
+            rd.data.setdefault(relay.fingerprint, []).append(r)
+    rd._index_data()
+    return rd
+
+
+def make_conf(fresh_days, fraction, min_relays):
+    conf = MagicMock()
+    values = {
+        ('general', 'data_period'): fresh_days,
+        ('relayprioritizer', 'min_relays'): min_relays,
+        ('relayprioritizer', 'fraction_relays'): fraction,
+        ('relayprioritizer', 'measure_authorities'): False,
+    }
+    conf.getint.side_effect = lambda sec, key: values[(sec, key)]
+    conf.getfloat.side_effect = lambda sec, key: values[(sec, key)]
+    conf.getboolean.side_effect = lambda sec, key: values[(sec, key)]
+    return conf
+
+
+def main(args):
+    random.seed(args.seed)
+    relays = make_relays(args.relays, args.authorities)
+    rd = make_result_dump(relays, args.results_per_relay, args.data_period)
+    rp = RelayPrioritizer(
+        None, make_conf(args.data_period, args.fraction_relays, 50),
+        FakeRelayList(relays), rd)
+    times = []
+    for _ in range(0, args.passes):
+        start = time.perf_counter()
+        for _ in rp.best_priority():
+            pass
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for _ in rp.best_priority():
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{} relays, {} results per relay'.format(
+        args.relays, args.results_per_relay))
+    print('best_priority(): min {:.2f} ms, mean {:.2f} ms over {} '
+          'passes'.format(min(times) * 1000, sum(times) / len(times) * 1000,
+                          args.passes))
+    print('Peak memory allocated during one pass: {:.1f} KiB'.format(
+        peak / 1024))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--relays', type=int, default=7000,
+                        help='Number of relays in the synthetic consensus')
+    parser.add_argument('--authorities', type=int, default=9,
+                        help='How many of them are authorities')
+    parser.add_argument('--results-per-relay', type=int, default=5)
+    parser.add_argument('--data-period', type=int, default=5,
+                        help='Days results stay fresh')
+    parser.add_argument('--fraction-relays', type=float, default=0.05)
+    parser.add_argument('--passes', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args)
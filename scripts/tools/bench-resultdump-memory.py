@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# File: bench-resultdump-memory.py
+# Copyright/License: CC0
+'''
+Measure how much memory the Results ResultDump keeps in memory take. Writes a
+synthetic datadir with results for a full network, loads it the way
+ResultDump does when the scanner starts, and prints the process' resident set
+size before and after. Run it on two versions of sbws to compare them.
+'''
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from sbws.lib.resultdump import Result
+from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import ResultErrorCircuit
+from sbws.lib.resultdump import load_recent_results_in_datadir
+from sbws.lib.resultdump import write_results_to_datadir
+from tempfile import TemporaryDirectory
+import gc
+import random
+import resource
+import time
+
+
+def rss_kib():
+    ''' The current resident set size in KiB, or the maximum one if the
+    current one isn't available '''
+    try:
+        with open('/proc/self/status', 'rt') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_datadir(datadir, num_relays, results_per_relay, fresh_days):
+    now = time.time()
+    dest_url = 'https://example.com/sbws.bin'
+    relays = [Result.Relay('{:040X}'.format(i), 'relay{}'.format(i),
+                           '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255,
+                                                i & 255))
+              for i in range(0, num_relays)]
+    for relay in relays:
+        results = []
+        for _ in range(0, results_per_relay):
+            circ = [relay.fingerprint, random.choice(relays).fingerprint]
+            t = now - random.random() * fresh_days * 24*60*60
+            if random.random() < 0.1:
+                results.append(ResultErrorCircuit(
+                    relay, circ, dest_url, 'bench', msg='bench', t=t))
+            else:
+                results.append(ResultSuccess(
+                    [random.random() for _ in range(0, 10)],
+                    [{'duration': random.uniform(5, 10),
+                      'amount': random.randint(1, 2**30)}
+                     for _ in range(0, 5)],
+                    relay, circ, dest_url, 'bench', t=t))
+        write_results_to_datadir(results, datadir)
+
+
+def main(args):
+    random.seed(args.seed)
+    with TemporaryDirectory() as datadir:
+        write_datadir(datadir, args.relays, args.results_per_relay,
+                      args.data_period)
+        gc.collect()
+        before = rss_kib()
+        results = load_recent_results_in_datadir(args.data_period, datadir)
+        gc.collect()
+        after = rss_kib()
+        num_results = sum([len(results[fp]) for fp in results])
+    print('{} relays, {} results'.format(len(results), num_results))
+    print('RSS before loading: {} KiB'.format(before))
+    print('RSS after loading: {} KiB'.format(after))
+    print('{:.0f} bytes per result'.format(
+        (after - before) * 1024 / num_results))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--relays', type=int, default=7000,
+                        help='Number of relays in the synthetic network')
+    parser.add_argument('--results-per-relay', type=int, default=25)
+    parser.add_argument('--data-period', type=int, default=5,
+                        help='Days results stay fresh')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args)
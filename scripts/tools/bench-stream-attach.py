@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# File: bench-stream-attach.py
+# Copyright/License: CC0
+'''
+Measure how many streams the scanner's measurement threads can open at once.
+Each thread calls connect_to_destination_over_circuit() against a fake
+controller and a fake HEAD request that opens a stream, waits for it to be
+attached and then takes --latency seconds, like a round trip over Tor would.
+
+With --serialized, each call holds one global lock, the way every stream used
+to be opened one at a time. Compare the two.
+'''
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from threading import Lock
+from urllib.parse import urlparse
+from sbws.lib.destination import Destination
+from sbws.lib.destination import connect_to_destination_over_circuit
+import sbws.util.requests as requests_utils
+import stem.response
+import itertools
+import time
+
+
+class FakeController:
+    def __init__(self):
+        self._listeners = []
+        self._attached = {}
+        self._lock = Lock()
+        self._stream_ids = itertools.count()
+
+    def is_alive(self):
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def get_listeners(self, listener_type):
+        return [('127.0.0.1', 9050)]
+
+    def add_event_listener(self, func, event):
+        with self._lock:
+            self._listeners.append(func)
+
+    def remove_event_listener(self, func):
+        with self._lock:
+            self._listeners.remove(func)
+
+    def attach_stream(self, stream_id, circ_id):
+        self._attached[stream_id].set()
+
+    def open_stream(self, username):
+        ''' Emit a STREAM NEW event and return whether it was attached '''
+        stream_id = str(next(self._stream_ids))
+        self._attached[stream_id] = Event()
+        event = stem.response.ControlMessage.from_str(
+            '650 STREAM {} NEW 0 example.com:443 SOURCE_ADDR=127.0.0.1:1 '
+            'PURPOSE=USER SOCKS_USERNAME="{}" SOCKS_PASSWORD="sbws"\r\n'
+            .format(stream_id, username), 'EVENT')
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(event)
+        return self._attached.pop(stream_id).is_set()
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {'content-length': str(2**30)}
+
+
+def fake_head(cont, latency):
+    def head(s, url, **kw):
+        username = urlparse(s.proxies['https']).username
+        assert cont.open_stream(username)
+        time.sleep(latency)
+        return FakeResponse()
+    return head
+
+
+def main(args):
+    cont = FakeController()
+    requests_utils.head = fake_head(cont, args.latency)
+    dest = Destination('https://example.com/sbws.bin', '/sbws.bin', 1)
+    lock = Lock()
+
+    def connect(circ_id):
+        s = requests_utils.make_session(cont, 10)
+        if args.serialized:
+            with lock:
+                ok, _ = connect_to_destination_over_circuit(
+                    dest, str(circ_id), s, cont, 1)
+        else:
+            ok, _ = connect_to_destination_over_circuit(
+                dest, str(circ_id), s, cont, 1)
+        assert ok
+
+    start = time.time()
+    with ThreadPoolExecutor(args.threads) as executor:
+        list(executor.map(connect, range(0, args.streams)))
+    duration = time.time() - start
+    print('{} streams with {} threads in {:.2f} seconds: {:.1f} streams/s'
+          .format(args.streams, args.threads, duration,
+                  args.streams / duration))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=10,
+                        help='Like scanner.measurement_threads')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Seconds each HEAD takes')
+    parser.add_argument('--serialized', action='store_true',
+                        help='Open the streams one at a time')
+    args = parser.parse_args()
+    main(args)
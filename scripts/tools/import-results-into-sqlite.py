@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# File: import-results-into-sqlite.py
+# Copyright/License: CC0
+'''
+Import the .txt and .txt.gz result files in an sbws datadir into the
+datadir's SQLite result store so that sbws can be switched to
+general.result_store = sqlite without losing results. Only the results added
+to the files since the last import are imported, so it is safe to run this
+more than once.
+'''
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from sbws.lib.resultstore import SQLiteResultStore
+from sbws.lib.resultstore import import_result_files
+from sbws.lib.resultstore import results_db_fname
+from sbws.util.config import get_config
+from sbws.util.parser import _default_dot_sbws_dname
+import logging
+import os
+import sys
+
+
+def fail_hard(*s):
+    print(*s, file=sys.stderr)
+    exit(1)
+
+
+def main(args):
+    conf = get_config(args)
+    datadir = conf['paths']['datadir']
+    if not os.path.isdir(datadir):
+        fail_hard(datadir, 'does not exist')
+    store = SQLiteResultStore(results_db_fname(datadir))
+    num = import_result_files(store, datadir)
+    print('Imported {} results into {}'.format(num, results_db_fname(datadir)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--directory', default=_default_dot_sbws_dname(),
+                        help='Name of the .sbws directory')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    main(args)
@@ -5,6 +5,10 @@
 from collections import OrderedDict
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
 import sys
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def fail_hard(*s):
@@ -55,15 +59,21 @@ def main(args):
     # should give ourselves based on the number of relays in the v3bw file (AKA
     # the total output weight) divided by the total input weight
     ratio = (len(line_dicts) * args.budget_per_relay) / total_input_weight
-    for d in line_dicts:
-        d['bw'] = round(d['bw'] * ratio)
-        # Accumulate all the parts of the line back together
-        s = ''
-        for key in d:
-            s += '{}={} '.format(key, d[key])
-        # Remove trailing ' ' and replace with '\n'
-        s = s.rstrip() + '\n'
-        args.output.write(s)
+    bws = [d['bw'] for d in line_dicts]
+    if np is not None:
+        # Scale them all at once. rint() rounds halves to even like round()
+        bws = np.rint(np.array(bws, dtype=np.float64) * ratio)\
+            .astype(np.int64).tolist()
+    else:
+        bws = [round(bw * ratio) for bw in bws]
+    # Accumulate all the parts of the lines back together and write them at
+    # once
+    out = []
+    for d, bw in zip(line_dicts, bws):
+        d['bw'] = bw
+        out.append(' '.join(['{}={}'.format(key, d[key]) for key in d]))
+        out.append('\n')
+    args.output.write(''.join(out))
 
 
 def gen_parser():
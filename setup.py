@@ -83,5 +83,8 @@ setup(
         'test': ['tox', 'pytest', 'coverage'],
         # recommonmark: to make sphinx render markdown
         'doc': ['sphinx', 'recommonmark'],
+        # orjson: to read result files faster
+        # numpy: to compute the v3bw lines of all relays at once
+        'fast': ['orjson', 'numpy'],
     },
 )
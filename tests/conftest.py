@@ -8,10 +8,17 @@ import sbws.core.init
 from tempfile import TemporaryDirectory
 import pytest
 import os
+import sys
 import time
 import argparse
 
 
+# The asyncio engine and its tests need Python 3.5 or newer
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore = ['lib/test_asyncengine.py', 'util/test_asyncio_http.py']
+
+
 class _PseudoArguments(argparse.Namespace):
     '''
     Just enough of the argparse.Namespace (what you get when you do
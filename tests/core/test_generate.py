@@ -1,9 +1,13 @@
 import sbws.core.generate
 from sbws.util.config import get_config
 from sbws.lib.resultdump import load_recent_results_in_datadir
+from sbws.lib.resultdump import Result
 from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import write_result_to_datadir
 from statistics import median
+from threading import Event
 import logging
+import os
 
 log = logging.getLogger(__name__)
 
@@ -257,3 +261,114 @@ def test_generate_two_relays_success_noscale(
     bw_line = 'node_id=${} bw={} nick={} rtt={} time={}'.format(
         r2_fingerprint, r2_speed, r2_name, r2_rtt, r2_time)
     assert stdout_lines[NUM_LINES_HEADER] == bw_line
+
+
+def test_generate_incremental(dotsbws_success_result_two_relays, parser,
+                              capfd):
+    dotsbws = dotsbws_success_result_two_relays
+    outputs = []
+    for flags in ['', '--incremental', '--incremental']:
+        args = parser.parse_args(
+            '-d {} --log-level DEBUG generate --output /dev/stdout {}'
+            .format(dotsbws.name, flags).split())
+        conf = get_config(args)
+        sbws.core.generate.main(args, conf)
+        captured = capfd.readouterr()
+        # Skip the header, since it has the time it was generated
+        outputs.append(captured.out.strip().split('\n')[NUM_LINES_HEADER:])
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_generate_quantile_sketch(dotsbws_success_result_two_relays, parser,
+                                  capfd):
+    dotsbws = dotsbws_success_result_two_relays
+    outputs = []
+    for sketch_k in ['0', '100']:
+        args = parser.parse_args(
+            '-d {} --log-level DEBUG generate --output /dev/stdout'
+            .format(dotsbws.name).split())
+        conf = get_config(args)
+        conf['general']['quantile_sketch_k'] = sketch_k
+        sbws.core.generate.main(args, conf)
+        captured = capfd.readouterr()
+        outputs.append(captured.out.strip().split('\n')[NUM_LINES_HEADER:])
+    # With this few results the sketch still has all of them
+    assert outputs[0] == outputs[1]
+
+
+def test_generate_without_numpy(dotsbws_success_result_two_relays, parser,
+                                capfd, monkeypatch):
+    dotsbws = dotsbws_success_result_two_relays
+    outputs = []
+    for numpy in [True, False]:
+        if not numpy:
+            monkeypatch.setattr(sbws.core.generate, 'have_numpy',
+                                lambda: False)
+        args = parser.parse_args(
+            '-d {} --log-level DEBUG generate --output /dev/stdout --scale'
+            .format(dotsbws.name).split())
+        conf = get_config(args)
+        sbws.core.generate.main(args, conf)
+        captured = capfd.readouterr()
+        outputs.append(captured.out.strip().split('\n')[NUM_LINES_HEADER:])
+    assert outputs[0] == outputs[1]
+
+
+def test_generate_daemon(dotsbws_success_result_two_relays, parser, tmpdir):
+    dotsbws = dotsbws_success_result_two_relays
+    output = os.path.join(str(tmpdir), 'v3bw.txt')
+    history_dname = os.path.join(str(tmpdir), 'history')
+
+    def generate_once():
+        args = parser.parse_args(
+            '-d {} --log-level DEBUG generate --output {}'
+            .format(dotsbws.name, output).split())
+        conf = get_config(args)
+        sbws.core.generate.main(args, conf)
+        with open(output, 'rt') as fd:
+            return fd.read().split('\n')[NUM_LINES_HEADER:]
+
+    args = parser.parse_args(
+        '-d {} --log-level DEBUG generate --daemon --output {}'
+        .format(dotsbws.name, output).split())
+    conf = get_config(args)
+    conf['paths']['v3bw_history_dname'] = history_dname
+    daemon = sbws.core.generate.GenerateDaemon(args, conf)
+    assert daemon.run_once()
+    with open(output, 'rt') as fd:
+        from_daemon = fd.read().split('\n')[NUM_LINES_HEADER:]
+    assert from_daemon == generate_once()
+    assert len(os.listdir(history_dname)) == 1
+    # A new result is read by the next run
+    relay = Result.Relay('D' * 40, 'CowSayWhat4', '169.254.100.4')
+    write_result_to_datadir(ResultSuccess(
+        [1, 2], [{'duration': 4, 'amount': 4000*1024}], relay,
+        ['D' * 40, 'C' * 40], '169.254.100.3', 'SBWSscanner'),
+        conf['paths']['datadir'])
+    assert daemon.run_once()
+    with open(output, 'rt') as fd:
+        from_daemon = fd.read().split('\n')[NUM_LINES_HEADER:]
+    assert len(from_daemon) == 4
+    assert from_daemon == generate_once()
+    assert not os.path.exists(output + '.tmp')
+
+
+def test_generate_daemon_keeps_going(dotsbws_success_result, parser,
+                                     monkeypatch):
+    args = parser.parse_args(
+        '-d {} --log-level DEBUG generate --daemon'
+        .format(dotsbws_success_result.name).split())
+    conf = get_config(args)
+    conf['generate']['publish_interval'] = '0'
+    daemon = sbws.core.generate.GenerateDaemon(args, conf)
+    end_event = Event()
+    calls = []
+
+    def run_once():
+        calls.append(None)
+        if len(calls) == 1:
+            raise OSError('Oh no')
+        end_event.set()
+    monkeypatch.setattr(daemon, 'run_once', run_once)
+    daemon.run(end_event)
+    assert len(calls) == 2
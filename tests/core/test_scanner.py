@@ -0,0 +1,176 @@
+from sbws.core.scanner import measure_rtt_to_server
+from sbws.core.scanner import pick_helper_exit
+from sbws.core.scanner import timed_recv_from_server
+from sbws.core.scanner import WorkerSlots
+from sbws.core.scanner import result_putter, result_putter_error
+from sbws.globals import DOWNLOAD_CHUNK_SIZE
+from sbws.lib.destination import Destination
+from configparser import ConfigParser
+from unittest.mock import MagicMock
+import io
+import requests
+import sbws.core.scanner
+import threading
+
+
+class _FakeDestination:
+    url = 'http://example.com/sbws.bin'
+
+
+def _fake_session(body):
+    resp = MagicMock()
+    resp.raw = io.BytesIO(body)
+    resp.__enter__.return_value = resp
+    s = MagicMock()
+    s.sbws_timeout = 10
+    s.get.return_value = resp
+    return s
+
+
+def test_timed_recv_from_server_streams():
+    body = b'A' * (DOWNLOAD_CHUNK_SIZE * 3 + 42)
+    s = _fake_session(body)
+    success, data = timed_recv_from_server(
+        s, _FakeDestination(), 'bytes=0-{}'.format(len(body) - 1))
+    assert success
+    assert data >= 0
+    _, kw = s.get.call_args
+    assert kw['stream'] is True
+    assert kw['headers']['Accept-Encoding'] == 'identity'
+    # Everything was read from the response body
+    assert s.get.return_value.raw.read() == b''
+
+
+def test_timed_recv_from_server_error():
+    s = _fake_session(b'')
+    s.get.side_effect = requests.exceptions.ConnectionError('Oh no')
+    success, data = timed_recv_from_server(s, _FakeDestination(), 'bytes=0-9')
+    assert not success
+    assert isinstance(data, requests.exceptions.ConnectionError)
+
+
+def test_timed_recv_from_server_content_range():
+    s = _fake_session(b'A' * 10)
+    resp = s.get.return_value
+    resp.status_code = 206
+    resp.headers = {'content-range': 'bytes 0-9/100'}
+    dest = _FakeDestination()
+    dest.content_length = 100
+    success, _ = timed_recv_from_server(
+        s, dest, 'bytes=0-9', content_length=100)
+    assert success
+    assert dest.content_length == 100
+    # The content changed since we learned its length
+    resp.headers = {'content-range': 'bytes 0-9/50'}
+    success, data = timed_recv_from_server(
+        s, dest, 'bytes=0-9', content_length=100)
+    assert not success
+    assert '50' in data
+    assert dest.content_length is None
+
+
+def test_measure_rtt_to_server_skips_first_request(monkeypatch):
+    calls = []
+    durations = iter([5.0, 0.1, 0.2, 0.3])
+
+    def fake_timed_recv(session, dest, byte_range, content_length=None):
+        calls.append(content_length)
+        return True, next(durations)
+    monkeypatch.setattr(
+        sbws.core.scanner, 'timed_recv_from_server', fake_timed_recv)
+    conf = ConfigParser()
+    conf.read_dict({'scanner': {'num_rtts': '3', 'min_download_size': '1'}})
+    rtts = measure_rtt_to_server(None, conf, _FakeDestination(), 100)
+    # The first request opened the stream, so it isn't an RTT
+    assert rtts == [0.1, 0.2, 0.3]
+    # Only the first request checks the content length
+    assert calls == [100, None, None, None]
+
+
+def test_worker_slots_initially_free():
+    slots = WorkerSlots(2)
+    assert slots.acquire() is None
+    assert slots.acquire() is None
+
+
+def test_worker_slots_wake_up_on_release():
+    slots = WorkerSlots(1)
+    assert slots.acquire() is None
+    got_slot = threading.Event()
+
+    def waiter():
+        slots.acquire()
+        got_slot.set()
+    t = threading.Thread(target=waiter)
+    t.start()
+    assert not got_slot.wait(0.1)
+    slots.release()
+    assert got_slot.wait(5)
+    t.join()
+
+
+def test_worker_slots_latency():
+    slots = WorkerSlots(1)
+    slots.acquire()
+    slots.release()
+    latency = slots.acquire()
+    assert latency is not None
+    assert latency >= 0
+
+
+def test_result_putters_release_slots():
+    slots = WorkerSlots(2)
+    slots.acquire()
+    slots.acquire()
+    rd = MagicMock()
+    result_putter(rd, slots)(['result'])
+    rd.queue.put.assert_called_once_with(['result'])
+    target = MagicMock()
+    result_putter_error(target, slots)(Exception('Oh no'))
+    assert slots.acquire() is not None
+    assert slots.acquire() is not None
+
+
+def test_worker_slots_in_flight():
+    slots = WorkerSlots(2)
+    slots.acquire('A' * 40)
+    assert slots.is_measuring('A' * 40)
+    assert not slots.is_measuring('B' * 40)
+    target = MagicMock(fingerprint='A' * 40)
+    result_putter(MagicMock(), slots, target)(['result'])
+    assert not slots.is_measuring('A' * 40)
+    slots.acquire('B' * 40)
+    target = MagicMock(fingerprint='B' * 40)
+    result_putter_error(target, slots)(Exception('Oh no'))
+    assert not slots.is_measuring('B' * 40)
+
+
+class _FakeRelayList:
+    ''' Only has exits with a bandwidth of 1000 '''
+    def __init__(self):
+        self.ranges = []
+
+    def random_exit_to(self, host, port, min_bw, max_bw, exclude_fp=None):
+        self.ranges.append((min_bw, max_bw))
+        if min_bw <= 1000 <= max_bw:
+            return 'exit'
+        return None
+
+
+def test_pick_helper_exit_widens_the_range():
+    conf = ConfigParser()
+    conf.read_dict({'scanner': {'helper_exit_widen_steps': '3',
+                                'helper_exit_widen_factor': '2'}})
+    dest = Destination('https://example.com/sbws.bin', '/sbws.bin', 1)
+    relay = MagicMock(bandwidth=100, fingerprint='A' * 40)
+    rl = _FakeRelayList()
+    assert pick_helper_exit(conf, rl, dest, relay) == 'exit'
+    assert rl.ranges == [(125, 200), (62, 400), (31, 800), (16, 1600)]
+    relay.bandwidth = 10000
+    rl = _FakeRelayList()
+    assert pick_helper_exit(conf, rl, dest, relay) is None
+    assert len(rl.ranges) == 4
+    conf['scanner']['helper_exit_widen_steps'] = '0'
+    rl = _FakeRelayList()
+    assert pick_helper_exit(conf, rl, dest, relay) is None
+    assert len(rl.ranges) == 1
@@ -0,0 +1,23 @@
+from sbws.core.service import PeriodicJob
+from sbws.core.service import run_jobs
+from threading import Event
+
+
+def test_run_jobs():
+    end_event = Event()
+    runs = []
+
+    def often():
+        runs.append('often')
+        if runs.count('often') == 3:
+            end_event.set()
+
+    def broken():
+        runs.append('broken')
+        raise Exception('Oh no')
+
+    jobs = [PeriodicJob('often', 0.01, often),
+            PeriodicJob('broken', 60, broken)]
+    run_jobs(jobs, end_event)
+    # Both run at first, and a failing job doesn't stop the others
+    assert sorted(runs) == ['broken', 'often', 'often', 'often']
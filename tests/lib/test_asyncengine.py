@@ -0,0 +1,99 @@
+from sbws.lib.asyncengine import AsyncMeasurementEngine
+from configparser import ConfigParser
+from queue import Queue
+from threading import Event
+import asyncio
+
+
+class _FakeController:
+    def is_alive(self):
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def add_event_listener(self, func, event):
+        pass
+
+    def remove_event_listener(self, func):
+        pass
+
+    def get_listeners(self, listener_type):
+        return [('127.0.0.1', 9050)]
+
+
+class _FakeRelay:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.nickname = fingerprint
+
+
+class _FakePrioritizer:
+    ''' Always gives the same relays, like when none of them has a result
+    yet '''
+    def __init__(self, relays):
+        self.relays = relays
+
+    def best_priority(self):
+        return iter(self.relays)
+
+
+class _FakeResultDump:
+    def __init__(self):
+        self.queue = Queue()
+
+
+class _Engine(AsyncMeasurementEngine):
+    ''' Takes a little while to "measure" each relay, and stops once it has
+    **num_results** results '''
+    def __init__(self, num_results, *a):
+        super().__init__(*a)
+        self.num_results = num_results
+        self.measuring = set()
+        self.max_measuring = 0
+        self.measured_twice_at_once = False
+
+    async def measure_relay(self, relay):
+        if relay.fingerprint in self.measuring:
+            self.measured_twice_at_once = True
+        self.measuring.add(relay.fingerprint)
+        self.max_measuring = max(self.max_measuring, len(self.measuring))
+        await asyncio.sleep(0.01)
+        self.measuring.discard(relay.fingerprint)
+        if relay.fingerprint == 'C':
+            raise ValueError('Measuring C always fails')
+        if self._rd.queue.qsize() + 1 >= self.num_results:
+            self._end_event.set()
+        return relay.fingerprint
+
+
+def _conf(asyncio_measurements):
+    conf = ConfigParser()
+    conf.read_dict({
+        'general': {'circuit_timeout': '10', 'http_timeout': '10'},
+        'scanner': {'asyncio_measurements': str(asyncio_measurements),
+                    'measurement_threads': '2', 'nickname': 'test'},
+    })
+    return conf
+
+
+def test_engine_runs_until_end_event():
+    relays = [_FakeRelay(fp) for fp in 'ABCDE']
+    rd = _FakeResultDump()
+    end_event = Event()
+    engine = _Engine(
+        20, None, _conf(3), _FakeController(), None, None, rd,
+        _FakePrioritizer(relays), None, end_event)
+    engine.run()
+    assert end_event.is_set()
+    results = []
+    while not rd.queue.empty():
+        results.append(rd.queue.get())
+    assert len(results) >= 20
+    # The exception measuring C didn't stop anything
+    assert set(results) == {'A', 'B', 'D', 'E'}
+    assert engine.max_measuring == 3
+    assert not engine.measured_twice_at_once
+    # Every measurement finished before run() returned
+    assert engine.measuring == set()
+    assert engine._in_flight == set()
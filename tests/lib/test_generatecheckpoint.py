@@ -0,0 +1,76 @@
+from sbws.lib.generatecheckpoint import checkpoint_fname
+from sbws.lib.generatecheckpoint import load_checkpoint
+from sbws.lib.generatecheckpoint import load_recent_result_fields_incrementally
+from sbws.lib.resultdump import Result
+from sbws.lib.resultdump import ResultError
+from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import load_recent_result_fields_in_datadir
+from sbws.lib.resultdump import write_results_to_datadir
+from unittest.mock import patch
+import os
+import time
+
+FIELDS = ('nickname', 'time', 'rtts', 'downloads')
+
+
+def _results(start, end, now):
+    fp1 = 'A' * 40
+    fp2 = 'B' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relays = [Result.Relay(fp1, 'CowSayWhat1', '169.254.100.1'),
+              Result.Relay(fp2, 'CowSayWhat2', '169.254.100.2')]
+    results = []
+    for i in range(start, end):
+        relay = relays[i % 2]
+        t = now - i * 5*60*60
+        if i % 3 == 0:
+            results.append(ResultError(relay, circ, dest_url, 'SBWSscanner',
+                                       msg='Oh no', t=t))
+        else:
+            results.append(ResultSuccess(
+                [i / 10], [{'duration': 4, 'amount': i * 1024}], relay, circ,
+                dest_url, 'SBWSscanner', t=t))
+    return results
+
+
+def _assert_same_as_full_load(datadir):
+    incremental = load_recent_result_fields_incrementally(
+        5, datadir, FIELDS, success_only=True)
+    full = load_recent_result_fields_in_datadir(
+        5, datadir, FIELDS, success_only=True)
+    assert incremental == full
+    return incremental
+
+
+def test_incremental_matches_full_load(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    write_results_to_datadir(_results(10, 40, now), datadir)
+    _assert_same_as_full_load(datadir)
+    assert load_checkpoint(checkpoint_fname(datadir)) is not None
+    # New results, some of them in old files
+    write_results_to_datadir(_results(0, 10, now), datadir)
+    write_results_to_datadir(_results(40, 45, now), datadir)
+    data = _assert_same_as_full_load(datadir)
+    assert sum([len(data[fp]['time']) for fp in data]) == 16
+    # Time passes and results expire
+    with patch('time.time') as time_mock:
+        time_mock.return_value = now + 2 * 24*60*60
+        _assert_same_as_full_load(datadir)
+
+
+def test_incremental_rebuilds_when_files_change(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    write_results_to_datadir(_results(0, 20, now), datadir)
+    _assert_same_as_full_load(datadir)
+    for fname in os.listdir(datadir):
+        if fname.endswith('.txt'):
+            os.remove(os.path.join(datadir, fname))
+    write_results_to_datadir(_results(5, 10, now), datadir)
+    _assert_same_as_full_load(datadir)
+    # Or when the checkpoint can't be read
+    with open(checkpoint_fname(datadir), 'wt') as fd:
+        fd.write('Not a checkpoint')
+    _assert_same_as_full_load(datadir)
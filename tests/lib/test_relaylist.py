@@ -0,0 +1,315 @@
+from sbws.lib.relaylist import RelayList
+from stem import DescriptorUnavailable
+from stem import Flag
+from stem import InvalidArguments
+from stem.descriptor.microdescriptor import Microdescriptor
+from stem.descriptor.networkstatus import NetworkStatusDocumentV3
+from stem.descriptor.router_status_entry import RouterStatusEntryMicroV3
+from stem.descriptor.router_status_entry import RouterStatusEntryV3
+from threading import Event
+import base64
+import hashlib
+import os
+import time
+
+
+def _fp(nickname):
+    return hashlib.sha1(nickname.encode('utf-8')).hexdigest().upper()
+
+
+def _identity(nickname):
+    identity = base64.b64encode(bytes.fromhex(_fp(nickname)))
+    return identity.decode('ascii').rstrip('=')
+
+
+def _relay(nickname, bandwidth, flags, exit_policy=None,
+           published='2018-05-09 01:02:03'):
+    ''' A network status like the ones Tor gives us. They have no exit policy
+    when Tor uses microdescriptors. '''
+    attr = {
+        'r': '{} {} oQZFLYe9e4A7bOkWKR7TaNxb0JE {} 1.2.3.4 9001 0'.format(
+            nickname, _identity(nickname), published),
+        's': ' '.join(flags),
+        'w': 'Bandwidth={}'.format(bandwidth),
+    }
+    if exit_policy is not None:
+        attr['p'] = exit_policy
+    return RouterStatusEntryV3.create(attr)
+
+
+def _microdesc(exit_policy):
+    return Microdescriptor.create({'p': exit_policy})
+
+
+# In the microdescriptor consensus for relays Tor has no microdescriptor for
+_UNKNOWN_MICRODESC = _microdesc('reject 1-65535')
+
+
+class _FakeController:
+    def __init__(self, relays, microdescs=None, microdesc_consensus=True,
+                 datadir=None):
+        self.relays = relays
+        # Fingerprint: the microdescriptor Tor has for it
+        self.microdescs = microdescs or {}
+        # Whether GETINFO gives the microdescriptor consensus
+        self.microdesc_consensus = microdesc_consensus
+        self.datadir = datadir
+        self.num_calls = 0
+        self.num_microdesc_loads = 0
+        self.num_microdesc_queries = 0
+        self.num_status_loads = 0
+        self.listeners = []
+        # Cleared to make get_network_statuses() wait
+        self.can_get_statuses = Event()
+        self.can_get_statuses.set()
+
+    def is_alive(self):
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def add_event_listener(self, func, event):
+        self.listeners.append((func, event))
+
+    def get_network_statuses(self):
+        assert self.can_get_statuses.wait(5)
+        self.num_calls += 1
+        self.num_status_loads += 1
+        return list(self.relays)
+
+    def new_consensus(self):
+        for func, event in self.listeners:
+            if event == 'NEWCONSENSUS':
+                func(_FakeEvent(event))
+
+    def microdesc_consensus_text(self):
+        entries = [RouterStatusEntryMicroV3.create({
+            'r': '{} {} {} 1.2.3.4 9001 0'.format(
+                relay.nickname, _identity(relay.nickname), relay.published),
+            'm': self.microdescs.get(
+                relay.fingerprint, _UNKNOWN_MICRODESC).digest(),
+        }) for relay in self.relays]
+        return str(NetworkStatusDocumentV3.create(
+            {'network-status-version': '3 microdesc'}, routers=entries))
+
+    def get_info(self, param):
+        assert param == 'dir/status-vote/current/consensus-microdesc'
+        self.num_calls += 1
+        if not self.microdesc_consensus:
+            raise InvalidArguments(None, 'Unrecognized key')
+        return self.microdesc_consensus_text()
+
+    def get_conf(self, param):
+        assert param == 'DataDirectory'
+        if self.datadir is not None:
+            with open(os.path.join(self.datadir, 'cached-microdesc-consensus'),
+                      'wt') as fd:
+                fd.write(self.microdesc_consensus_text())
+        return self.datadir
+
+    def get_microdescriptors(self):
+        self.num_calls += 1
+        self.num_microdesc_loads += 1
+        return iter(self.microdescs.values())
+
+    def get_microdescriptor(self, fingerprint):
+        self.num_calls += 1
+        self.num_microdesc_queries += 1
+        if fingerprint not in self.microdescs:
+            raise DescriptorUnavailable('No microdescriptor')
+        return self.microdescs[fingerprint]
+
+
+class _FakeEvent:
+    def __init__(self, type):
+        self.type = type
+
+
+def _wait_for_refresh(rl):
+    start = time.time()
+    while rl._refreshing:
+        assert time.time() - start < 5
+        time.sleep(0.01)
+
+
+def _relays():
+    return [
+        _relay('A', 300, [Flag.EXIT], 'accept 443'),
+        _relay('B', 100, [Flag.EXIT, Flag.FAST], 'accept 80,443'),
+        _relay('C', 200, [Flag.EXIT], 'accept 80'),
+        # Its policy is only in its microdescriptor
+        _relay('D', 50, [Flag.EXIT]),
+        # Its microdescriptor isn't available
+        _relay('E', 500, [Flag.EXIT]),
+        _relay('F', 1000, [Flag.FAST]),
+    ]
+
+
+def _nicknames(relays):
+    return [r.nickname for r in relays]
+
+
+def test_exits_can_exit_to_uses_the_index():
+    cont = _FakeController(
+        _relays(), microdescs={_fp('D'): _microdesc('accept 443')})
+    rl = RelayList(None, None, cont)
+    rl.index_exits_to('127.0.0.1', 443)
+    num_calls = cont.num_calls
+    exits = rl.exits_can_exit_to('127.0.0.1', 443)
+    assert _nicknames(exits) == ['D', 'B', 'A']
+    assert cont.num_calls == num_calls
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == ['B', 'C']
+
+
+def test_exit_index_rebuilt_on_refresh():
+    cont = _FakeController(_relays())
+    rl = RelayList(None, None, cont)
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == ['B', 'C']
+    cont.relays.append(_relay('G', 150, [Flag.EXIT], 'accept 80'))
+    cont.new_consensus()
+    _wait_for_refresh(rl)
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == \
+        ['B', 'G', 'C']
+
+
+def test_exit_index_keeps_destinations_asked_about_while_refreshing():
+    cont = _FakeController(_relays())
+    rl = RelayList(None, None, cont)
+    rl.index_exits_to('127.0.0.1', 80)
+    find = rl._find_exits_that_can_exit_to
+
+    def find_and_ask(exits, exit_policies, host, port):
+        if port == 80:
+            rl.index_exits_to('127.0.0.1', 443)
+        return find(exits, exit_policies, host, port)
+    rl._find_exits_that_can_exit_to = find_and_ask
+    cont.relays.append(_relay('G', 150, [Flag.EXIT], 'accept 80,443'))
+    cont.new_consensus()
+    _wait_for_refresh(rl)
+    snapshot = rl._snapshot
+    assert set(snapshot.exit_index) == {('127.0.0.1', 80), ('127.0.0.1', 443)}
+    assert _nicknames(snapshot.exit_index[('127.0.0.1', 443)][0]) == \
+        ['B', 'G', 'A']
+
+
+def test_exit_policies_loaded_once_per_new_microdescriptor():
+    cont = _FakeController(
+        _relays(), microdescs={_fp('D'): _microdesc('accept 443'),
+                               _fp('E'): _microdesc('accept 80')})
+    rl = RelayList(None, None, cont)
+    assert cont.num_microdesc_loads == 1
+    assert cont.num_microdesc_queries == 0
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == \
+        ['B', 'C', 'E']
+    # Nothing new in the next consensus
+    cont.new_consensus()
+    _wait_for_refresh(rl)
+    assert cont.num_microdesc_loads == 1
+    # A new exit with its policy in its microdescriptor, and E with a new
+    # microdescriptor, even though it didn't publish a new descriptor
+    cont.relays.append(_relay('G', 150, [Flag.EXIT]))
+    cont.microdescs[_fp('G')] = _microdesc('accept 80')
+    cont.microdescs[_fp('E')] = _microdesc('accept 443')
+    cont.new_consensus()
+    _wait_for_refresh(rl)
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == \
+        ['B', 'G', 'C']
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 443)) == \
+        ['D', 'B', 'A', 'E']
+    assert cont.num_microdesc_loads == 2
+    assert cont.num_microdesc_queries == 0
+
+
+def test_exit_policies_without_microdescriptor():
+    microdescs = {_fp('D'): _microdesc('accept 443')}
+    cont = _FakeController(_relays(), microdescs=microdescs)
+    rl = RelayList(None, None, cont)
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 443)) == \
+        ['D', 'B', 'A']
+    # Only E, whose microdescriptor Tor doesn't have, is asked for by itself
+    assert cont.num_microdesc_loads == 1
+    assert cont.num_microdesc_queries == 1
+
+
+def test_exit_policies_from_cached_microdesc_consensus(tmpdir):
+    microdescs = {_fp('D'): _microdesc('accept 443'),
+                  _fp('E'): _microdesc('accept 80')}
+    cont = _FakeController(_relays(), microdescs=microdescs,
+                           microdesc_consensus=False, datadir=str(tmpdir))
+    rl = RelayList(None, None, cont)
+    assert cont.num_microdesc_loads == 1
+    assert cont.num_microdesc_queries == 0
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == \
+        ['B', 'C', 'E']
+    # Without any microdescriptor consensus, each exit's is asked for
+    cont = _FakeController(
+        _relays(), microdescs=microdescs, microdesc_consensus=False)
+    rl = RelayList(None, None, cont)
+    assert cont.num_microdesc_loads == 0
+    assert cont.num_microdesc_queries == 2
+    assert _nicknames(rl.exits_can_exit_to('127.0.0.1', 80)) == \
+        ['B', 'C', 'E']
+
+
+def test_random_exit_to():
+    cont = _FakeController(
+        _relays(), microdescs={_fp('D'): _microdesc('accept 443')})
+    rl = RelayList(None, None, cont)
+    names = set(rl.random_exit_to('127.0.0.1', 443, 60, 300).nickname
+                for _ in range(0, 100))
+    assert names == {'A', 'B'}
+    names = set(rl.random_exit_to('127.0.0.1', 443, 60, 300,
+                                  exclude_fp=_fp('A')).nickname
+                for _ in range(0, 100))
+    assert names == {'B'}
+    assert rl.random_exit_to('127.0.0.1', 443, 60, 100,
+                             exclude_fp=_fp('B')) is None
+    assert rl.random_exit_to('127.0.0.1', 443, 400, 10000) is None
+
+
+def test_refresh_in_background():
+    cont = _FakeController(_relays())
+    rl = RelayList(None, None, cont)
+    old_relays = rl.relays
+    cont.can_get_statuses.clear()
+    cont.new_consensus()
+    # The refresh waits for Tor, but we don't
+    assert rl.relays is old_relays
+    # Only one more refresh for all the events while it is running
+    cont.new_consensus()
+    cont.new_consensus()
+    rl._last_refresh = 0
+    assert rl.relays is old_relays
+    cont.can_get_statuses.set()
+    _wait_for_refresh(rl)
+    assert rl.relays is not old_relays
+    assert cont.num_status_loads == 3
+    # An old consensus is refreshed in the background too
+    cont.can_get_statuses.clear()
+    rl._last_refresh = 0
+    assert rl.relays is not old_relays
+    cont.can_get_statuses.set()
+    _wait_for_refresh(rl)
+    assert cont.num_status_loads == 4
+
+
+def test_relays_by_flag_and_fingerprint():
+    cont = _FakeController(_relays() + [
+        _relay('H', 10, [Flag.AUTHORITY, Flag.FAST, 'NotAFlagYet'])])
+    rl = RelayList(None, None, cont)
+    assert _nicknames(rl.fast) == ['B', 'F', 'H']
+    assert _nicknames(rl.slow) == ['A', 'C', 'D', 'E']
+    assert _nicknames(rl.authorities) == ['H']
+    assert _nicknames(rl.non_authorities) == ['A', 'B', 'C', 'D', 'E', 'F']
+    assert rl.guards == ()
+    # The same tuples until the next consensus
+    assert rl.fast is rl.fast
+    assert rl.slow is rl.slow
+    assert rl.relay(_fp('C')).bandwidth == 200
+    assert rl.relay(_fp('Z')) is None
+    cont.relays.append(_relay('Z', 10, [Flag.FAST]))
+    cont.new_consensus()
+    _wait_for_refresh(rl)
+    assert _nicknames(rl.fast) == ['B', 'F', 'H', 'Z']
+    assert rl.relay(_fp('Z')).bandwidth == 10
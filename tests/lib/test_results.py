@@ -1,4 +1,6 @@
 from unittest.mock import patch
+from threading import Event
+from sbws.util.config import get_config
 from sbws.globals import RESULT_VERSION
 from sbws.lib.resultdump import Result
 from sbws.lib.resultdump import ResultSuccess
@@ -7,7 +9,19 @@ from sbws.lib.resultdump import ResultErrorAuth
 from sbws.lib.resultdump import ResultErrorCircuit
 from sbws.lib.resultdump import ResultErrorStream
 from sbws.lib.resultdump import _ResultType
+from sbws.lib.resultdump import ResultDump
+from sbws.lib.resultdump import write_results_to_datadir
+from sbws.lib.resultdump import load_result_file
+from sbws.lib.resultdump import load_recent_results_in_datadir
+from sbws.lib.resultdump import load_recent_result_fields_in_datadir
+from sbws.lib.resultdump import merge_result_dicts
+from sbws.lib.resultdump import load_result_snapshot
+from sbws.lib.resultdump import RESULT_SNAPSHOT_FNAME
 from tests.globals import monotonic_time
+from tests.conftest import _PseudoArguments
+import json
+import os
+import time
 
 
 @patch('time.time')
@@ -333,3 +347,365 @@ def test_ResultErrorAuth_from_dict(time_mock):
     assert isinstance(r1, ResultErrorAuth)
     assert isinstance(r2, ResultErrorAuth)
     assert str(r1) == str(r2)
+
+
+def _started_result_dump(dotsbws):
+    ''' Return a ResultDump whose thread has already loaded the (empty)
+    datadir and exited, so that results can be given to it directly '''
+    args = _PseudoArguments(directory=dotsbws.name)
+    conf = get_config(args)
+    end_event = Event()
+    end_event.set()
+    rd = ResultDump(args, conf, end_event)
+    rd.thread.join()
+    return rd
+
+
+def test_ResultDump_relay_freshness(empty_dotsbws_datadir):
+    rd = _started_result_dump(empty_dotsbws_datadir)
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    scanner_nick = 'sbwsscanner'
+    relay = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    now = time.time()
+    results = [
+        ResultSuccess([1], [{'duration': 4, 'amount': 40}], relay, circ,
+                      dest_url, scanner_nick, t=now - 100),
+        ResultErrorCircuit(relay, circ, dest_url, scanner_nick, msg='Oh no',
+                           t=now - 50),
+        ResultErrorAuth(relay, circ, dest_url, scanner_nick, msg='Oh no',
+                        t=now - 10),
+    ]
+    oldest_allowed = now - 1000
+    assert rd.relay_freshness(fp1, oldest_allowed) == 0
+    for r in results:
+        rd.store_result(r)
+    expected = 900 + 950 * (1 - 0.6) + 990 * (1 - 0.9)
+    assert abs(rd.relay_freshness(fp1, oldest_allowed) - expected) < 0.01
+    assert rd.relay_freshness(fp2, oldest_allowed) == 0
+    # A result that is too old to be kept doesn't count
+    rd.store_result(ResultSuccess(
+        [1], [{'duration': 4, 'amount': 40}], relay, circ, dest_url,
+        scanner_nick, t=now - rd.fresh_days * 24*60*60 - 1))
+    assert abs(rd.relay_freshness(fp1, oldest_allowed) - expected) < 0.01
+
+
+def test_ResultDump_freshness_without_stale_results(empty_dotsbws_datadir):
+    rd = _started_result_dump(empty_dotsbws_datadir)
+    fp1 = 'A' * 40
+    circ = [fp1, 'Z' * 40]
+    relay = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    now = time.time()
+    fresh_seconds = rd.fresh_days * 24*60*60
+    rd.store_result(ResultSuccess(
+        [1], [{'duration': 4, 'amount': 40}], relay, circ,
+        'http://example.com/sbws.bin', 'sbwsscanner', t=now - 100))
+    # Time passed without any new results, so the result is stale but
+    # hasn't expired yet
+    later = now + fresh_seconds
+    with patch('time.time') as time_mock:
+        time_mock.return_value = later
+        assert len(rd.data[fp1]) == 1
+        assert list(rd.iter_summaries(later - fresh_seconds)) == []
+        assert fp1 not in rd.data
+        assert rd.relay_freshness(fp1, later - fresh_seconds) == 0
+
+
+def test_ResultDump_expires_results_in_time_order(empty_dotsbws_datadir):
+    rd = _started_result_dump(empty_dotsbws_datadir)
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    scanner_nick = 'sbwsscanner'
+    relay1 = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    relay2 = Result.Relay(fp2, 'Baaaaaaa', '169.254.100.2')
+    now = time.time()
+    fresh_seconds = rd.fresh_days * 24*60*60
+    # Out of order on purpose
+    for t in [now - 10, now - 30, now - 20]:
+        rd.store_result(ResultError(relay1, circ, dest_url, scanner_nick,
+                                    msg='Oh no', t=t))
+    assert [r.time for r in rd.data[fp1]] == [now - 30, now - 20, now - 10]
+    # Pretend time passed so that the two oldest results of relay1 are stale
+    # when relay2's result arrives
+    with patch('time.time') as time_mock:
+        time_mock.return_value = now + fresh_seconds - 15
+        rd.store_result(ResultError(relay2, circ, dest_url, scanner_nick,
+                                    msg='Oh no', t=now))
+    assert [r.time for r in rd.data[fp1]] == [now - 10]
+    assert [r.time for r in rd.data[fp2]] == [now]
+    assert len(rd._expiry) == 2
+
+
+def test_write_results_to_datadir(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    dd = conf['paths']['datadir']
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    relay = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    day = 24*60*60
+    t = 1500000000
+    results = [
+        ResultError(relay, [fp1, fp2], 'http://example.com/sbws.bin',
+                    'sbwsscanner', msg='Oh no', t=t + i * day / 2)
+        for i in range(0, 4)]
+    write_results_to_datadir(results, dd, fsync=True)
+    d = {}
+    for fname in sorted(os.listdir(dd)):
+        if fname.endswith('.txt'):
+            merge_result_dicts(d, load_result_file(os.path.join(dd, fname)))
+    assert [r.time for r in d[fp1]] == [r.time for r in results]
+
+
+def test_ResultDump_flushes_batch_at_end(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    conf['scanner']['result_batch_size'] = '100'
+    conf['scanner']['result_batch_age'] = '1000'
+    dd = conf['paths']['datadir']
+    end_event = Event()
+    rd = ResultDump(args, conf, end_event)
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    relay = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    for _ in range(0, 3):
+        rd.queue.put(ResultSuccess(
+            [1], [{'duration': 4, 'amount': 40}], relay, [fp1, fp2],
+            'http://example.com/sbws.bin', 'sbwsscanner'))
+    end_event.set()
+    rd.thread.join()
+    results = load_recent_results_in_datadir(rd.fresh_days, dd)
+    assert len(results[fp1]) == 3
+
+
+def test_load_recent_result_fields_in_datadir(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    dd = conf['paths']['datadir']
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relay1 = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    relay2 = Result.Relay(fp2, 'Baaaaaaa', '169.254.100.2')
+    now = time.time()
+    write_results_to_datadir([
+        ResultSuccess([1, 2], [{'duration': 4, 'amount': 40}], relay1, circ,
+                      dest_url, 'sbwsscanner', t=now - 100),
+        ResultError(relay1, circ, dest_url, 'sbwsscanner', msg='Oh no',
+                    t=now - 50),
+        ResultSuccess([3], [{'duration': 4, 'amount': 80},
+                            {'duration': 2, 'amount': 80}], relay1, circ,
+                      dest_url, 'sbwsscanner', t=now - 10),
+        ResultSuccess([4], [{'duration': 1, 'amount': 10}], relay2, circ,
+                      dest_url, 'sbwsscanner', t=now - 5),
+        # Too old
+        ResultSuccess([5], [{'duration': 1, 'amount': 10}], relay2, circ,
+                      dest_url, 'sbwsscanner', t=now - 10 * 24*60*60),
+    ], dd)
+    fields = ('nickname', 'time', 'rtts', 'downloads')
+    data = load_recent_result_fields_in_datadir(
+        5, dd, fields, success_only=True)
+    assert sorted(data.keys()) == [fp1, fp2]
+    assert data[fp1]['nickname'] == ['Mooooooo', 'Mooooooo']
+    assert data[fp1]['time'] == [now - 100, now - 10]
+    assert data[fp1]['rtts'] == [1, 2, 3]
+    assert data[fp1]['downloads'] == [
+        {'duration': 4, 'amount': 40}, {'duration': 4, 'amount': 80},
+        {'duration': 2, 'amount': 80}]
+    assert data[fp2]['rtts'] == [4]
+    # Errors have no rtts or downloads
+    data = load_recent_result_fields_in_datadir(
+        5, dd, fields, fingerprint=fp1)
+    assert list(data.keys()) == [fp1]
+    assert data[fp1]['time'] == [now - 100, now - 50, now - 10]
+    assert data[fp1]['rtts'] == [1, 2, 3]
+    # The same results as the slow path
+    results = load_recent_results_in_datadir(5, dd, success_only=True)
+    data = load_recent_result_fields_in_datadir(
+        5, dd, fields, success_only=True)
+    for fp in results:
+        assert [r.time for r in results[fp]] == data[fp]['time']
+
+
+def test_load_recent_results_in_datadir_processes(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    dd = conf['paths']['datadir']
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relays = [Result.Relay(fp1, 'Mooooooo', '169.254.100.1'),
+              Result.Relay(fp2, 'Baaaaaaa', '169.254.100.2')]
+    now = time.time()
+    results = []
+    # Results spread over several day files
+    for i in range(0, 20):
+        relay = relays[i % 2]
+        t = now - i * 6*60*60
+        if i % 3 == 0:
+            results.append(ResultError(relay, circ, dest_url, 'sbwsscanner',
+                                       msg='Oh no', t=t))
+        else:
+            results.append(ResultSuccess(
+                [i], [{'duration': 4, 'amount': i}], relay, circ, dest_url,
+                'sbwsscanner', t=t))
+    write_results_to_datadir(results, dd)
+    serial = load_recent_results_in_datadir(5, dd)
+    parallel = load_recent_results_in_datadir(5, dd, processes=3)
+    assert sorted(serial.keys()) == sorted(parallel.keys()) == [fp1, fp2]
+    for fp in serial:
+        assert [str(r) for r in serial[fp]] == [str(r) for r in parallel[fp]]
+    fields = ('nickname', 'time', 'rtts', 'downloads')
+    serial = load_recent_result_fields_in_datadir(
+        5, dd, fields, success_only=True)
+    parallel = load_recent_result_fields_in_datadir(
+        5, dd, fields, success_only=True, processes=3)
+    assert serial == parallel
+
+
+def test_Result_is_compact():
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    dest_url = 'http://example.com/sbws.bin'
+    d = {
+        'rtts': [0.5, 1], 'downloads': [{'duration': 4, 'amount': 40},
+                                        {'duration': 5.5, 'amount': 80}],
+        'fingerprint': fp1, 'nickname': 'Mooooooo',
+        'address': '169.254.100.1', 'circ': [fp1, fp2],
+        'dest_url': dest_url, 'scanner': 'sbwsscanner', 'time': 1500000000,
+        'type': _ResultType.Success, 'version': RESULT_VERSION,
+    }
+    # Copies of the strings, like json.loads() would make
+    r1 = Result.from_dict(json.loads(json.dumps(d)))
+    r2 = Result.from_dict(json.loads(json.dumps(d)))
+    assert not hasattr(r1, '__dict__')
+    assert r1.fingerprint is r2.fingerprint
+    assert r1.dest_url is r2.dest_url
+    assert r1.circ[1] is r2.circ[1]
+    assert r1.to_dict() == d
+    assert json.loads(str(r1)) == json.loads(json.dumps(d))
+
+
+def test_result_snapshot(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    dd = conf['paths']['datadir']
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relay = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    now = time.time()
+
+    def results(start):
+        return [ResultSuccess([i], [{'duration': 4, 'amount': i}], relay,
+                              circ, dest_url, 'sbwsscanner',
+                              t=now - i * 6*60*60)
+                for i in range(start, start + 4)]
+    end_event = Event()
+    rd = ResultDump(args, conf, end_event)
+    rd.queue.put(results(0))
+    end_event.set()
+    rd.thread.join()
+    fname = os.path.join(dd, RESULT_SNAPSHOT_FNAME)
+    assert os.path.isfile(fname)
+    # Written after the snapshot, so they must be read from the files
+    write_results_to_datadir(results(4), dd)
+    data = load_result_snapshot(fname, dd, rd.fresh_days)
+    expected = load_recent_results_in_datadir(rd.fresh_days, dd)
+    assert sorted([str(r) for r in data[fp1]]) == \
+        sorted([str(r) for r in expected[fp1]])
+    assert len(data[fp1]) == 8
+    # A new ResultDump starts from the snapshot
+    rd = _started_result_dump(empty_dotsbws_datadir)
+    assert len(rd.data[fp1]) == 8
+    # Can't be used when a result file changed under it
+    for result_fname in os.listdir(dd):
+        if result_fname.endswith('.txt'):
+            with open(os.path.join(dd, result_fname), 'wt'):
+                pass
+    assert load_result_snapshot(fname, dd, rd.fresh_days) is None
+    # Nor when it is missing
+    os.remove(fname)
+    assert load_result_snapshot(fname, dd, rd.fresh_days) is None
+
+
+def test_ResultDump_summaries(empty_dotsbws_datadir):
+    rd = _started_result_dump(empty_dotsbws_datadir)
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    scanner_nick = 'sbwsscanner'
+    relay1 = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    relay2 = Result.Relay(fp2, 'Baaaaaaa', '169.254.100.2')
+    now = time.time()
+    fresh_seconds = rd.fresh_days * 24*60*60
+    assert rd.summary_for_relay(fp1) is None
+    rd.store_result(ResultSuccess([1], [{'duration': 4, 'amount': 40}],
+                                  relay1, circ, dest_url, scanner_nick,
+                                  t=now - 30))
+    rd.store_result(ResultErrorCircuit(relay1, circ, dest_url, scanner_nick,
+                                       msg='Oh no', t=now - 20))
+    rd.store_result(ResultSuccess([1], [{'duration': 4, 'amount': 40}],
+                                  relay1, circ, dest_url, scanner_nick,
+                                  t=now - 10))
+    summary = rd.summary_for_relay(fp1)
+    assert summary.nickname == 'Mooooooo'
+    assert summary.num_results == 3
+    assert summary.num_success == 2
+    assert summary.num_errors == 1
+    assert summary.num_per_type == {'success': 2, 'error-circ': 1}
+    assert summary.oldest_time == now - 30
+    assert summary.newest_time == now - 10
+    assert abs(summary.freshness(now - 100) -
+               rd.relay_freshness(fp1, now - 100)) < 0.01
+    # Expire the oldest result of relay1
+    with patch('time.time') as time_mock:
+        time_mock.return_value = now + fresh_seconds - 25
+        rd.store_result(ResultSuccess([1], [{'duration': 4, 'amount': 40}],
+                                      relay2, circ, dest_url, scanner_nick,
+                                      t=now))
+    # The copy we got before doesn't change
+    assert summary.num_results == 3
+    summary = rd.summary_for_relay(fp1)
+    assert summary.num_results == 2
+    assert summary.num_success == 1
+    assert summary.oldest_time == now - 20
+    assert sorted([s.fingerprint for s in rd.iter_summaries()]) == [fp1, fp2]
+
+
+def test_ResultDump_result_fields(empty_dotsbws_datadir):
+    args = _PseudoArguments(directory=empty_dotsbws_datadir.name)
+    conf = get_config(args)
+    dd = conf['paths']['datadir']
+    fp1 = 'A' * 40
+    fp2 = 'Z' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relay1 = Result.Relay(fp1, 'Mooooooo', '169.254.100.1')
+    relay2 = Result.Relay(fp2, 'Baaaaaaa', '169.254.100.2')
+    now = time.time()
+    end_event = Event()
+    rd = ResultDump(args, conf, end_event)
+    rd.queue.put([
+        ResultSuccess([1, 2], [{'duration': 4, 'amount': 40}], relay1, circ,
+                      dest_url, 'sbwsscanner', t=now - 30),
+        ResultErrorCircuit(relay1, circ, dest_url, 'sbwsscanner',
+                           msg='Oh no', t=now - 20),
+        ResultSuccess([3], [{'duration': 2, 'amount': 80}], relay2, circ,
+                      dest_url, 'sbwsscanner', t=now - 10),
+    ])
+    end_event.set()
+    rd.thread.join()
+    fields = ('nickname', 'time', 'rtts', 'downloads')
+    for success_only in [False, True]:
+        assert rd.result_fields(fields, success_only=success_only) == \
+            load_recent_result_fields_in_datadir(
+                rd.fresh_days, dd, fields, success_only=success_only)
@@ -0,0 +1,117 @@
+from sbws.lib.resultdump import Result
+from sbws.lib.resultdump import ResultError
+from sbws.lib.resultdump import ResultSuccess
+from sbws.lib.resultdump import load_recent_results_in_datadir
+from sbws.lib.resultdump import write_results_to_datadir
+from sbws.lib.resultstore import SQLiteResultStore
+from sbws.lib.resultstore import import_result_files
+from sbws.lib.resultstore import results_db_fname
+import gzip
+import os
+import shutil
+import time
+
+
+def _results(now):
+    fp1 = 'A' * 40
+    fp2 = 'B' * 40
+    circ = [fp1, fp2]
+    dest_url = 'http://example.com/sbws.bin'
+    relay1 = Result.Relay(fp1, 'CowSayWhat1', '169.254.100.1')
+    relay2 = Result.Relay(fp2, 'CowSayWhat2', '169.254.100.2')
+    return [
+        ResultSuccess([1, 2], [{'duration': 4, 'amount': 40}], relay1, circ,
+                      dest_url, 'SBWSscanner', t=now - 20),
+        ResultError(relay1, circ, dest_url, 'SBWSscanner', msg='Oh no',
+                    t=now - 10),
+        ResultSuccess([3, 4], [{'duration': 4, 'amount': 80}], relay2, circ,
+                      dest_url, 'SBWSscanner', t=now - 5),
+        # Too old
+        ResultSuccess([5, 6], [{'duration': 4, 'amount': 80}], relay2, circ,
+                      dest_url, 'SBWSscanner', t=now - 10 * 24*60*60),
+    ]
+
+
+def test_store_and_load(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    store = SQLiteResultStore(results_db_fname(datadir))
+    results = _results(now)
+    store.write_results(results)
+    d = load_recent_results_in_datadir(5, datadir, result_store='sqlite')
+    assert sorted(d.keys()) == ['A' * 40, 'B' * 40]
+    assert [str(r) for r in d['A' * 40]] == [str(r) for r in results[0:2]]
+    assert [str(r) for r in d['B' * 40]] == [str(results[2])]
+    d = load_recent_results_in_datadir(
+        5, datadir, success_only=True, result_store='sqlite')
+    assert [str(r) for r in d['A' * 40]] == [str(results[0])]
+    d = load_recent_results_in_datadir(
+        5, datadir, fingerprint='B' * 40, result_store='sqlite')
+    assert list(d.keys()) == ['B' * 40]
+    d = store.load_result_fields(now - 5 * 24*60*60, ('time', 'rtts'),
+                                 success_only=True)
+    assert d['A' * 40] == {'time': [now - 20], 'rtts': [1, 2]}
+    assert d['B' * 40] == {'time': [now - 5], 'rtts': [3, 4]}
+
+
+def test_delete_results_older_than(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    store = SQLiteResultStore(results_db_fname(datadir))
+    store.write_results(_results(now))
+    assert store.delete_results_older_than(now - 15, dry_run=True) == 2
+    assert store.delete_results_older_than(now - 15) == 2
+    assert store.delete_results_older_than(now - 15) == 0
+    d = store.load_results(0)
+    assert sum([len(d[fp]) for fp in d]) == 2
+
+
+def test_import_result_files(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    results = _results(now)
+    write_results_to_datadir(results, datadir)
+    # Compress the file with the old result, like sbws cleanup would
+    for fname in os.listdir(datadir):
+        fname = os.path.join(datadir, fname)
+        if fname.endswith('.txt') and os.path.getsize(fname) < 500:
+            with open(fname, 'rt') as in_fd:
+                with gzip.open(fname + '.gz', 'wt') as out_fd:
+                    shutil.copyfileobj(in_fd, out_fd)
+            os.remove(fname)
+    store = SQLiteResultStore(results_db_fname(datadir))
+    assert import_result_files(store, datadir) == len(results)
+    # Importing again doesn't duplicate anything
+    assert import_result_files(store, datadir) == 0
+    from_files = load_recent_results_in_datadir(5, datadir)
+    from_db = load_recent_results_in_datadir(
+        5, datadir, result_store='sqlite')
+    assert sorted(from_files.keys()) == sorted(from_db.keys())
+    for fp in from_files:
+        assert [str(r) for r in from_files[fp]] == \
+            [str(r) for r in from_db[fp]]
+
+
+def test_import_result_files_still_being_written(tmpdir):
+    datadir = str(tmpdir)
+    now = time.time()
+    results = _results(now)[:3]
+    # The same day in the datadir and in a scanner's subdirectory
+    subdir = os.path.join(datadir, 'scanner2')
+    os.mkdir(subdir)
+    write_results_to_datadir(results[:1], datadir)
+    write_results_to_datadir(results[1:2], subdir)
+    store = SQLiteResultStore(results_db_fname(datadir))
+    assert import_result_files(store, datadir) == 2
+    # More results, and one that isn't completely written yet
+    write_results_to_datadir(results[2:3], datadir)
+    fname = os.path.join(datadir, os.listdir(subdir)[0])
+    with open(fname, 'at') as fd:
+        fd.write(str(results[0])[:20])
+    assert import_result_files(store, datadir) == 1
+    with open(fname, 'at') as fd:
+        fd.write(str(results[0])[20:] + '\n')
+    assert import_result_files(store, datadir) == 1
+    assert import_result_files(store, datadir) == 0
+    d = store.load_results(0)
+    assert sum([len(d[fp]) for fp in d]) == 4
@@ -0,0 +1,50 @@
+from sbws.core.generate import result_data_to_v3bw_line
+from sbws.core.generate import scale_columns
+from sbws.core.generate import scale_lines
+from argparse import Namespace
+import random
+import pytest
+
+v3bwarrays = pytest.importorskip('sbws.lib.v3bwarrays')
+if not v3bwarrays.have_numpy():
+    pytest.skip('NumPy is not installed', allow_module_level=True)
+
+
+def _random_result_fields(num_relays):
+    rng = random.Random(1)
+    data = {}
+    for i in range(0, num_relays):
+        num_results = rng.randint(1, 4)
+        data['{:040X}'.format(i)] = {
+            'nickname': ['relay{}'.format(i)] * num_results,
+            'time': [rng.uniform(1e9, 2e9) for _ in range(0, num_results)],
+            # Few different values, so there are ties and halves to round
+            'rtts': [rng.choice([0.1, 0.2, 0.0005, 0.0015, 0.3])
+                     for _ in range(0, rng.randint(1, 10))],
+            'downloads': [{'duration': rng.choice([1, 2, 4]),
+                           'amount': rng.choice([1024, 1536, 2**20, 2**30])}
+                          for _ in range(0, rng.randint(1, 6))],
+        }
+    return data
+
+
+@pytest.mark.parametrize('scale', [False, True])
+def test_same_as_v3bwlines(scale):
+    data = _random_result_fields(500)
+    args = Namespace(scale=scale, scale_constant=7500)
+    lines = [result_data_to_v3bw_line(data, fp) for fp in data]
+    lines = sorted(lines, key=lambda d: d.bw, reverse=True)
+    lines = scale_lines(args, lines)
+    columns = v3bwarrays.V3BWColumns.from_result_fields(data)
+    columns.sort_by_bw()
+    columns = scale_columns(args, columns)
+    assert columns.lines() == ''.join(
+        ['{}\n'.format(line) for line in lines])
+
+
+def test_grouped_median():
+    np = v3bwarrays.np
+    groups = np.array([1, 0, 1, 1, 0, 2])
+    values = np.array([3.0, 2.0, 1.0, 2.0, 5.0, 7.0])
+    assert v3bwarrays.grouped_median(groups, values, 3).tolist() == \
+        [3.5, 2.0, 7.0]
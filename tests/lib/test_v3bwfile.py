@@ -2,7 +2,9 @@
 """Test generation of bandwidth measurements document (v3bw)"""
 from sbws.globals import SPEC_VERSION
 from sbws.lib.v3bwfile import V3BwHeader, TERMINATOR, LINE_SEP, K_SEP_V110
+from sbws.lib.v3bwfile import write_v3bw
 from sbws import __version__ as version
+import os
 
 timestamp = 1524661857
 timestamp_l = str(timestamp)
@@ -55,3 +57,41 @@ def test_v3bwheader_from_text():
 def test_v3bwfile():
     """Test generate v3bw file (including relay_lines)."""
     pass
+
+
+def test_write_v3bw(tmpdir):
+    fname = os.path.join(str(tmpdir), 'v3bw.txt')
+    history_dname = os.path.join(str(tmpdir), 'history')
+    assert write_v3bw(fname, 'old') is None
+    history_fname = write_v3bw(fname, header_str, history_dname=history_dname,
+                               timestamp=timestamp)
+    assert os.path.basename(history_fname) == '20180425-131057-v3bw.txt'
+    for f in [fname, history_fname]:
+        with open(f, 'rt') as fd:
+            assert fd.read() == header_str
+    assert sorted(os.listdir(str(tmpdir))) == ['history', 'v3bw.txt']
+
+
+def test_write_v3bw_symlink(tmpdir):
+    target = os.path.join(str(tmpdir), 'v3bw-target.txt')
+    fname = os.path.join(str(tmpdir), 'latest.v3bw')
+    with open(target, 'wt') as fd:
+        fd.write('old')
+    os.symlink(target, fname)
+    # The file the link points to is replaced
+    write_v3bw(fname, 'new')
+    assert os.path.islink(fname)
+    with open(target, 'rt') as fd:
+        assert fd.read() == 'new'
+    # The link is pointed to the history copy
+    history_dname = os.path.join(str(tmpdir), 'history')
+    history_fname = write_v3bw(fname, header_str, history_dname=history_dname,
+                               timestamp=timestamp)
+    assert os.path.islink(fname)
+    assert os.path.realpath(fname) == os.path.realpath(history_fname)
+    with open(fname, 'rt') as fd:
+        assert fd.read() == header_str
+    with open(target, 'rt') as fd:
+        assert fd.read() == 'new'
+    assert sorted(os.listdir(str(tmpdir))) == \
+        ['history', 'latest.v3bw', 'v3bw-target.txt']
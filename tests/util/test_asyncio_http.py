@@ -0,0 +1,157 @@
+from sbws.util.asyncio_http import AsyncHTTPConnection
+from sbws.util.asyncio_http import AsyncHTTPError
+from sbws.util.asyncio_http import socks_connect
+from sbws.util.asyncio_http import socks_tcp_connect
+import asyncio
+import pytest
+import struct
+
+
+def _run(loop, handler, client):
+    ''' Serve connections on localhost with **handler** and run **client**
+    with the server's port '''
+    server = loop.run_until_complete(
+        asyncio.start_server(handler, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    try:
+        return loop.run_until_complete(client(port))
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    # Servers that are still sending
+    tasks = [t for t in asyncio.all_tasks(loop) if not t.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+def _http_handler(body_parts, delay, chunked=False):
+    ''' Answer every request with **body_parts**, waiting **delay** seconds
+    before sending each of them '''
+    async def handler(reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break
+            if chunked:
+                writer.write(b'HTTP/1.1 206 Partial Content\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n')
+            else:
+                writer.write(
+                    'HTTP/1.1 206 Partial Content\r\nContent-Length: {}\r\n'
+                    '\r\n'.format(sum(map(len, body_parts))).encode())
+            for part in body_parts:
+                await asyncio.sleep(delay)
+                if chunked:
+                    part = '{:x}\r\n'.format(len(part)).encode() + part + \
+                        b'\r\n'
+                writer.write(part)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            if head.startswith(b'HEAD'):
+                break
+        writer.close()
+    return handler
+
+
+def _request(method, timeout, headers=None):
+    async def client(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        conn = AsyncHTTPConnection(reader, writer, 'example.com', timeout)
+        try:
+            resp = await conn.request(method, '/sbws.bin', headers)
+            # The connection can be used again
+            resp = await conn.request(method, '/sbws.bin', headers)
+            return resp
+        finally:
+            conn.close()
+    return client
+
+
+def test_request_slow_download_that_keeps_going(loop):
+    # 0.5 seconds in all, but never 0.2 seconds without data
+    handler = _http_handler([b'A' * 1000] * 5, 0.05)
+    resp = _run(loop, handler, _request('GET', 0.2, {'Range': 'bytes=0-4999'}))
+    assert resp.status_code == 206
+    assert resp.headers['content-length'] == '5000'
+
+
+def test_request_chunked(loop):
+    handler = _http_handler([b'A' * 10, b'B' * 20], 0, chunked=True)
+    resp = _run(loop, handler, _request('GET', 1))
+    assert resp.status_code == 206
+    assert resp.headers['transfer-encoding'] == 'chunked'
+
+
+def test_request_stalled(loop):
+    handler = _http_handler([b'A' * 1000, b'B' * 1000], 0.5)
+    with pytest.raises(asyncio.TimeoutError):
+        _run(loop, handler, _request('GET', 0.1))
+
+
+def test_request_connection_closed(loop):
+    async def handler(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nshort')
+        writer.close()
+    with pytest.raises(AsyncHTTPError):
+        _run(loop, handler, _request('GET', 1))
+
+
+def test_socks_connect(loop):
+    requests = []
+
+    async def handler(reader, writer):
+        greeting = await reader.readexactly(3)
+        writer.write(b'\x05\x00')
+        request = await reader.readexactly(5)
+        host = await reader.readexactly(request[4])
+        port, = struct.unpack('!H', await reader.readexactly(2))
+        requests.append((greeting, host, port))
+        writer.write(b'\x05\x00\x00\x01' + bytes([127, 0, 0, 1]) +
+                     struct.pack('!H', 9))
+        await writer.drain()
+        writer.write(b'hello')
+        writer.close()
+
+    async def client(port):
+        sock = await socks_tcp_connect(loop, ('127.0.0.1', port))
+        try:
+            await socks_connect(loop, sock, 'example.com', 443)
+            return await loop.sock_recv(sock, 5)
+        finally:
+            sock.close()
+
+    assert _run(loop, handler, client) == b'hello'
+    assert requests == [(b'\x05\x01\x00', b'example.com', 443)]
+
+
+def test_socks_connect_refused(loop):
+    async def handler(reader, writer):
+        await reader.readexactly(3)
+        writer.write(b'\x05\x00')
+        await reader.readexactly(5 + len('example.com') + 2)
+        # Host unreachable
+        writer.write(b'\x05\x04\x00\x01' + bytes(6))
+        writer.close()
+
+    async def client(port):
+        sock = await socks_tcp_connect(loop, ('127.0.0.1', port))
+        try:
+            await socks_connect(loop, sock, 'example.com', 443)
+        finally:
+            sock.close()
+
+    with pytest.raises(AsyncHTTPError):
+        _run(loop, handler, client)
@@ -228,3 +228,15 @@ def test_nickname():
         d = {'n': nick}
         valid, reason = con._validate_nickname(d, 'n')
         assert not valid, reason
+
+
+def test_validate_choice():
+    choices = ['threads', 'asyncio']
+    for value in choices:
+        valid, reason = con._validate_choice({'': value}, '', choices)
+        assert valid, '{} should have been a valid choice, but got: '\
+            '{}'.format(value, reason)
+    for value in ['', 'Threads', 'processes']:
+        valid, reason = con._validate_choice({'': value}, '', choices)
+        assert not valid, '{} should not have been a valid '\
+            'choice'.format(value)
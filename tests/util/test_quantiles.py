@@ -0,0 +1,74 @@
+from sbws.util.quantiles import KLLSketch
+from bisect import bisect_left, bisect_right
+from statistics import median
+import random
+
+
+def _rank_error(sorted_values, value, q):
+    ''' How far off q the rank of **value** in **sorted_values** is, as a
+    fraction of the number of values '''
+    low = bisect_left(sorted_values, value) / len(sorted_values)
+    high = bisect_right(sorted_values, value) / len(sorted_values)
+    if low <= q <= high:
+        return 0
+    return min(abs(low - q), abs(high - q))
+
+
+def test_exact_while_small():
+    rng = random.Random(1)
+    values = [rng.uniform(0, 100) for _ in range(0, 50)]
+    sketch = KLLSketch(k=100)
+    sketch.update(values)
+    assert len(sketch) == 50
+    assert sketch.median() == median(values)
+    sketch.add(1000)
+    assert sketch.median() == median(values + [1000])
+
+
+def test_median_error_bounds():
+    rng = random.Random(2)
+    values = [rng.lognormvariate(10, 2) for _ in range(0, 100000)]
+    k = 200
+    sketch = KLLSketch(k=k)
+    sketch.update(values)
+    values.sort()
+    assert len(sketch) == len(values)
+    # Bounded memory
+    assert sum([len(c) for c in sketch._compactors]) < 4 * k
+    assert _rank_error(values, sketch.median(), 0.5) < 1.7 / k
+    for q in [0.1, 0.25, 0.75, 0.9]:
+        assert _rank_error(values, sketch.quantile(q), q) < 1.7 / k
+
+
+def test_merge():
+    rng = random.Random(3)
+    values = [rng.expovariate(1) for _ in range(0, 50000)]
+    k = 200
+    # Like sketches of different result files parsed in different processes
+    sketches = [KLLSketch(k=k, seed=i) for i in range(0, 5)]
+    for i, value in enumerate(values):
+        sketches[i % 5].add(value)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    values.sort()
+    assert len(merged) == len(values)
+    assert _rank_error(values, merged.median(), 0.5) < 1.7 / k
+
+
+def test_deterministic():
+    rng = random.Random(4)
+    values = [rng.random() for _ in range(0, 10000)]
+    sketch1 = KLLSketch(k=50)
+    sketch2 = KLLSketch(k=50)
+    sketch1.update(values)
+    sketch2.update(values)
+    assert sketch1.median() == sketch2.median()
+
+
+def test_quantiles_exact():
+    sketch = KLLSketch(k=100)
+    sketch.update([5, 1, 4, 2, 3])
+    assert sketch.quantiles([0, 0.2, 0.21, 0.5, 0.99, 1]) == \
+        [1, 1, 2, 3, 5, 5]
+    assert sketch.quantile(0.4) == 2
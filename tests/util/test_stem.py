@@ -0,0 +1,68 @@
+from sbws.util.stem import circuit_socks_username
+from sbws.util.stem import reports_socks_usernames
+from sbws.util.stem import stream_attacher
+from stem.version import Version
+import stem.response
+
+
+class _FakeController:
+    def __init__(self, version='0.4.8.10'):
+        self.listeners = []
+        self.attached = []
+        self.version = Version(version)
+
+    def get_version(self):
+        return self.version
+
+    def is_alive(self):
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def add_event_listener(self, func, event):
+        self.listeners.append(func)
+
+    def remove_event_listener(self, func):
+        self.listeners.remove(func)
+
+    def attach_stream(self, stream_id, circ_id):
+        self.attached.append((stream_id, circ_id))
+
+    def new_stream(self, stream_id, source_port, username=None):
+        line = '650 STREAM {} NEW 0 example.com:443 SOURCE_ADDR=127.0.0.1:{} '\
+            'PURPOSE=USER'.format(stream_id, source_port)
+        if username is not None:
+            line += ' SOCKS_USERNAME="{}" SOCKS_PASSWORD="sbws"'.format(
+                username)
+        event = stem.response.ControlMessage.from_str(
+            line + '\r\n', 'EVENT')
+        for listener in self.listeners:
+            listener(event)
+
+
+def test_stream_attacher():
+    cont = _FakeController()
+    attacher = stream_attacher(cont)
+    # Only one per controller
+    assert stream_attacher(cont) is attacher
+    assert len(cont.listeners) == 1
+    attacher.register_socks_username(circuit_socks_username('7'), '7')
+    attacher.register_source_port(5001, '8')
+    cont.new_stream('1', 5000, username=circuit_socks_username('7'))
+    cont.new_stream('2', 5001)
+    # Not ours
+    cont.new_stream('3', 5002, username='someone-else')
+    attacher.unregister_socks_username(circuit_socks_username('7'))
+    attacher.unregister_source_port(5001)
+    cont.new_stream('4', 5003, username=circuit_socks_username('7'))
+    cont.new_stream('5', 5001)
+    assert cont.attached == [('1', '7'), ('2', '8')]
+
+
+def test_reports_socks_usernames():
+    assert reports_socks_usernames(_FakeController('0.4.3.1-alpha'))
+    assert reports_socks_usernames(_FakeController('0.4.8.10'))
+    assert not reports_socks_usernames(_FakeController('0.4.2.8'))
+    assert not reports_socks_usernames(_FakeController('0.3.5.7'))
+    assert not reports_socks_usernames(_FakeController('0.3.4.11'))